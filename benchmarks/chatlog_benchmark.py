@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Compares peak RSS and throughput of loading a chatlog export with json.load against
+# streaming it, on synthetic exports of the requested sizes.
+#
+# Usage (from the repository root):
+#   python benchmarks/chatlog_benchmark.py --megabytes 100 1000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ['load', 'stream', 'load-count', 'stream-count', 'stream-top-k', 'stream-fingerprint']
+
+
+# Runs a single measurement in this process and prints the result as json
+def run_measurement(mode, filename):
+    sys.path.insert(0, ROOT_DIR)
+    from models.chatlog import ChatLog
+    from models.space_saving import SpaceSaving
+    import settings
+
+    start = time.perf_counter()
+    chatlog = ChatLog(filename, stream=mode.startswith('stream'))
+    if mode.endswith('count'):
+        comments = sum(count for (count, users, channel_id, stream_id) in chatlog.count_comments().values())
+    elif mode.endswith('top-k'):
+        # same counting as ChatLog.count_top_comments, which does not return the number of comments
+        top_comments = SpaceSaving(settings.TOP_K_CAPACITY, set)
+        for comment in chatlog.comments():
+            top_comments.add(comment.body).add(comment.user)
+        comments = top_comments.total
+    elif mode.endswith('fingerprint'):
+        comments = sum(count for (count, users, channel_id, stream_id) in chatlog.count_fingerprints().values())
+    else:
+        comments = sum(1 for comment in chatlog.comments())
+    seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        'mode': mode,
+        'comments': comments,
+        'seconds': round(seconds, 3),
+        'comments_per_second': round(comments / seconds),
+        'megabytes_per_second': round(os.path.getsize(filename) / 1000000 / seconds, 2),
+        # ru_maxrss is reported in kilobytes on linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000, 1),
+    }))
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark chatlog parsing memory and throughput')
+    argument_parser.add_argument('--megabytes', type=int, nargs='+', default=[100, 1000])
+    argument_parser.add_argument('--modes', nargs='+', choices=MODES, default=['load', 'stream', 'stream-count'])
+    argument_parser.add_argument('--directory', help='where synthetic exports are written, defaults to a temporary directory')
+    argument_parser.add_argument('--measure', nargs=2, metavar=('MODE', 'FILE'), help=argparse.SUPPRESS)
+    parser = argument_parser.parse_args()
+
+    if parser.measure:
+        run_measurement(*parser.measure)
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from chatlog_generator import write_chatlog
+
+    directory = parser.directory or tempfile.mkdtemp(prefix='chatlog_benchmark_')
+    results = []
+    for megabytes in parser.megabytes:
+        filename = os.path.join(directory, 'synthetic_{}mb.json'.format(megabytes))
+        if not os.path.exists(filename):
+            write_chatlog(filename, target_bytes=megabytes * 1000000)
+
+        for mode in parser.modes:
+            # Every measurement runs in a fresh process so peak RSS is not shared between modes
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', mode, filename], \
+                cwd=ROOT_DIR, stdout=subprocess.PIPE, check=True).stdout
+            result = json.loads(output)
+            result['file_megabytes'] = megabytes
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import itertools
+import json
+import random
+
+# Writes synthetic chatlog exports in the same schema as tests/test_files/test_comment.json
+
+CHANNEL_ID = '137512364'
+STREAM_ID = '451603129'
+
+# how spam comments pick one of the spam messages: pareto (a few messages repeated most of the time), zipf
+# (the n-th message repeated 1/n as often as the first) or uniform
+DISTRIBUTIONS = ['pareto', 'zipf', 'uniform']
+
+
+# Builds a single comment dictionary in the twitch export schema
+def make_comment(index, user, body, offset):
+    created_at = '2019-07-12T{:02d}:{:02d}:{:02d}.{:09d}Z'.format(\
+        (4 + int(offset) // 3600) % 24, (int(offset) // 60) % 60, int(offset) % 60, index % 1000000000)
+    return {
+        "_id": "synthetic-{}".format(index),
+        "channel_id": CHANNEL_ID,
+        "commenter": {
+            "_id": str(10000000 + int(user[len('viewer'):])),
+            "bio": None,
+            "created_at": "2014-04-30T01:08:55.326739Z",
+            "display_name": user,
+            "logo": "https://static-cdn.jtvnw.net/user-default-pictures-uv/profile_image-300x300.png",
+            "name": user.lower(),
+            "type": "user",
+            "updated_at": "2019-09-29T05:34:53.82089Z"
+        },
+        "content_id": STREAM_ID,
+        "content_offset_seconds": offset,
+        "content_type": "video",
+        "created_at": created_at,
+        "message": {
+            "body": body,
+            "fragments": [{"text": body}],
+            "is_action": False,
+            "user_badges": [{"_id": "premium", "version": "1"}]
+        },
+        "more_replies": False,
+        "source": "chat",
+        "state": "published",
+        "updated_at": created_at
+    }
+
+
+# Yields (user, body, offset) for every synthetic comment, endlessly if comments is None. A spam_ratio
+# of the comments are one of spam_messages messages picked by distribution, the others are unique
+def generate_messages(comments=None, users=5000, spam_messages=50, spam_ratio=0.3, seed=0, distribution='pareto'):
+    generator = random.Random(seed)
+    user_names = ['viewer{}'.format(index) for index in range(users)]
+    spam = ['spam message {} KEKW'.format(index) for index in range(spam_messages)]
+    pick_spam = spam_picker(generator, spam_messages, distribution)
+    offset = 0.0
+    for index in itertools.count():
+        if comments is not None and index >= comments:
+            return
+        offset += generator.expovariate(5.0)
+        if generator.random() < spam_ratio:
+            body = spam[pick_spam()]
+        else:
+            body = 'unique message {} from chat'.format(index)
+        yield generator.choice(user_names), body, round(offset, 3)
+
+
+# Returns a function picking the index of a spam message with distribution
+def spam_picker(generator, spam_messages, distribution):
+    if distribution == 'pareto':
+        return lambda: int(generator.paretovariate(1.2)) % spam_messages
+    if distribution == 'zipf':
+        weights = list(itertools.accumulate([1 / rank for rank in range(1, spam_messages + 1)]))
+        indexes = range(spam_messages)
+        return lambda: generator.choices(indexes, cum_weights=weights)[0]
+    if distribution == 'uniform':
+        return lambda: generator.randrange(spam_messages)
+    raise ValueError("Unknown distribution {}, expected one of {}".format(distribution, DISTRIBUTIONS))
+
+
+# Writes a chatlog export with `comments` comments, or until the file reaches `target_bytes`.
+# The other arguments are those of generate_messages
+def write_chatlog(filename, comments=None, target_bytes=None, seed=0, users=5000, spam_messages=50, spam_ratio=0.3, \
+    distribution='pareto'):
+    written = 0
+    size = 0
+    messages = generate_messages(comments, users, spam_messages, spam_ratio, seed, distribution)
+    with open(filename, 'w') as file:
+        file.write('{\n  "comments": [\n')
+        for index, (user, body, offset) in enumerate(messages):
+            if target_bytes is not None and size >= target_bytes:
+                break
+            # json.dumps escapes non ascii characters so string length equals the size in bytes
+            line = (',\n' if index else '') + json.dumps(make_comment(index, user, body, offset))
+            file.write(line)
+            size += len(line)
+            written += 1
+        file.write('\n  ],\n  "_next": null\n}\n')
+    return written
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Generate a synthetic twitch chatlog export')
+    argument_parser.add_argument('file')
+    argument_parser.add_argument('--comments', type=int)
+    argument_parser.add_argument('--megabytes', type=int)
+    argument_parser.add_argument('--seed', type=int, default=0)
+    argument_parser.add_argument('--users', type=int, default=5000)
+    argument_parser.add_argument('--spam-messages', type=int, default=50, help="number of distinct spam messages")
+    argument_parser.add_argument('--spam-ratio', type=float, default=0.3, help="share of the comments that are spam")
+    argument_parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='pareto', \
+        help="how often each spam message is repeated")
+    parser = argument_parser.parse_args()
+
+    target_bytes = parser.megabytes * 1000000 if parser.megabytes else None
+    written = write_chatlog(parser.file, parser.comments, target_bytes, parser.seed, parser.users, parser.spam_messages, \
+        parser.spam_ratio, parser.distribution)
+    print("wrote {} comments to {}".format(written, parser.file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Times the commands of twitch.py on synthetic chatlogs of --comments comments (10k, 1M and 10M by default),
+# written by chatlog_generator with --users, --spam-messages, --spam-ratio and --distribution. Every command
+# runs --repeat times as its own process of twitch.py --stats, against a database of its own per chatlog.
+# A result is printed as a json line to stderr as soon as it is measured, and once done a json object
+# {"python", "platform", "cpus", "parameters", "results": [every result]} to stdout (or to --output):
+#   {"comments", "command", "argv", "seconds": [every run], "min_seconds", "min_command_seconds", "max_rss_megabytes", "stats"}
+# min_command_seconds leaves out the start of the interpreter and the imports (the seconds of --stats), stats is
+# the --stats summary of the last run. The read commands run after the chatlog is stored, their
+# first run is the one reading the database, later ones may be answered by the result cache.
+# With --baseline, results are compared to a previous output of this script and the script exits 1 if the
+# min_seconds of a command grew by more than --tolerance (0.25 is 25%).
+#
+# Usage (from the repository root):
+#   python benchmarks/command_benchmark.py --comments 10000 1000000 --repeat 3 --output benchmark.json
+#   python benchmarks/command_benchmark.py --comments 10000 1000000 --repeat 3 --baseline benchmark.json
+# A chatlog of 10M comments is about 7.8GB, chatlogs are reused from --directory between runs.
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from chatlog_generator import CHANNEL_ID, STREAM_ID, DISTRIBUTIONS, write_chatlog
+
+COMMANDS = ['parsetopspam', 'storechatlog', 'gettopspam', 'gettopspam2', 'querychatlog', 'viewership']
+
+
+# Arguments of twitch.py for command on the chatlog filename
+def command_argv(command, filename):
+    if command in ['parsetopspam', 'storechatlog']:
+        return [command, filename]
+    if command == 'querychatlog':
+        return [command, 'stream_id eq {}'.format(STREAM_ID), 'user eq viewer7', '--jsonl']
+    return [command, CHANNEL_ID, STREAM_ID]
+
+
+# Runs twitch.py --stats with argv in directory, returns (seconds, max RSS in megabytes, stats summary)
+def run_twitch(argv, directory):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'twitch.py'), '--stats'] + argv, cwd=directory, \
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    errors = process.stderr.read()
+    # wait4 gives the resource usage of this process alone
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, argv, stderr=errors)
+
+    # the stats are the last line printed to stderr
+    stats = json.loads(errors.decode('utf-8').splitlines()[-1])
+    return seconds, usage.ru_maxrss / 1024, stats
+
+
+# Measures every command on filename, the database is created in a directory of its own
+def measure_chatlog(filename, comments, commands, repeat):
+    directory = tempfile.mkdtemp(prefix='command_benchmark_')
+    os.mkdir(os.path.join(directory, 'logs'))
+    run_twitch(['createchannel', 'synthetic', CHANNEL_ID], directory)
+    # the read commands need the chatlog and its top spam stored
+    if 'parsetopspam' not in commands or 'storechatlog' not in commands:
+        run_twitch(['ingest', filename], directory)
+
+    results = []
+    for command in commands:
+        argv = command_argv(command, filename)
+        runs = [run_twitch(argv, directory) for index in range(repeat)]
+        result = {
+            'comments': comments,
+            'command': command,
+            'argv': argv,
+            'seconds': [round(seconds, 3) for seconds, max_rss, stats in runs],
+            'min_seconds': round(min([seconds for seconds, max_rss, stats in runs]), 3),
+            'min_command_seconds': round(min([stats['seconds'] for seconds, max_rss, stats in runs]), 3),
+            'max_rss_megabytes': round(max([max_rss for seconds, max_rss, stats in runs]), 1),
+            'stats': runs[-1][2],
+        }
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+    return results
+
+
+# Returns the results of results whose min_seconds grew by more than tolerance from baseline_results
+def find_regressions(results, baseline_results, tolerance):
+    baseline = dict([((result['comments'], result['command']), result) for result in baseline_results])
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['comments'], result['command']))
+        if previous and result['min_seconds'] > previous['min_seconds'] * (1 + tolerance):
+            regressions.append({'comments': result['comments'], 'command': result['command'], \
+                'baseline_seconds': previous['min_seconds'], 'min_seconds': result['min_seconds']})
+    return regressions
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark the commands of twitch.py on synthetic chatlogs')
+    argument_parser.add_argument('--comments', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    argument_parser.add_argument('--commands', nargs='+', choices=COMMANDS, default=COMMANDS)
+    argument_parser.add_argument('--repeat', type=int, default=1)
+    argument_parser.add_argument('--users', type=int, default=5000)
+    argument_parser.add_argument('--spam-messages', type=int, default=50)
+    argument_parser.add_argument('--spam-ratio', type=float, default=0.3)
+    argument_parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='pareto')
+    argument_parser.add_argument('--seed', type=int, default=0)
+    argument_parser.add_argument('--directory', help="directory of the generated chatlogs, kept between runs")
+    argument_parser.add_argument('--output', metavar='FILE', help="write the results to FILE instead of stdout")
+    argument_parser.add_argument('--baseline', metavar='FILE', help="results of a previous run to compare with")
+    argument_parser.add_argument('--tolerance', type=float, default=0.25)
+    parser = argument_parser.parse_args()
+
+    # twitch.py runs from the directory of its database
+    directory = os.path.abspath(parser.directory or tempfile.mkdtemp(prefix='command_benchmark_'))
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    for comments in parser.comments:
+        filename = os.path.join(directory, 'synthetic_{}_{}u_{}s_{}_{}_{}.json'.format(comments, parser.users, \
+            parser.spam_messages, parser.spam_ratio, parser.distribution, parser.seed))
+        if not os.path.exists(filename):
+            write_chatlog(filename, comments, seed=parser.seed, users=parser.users, spam_messages=parser.spam_messages, \
+                spam_ratio=parser.spam_ratio, distribution=parser.distribution)
+        results += measure_chatlog(filename, comments, parser.commands, parser.repeat)
+
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': dict([(name, value) for name, value in vars(parser).items() \
+            if name not in ['directory', 'output', 'baseline']]),
+        'results': results,
+    }
+    if parser.output:
+        with open(parser.output, 'w') as file:
+            json.dump(output, file, indent=1)
+    else:
+        print(json.dumps(output))
+
+    if parser.baseline:
+        with open(parser.baseline) as file:
+            regressions = find_regressions(results, json.load(file)['results'], parser.tolerance)
+        for regression in regressions:
+            print('regression: {}'.format(json.dumps(regression)), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+# Compares top_spam inserts per second when opening a connection per insert (the previous
+# DbHandler behaviour) against the long lived connection, with and without a transaction.
+#
+# Usage (from the repository root):
+#   python benchmarks/db_benchmark.py --rows 5000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from models.db_model import DbHandler
+
+
+def make_rows(rows):
+    return [['137512364', '451603129', 'spam message {}'.format(index), 20, 10] for index in range(rows)]
+
+
+# connect, insert, commit and close for every row
+def insert_connection_per_row(database_name, rows):
+    for values in rows:
+        connection = sqlite3.connect(database_name)
+        connection.execute("INSERT INTO top_spam VALUES(?,?,?,?,?)", values)
+        connection.commit()
+        connection.close()
+
+
+# long lived connection, one commit per row
+def insert_persistent_connection(db_handler, rows):
+    for values in rows:
+        db_handler.insert_values('top_spam', values)
+
+
+# long lived connection, a single commit for all the rows
+def insert_transaction(db_handler, rows):
+    with db_handler.transaction():
+        for values in rows:
+            db_handler.insert_values('top_spam', values)
+
+
+def measure(name, rows, insert):
+    start = time.perf_counter()
+    insert()
+    seconds = time.perf_counter() - start
+    return {'method': name, 'rows': rows, 'seconds': round(seconds, 3), 'inserts_per_second': round(rows / seconds)}
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark DbHandler inserts per second')
+    argument_parser.add_argument('--rows', type=int, default=5000)
+    parser = argument_parser.parse_args()
+
+    database_name = os.path.join(tempfile.mkdtemp(prefix='db_benchmark_'), 'benchmark.db')
+    db_handler = DbHandler(database_name)
+    rows = make_rows(parser.rows)
+
+    results = [
+        measure('connection_per_row', parser.rows, lambda: insert_connection_per_row(database_name, rows)),
+        measure('persistent_connection', parser.rows, lambda: insert_persistent_connection(db_handler, rows)),
+        measure('transaction', parser.rows, lambda: insert_transaction(db_handler, rows)),
+    ]
+    db_handler.close()
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
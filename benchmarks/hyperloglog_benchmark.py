@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Measures the error of HyperLogLog distinct counts against their memory, for every precision and
+# cardinality, next to the memory of the exact set of user names. Then counts the comments of a
+# synthetic raid (few messages repeated by many users) with exact sets and with sketches and
+# reports the peak memory, time and worst user count error of both.
+#
+# Usage (from the repository root):
+#   python benchmarks/hyperloglog_benchmark.py --precisions 10 12 14 16 --cardinalities 1000 100000 1000000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models.chatlog import Comment, count_comment
+from models.hyperloglog import HyperLogLog
+from chatlog_generator import CHANNEL_ID, STREAM_ID, generate_messages
+
+
+# Returns the bytes allocated by building what make returns
+def allocated_bytes(make):
+    tracemalloc.start()
+    result = make()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def measure_error(precision, cardinality, trials):
+    errors = []
+    for trial in range(trials):
+        sketch = HyperLogLog(precision)
+        for index in range(cardinality):
+            sketch.add('viewer{}-{}'.format(trial, index))
+        errors.append(sketch.count() / cardinality - 1)
+
+    return {
+        'precision': precision,
+        'cardinality': cardinality,
+        'mean_absolute_error': round(sum([abs(error) for error in errors]) / trials, 5),
+        'max_absolute_error': round(max([abs(error) for error in errors]), 5),
+        'expected_standard_error': round(1.04 / (1 << precision) ** 0.5, 5),
+        'sketch_bytes': allocated_bytes(lambda: HyperLogLog.from_bytes(sketch.to_bytes())),
+        'serialized_bytes': len(sketch.to_bytes()),
+        'exact_set_bytes': allocated_bytes(lambda: set(['viewer0-{}'.format(index) for index in range(cardinality)])),
+    }
+
+
+# counts the comments of the raid, returns {comment: user_count}
+def count_raid(records, exact):
+    counts = {}
+    for comment in records:
+        count_comment(counts, comment, set if exact else HyperLogLog)
+    return {body: len(users) for body, (count, users, channel_id, stream_id) in counts.items()}
+
+
+def measure_raid(comments, users, exact):
+    records = [Comment(CHANNEL_ID, STREAM_ID, body, user, '', offset) for user, body, offset \
+        in generate_messages(comments, users=users, spam_messages=20, spam_ratio=0.95)]
+
+    start = time.perf_counter()
+    user_counts = count_raid(records, exact)
+    seconds = time.perf_counter() - start
+
+    # tracemalloc slows allocations down, memory is measured in a second run
+    tracemalloc.start()
+    count_raid(records, exact)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return user_counts, {
+        'mode': 'exact' if exact else 'sketch',
+        'comments': comments,
+        'users': users,
+        'seconds': round(seconds, 3),
+        'peak_mb': round(peak / 1000000, 1),
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark HyperLogLog error against memory')
+    argument_parser.add_argument('--precisions', type=int, nargs='+', default=[10, 12, 14, 16])
+    argument_parser.add_argument('--cardinalities', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    argument_parser.add_argument('--trials', type=int, default=5)
+    argument_parser.add_argument('--raid-comments', type=int, default=500000)
+    argument_parser.add_argument('--raid-users', type=int, default=200000)
+    parser = argument_parser.parse_args()
+
+    results = {'error': [], 'raid': []}
+    for precision in parser.precisions:
+        for cardinality in parser.cardinalities:
+            result = measure_error(precision, cardinality, parser.trials)
+            results['error'].append(result)
+            print(json.dumps(result), file=sys.stderr)
+
+    exact_counts, result = measure_raid(parser.raid_comments, parser.raid_users, True)
+    results['raid'].append(result)
+    print(json.dumps(result), file=sys.stderr)
+
+    sketch_counts, result = measure_raid(parser.raid_comments, parser.raid_users, False)
+    # worst relative error of the user count of a message
+    result['max_user_count_error'] = round(max([abs(sketch_counts[body] / exact_counts[body] - 1) \
+        for body in exact_counts]), 5)
+    results['raid'].append(result)
+    print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+# Weighs every index of chat_rows and top_spam against what it costs to keep: --streams synthetic chatlogs of
+# --comments comments each are ingested into a database of all the indexes, then into one database per index
+# without that index, each one in its own process. The ingest is timed, then the reads of a stream, every read
+# --repeat times with the result cache left out, keeping the fastest run:
+#  - query_stream: querychatlog of a channel and stream, ordered by chat_time
+#  - query_user: querychatlog of the comments of a user in a stream
+#  - top_spam, top_spam2: gettopspam and gettopspam2
+#  - viewership_10s: viewership of a window that is not a rollup, read from chat_rows
+#  - search, search_stream: searchchatlog of a spam word in every stream and in a stream
+#  - delete: deletechatlog of a stream
+# An index is worth keeping when dropping it makes a read slower by more than it makes the ingest faster.
+# Prints a json list of {"dropped_index", "ingest_seconds", "seconds": {read: seconds}, "database_megabytes"}.
+# Measured with 4 streams of 300k comments (a 316MB database ingested in 63s to 78s whatever the index dropped,
+# the ingest seconds vary more between runs than with the indexes), the indexes kept are worth their size:
+#  - chat_rows_stream_text (29MB): top_spam2 takes 2.7s without it instead of 0.11s, search 14.1s instead of 0.48s
+#  - chat_rows_stream_time (67MB): query_stream reads its rows in chat_time order from it, 5.1s without it instead
+#    of 4.3s, and viewership_10s the chat_time of the stream start, 0.77s instead of 0.60s
+#  - chat_rows_stream_user (21MB): query_user takes 0.15s without it instead of 0.001s
+#  - top_spam_stream: top_spam, a few rows per stream which cost nothing to index
+# chat_rows_stream_offset (37MB) was read by none of them and was dropped.
+#
+# Usage (from the repository root):
+#   python benchmarks/index_benchmark.py --comments 300000 --streams 4
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from chatlog_generator import CHANNEL_ID, STREAM_ID, write_chatlog
+
+INDEXES = ['chat_rows_stream_text', 'chat_rows_stream_time', 'chat_rows_stream_user', 'top_spam_stream']
+READS = ['query_stream', 'query_user', 'top_spam', 'top_spam2', 'viewership_10s', 'search', 'search_stream', 'delete']
+
+
+# Writes the chatlog of every stream to directory, the streams after the first one are copies under another id
+def write_chatlogs(directory, comments, streams):
+    filenames = [os.path.join(directory, 'chatlog_{}.json'.format(stream)) for stream in range(streams)]
+    write_chatlog(filenames[0], comments)
+    with open(filenames[0]) as file:
+        chatlog = file.read()
+    for stream, filename in list(enumerate(filenames))[1:]:
+        with open(filename, 'w') as file:
+            file.write(chatlog.replace('"content_id": "{}"'.format(STREAM_ID), \
+                '"content_id": "{}"'.format(int(STREAM_ID) + stream)))
+    return filenames
+
+
+def run_variant(directory, dropped_index, filenames, repeat):
+    database_name = os.path.join(directory, '{}.db'.format(dropped_index or 'all'))
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(database_name + suffix):
+            os.remove(database_name + suffix)
+
+    from models.db_model import DbHandler
+    from models.result_cache import ResultCache
+    from models.twitch_model import Twitch
+    db_handler = DbHandler(database_name)
+    if dropped_index:
+        db_handler.close()
+        connection = sqlite3.connect(database_name)
+        connection.execute('DROP INDEX {}'.format(dropped_index))
+        connection.close()
+    twitch = Twitch()
+    twitch.result_cache = ResultCache(0, 0, None)
+
+    start = time.perf_counter()
+    for filename in filenames:
+        twitch.parse_chatlog(filename, stream=True)
+        twitch.ingest_chatlog(filename)
+    ingest_seconds = time.perf_counter() - start
+    # the write ahead log is checkpointed once the connection closes
+    db_handler.close()
+    database_megabytes = round(os.path.getsize(database_name) / 1000000, 1)
+
+    reads = {
+        'query_stream': lambda: twitch.query_chatlog(['channel_id eq ' + CHANNEL_ID, 'stream_id eq ' + STREAM_ID]),
+        'query_user': lambda: twitch.query_chatlog(['stream_id eq ' + STREAM_ID, 'user eq viewer7']),
+        'top_spam': lambda: twitch.get_top_spam(CHANNEL_ID, STREAM_ID),
+        'top_spam2': lambda: twitch.get_top_spam2(CHANNEL_ID, STREAM_ID),
+        'viewership_10s': lambda: twitch.get_viewer_metrics(CHANNEL_ID, STREAM_ID, window='10s'),
+        'search': lambda: twitch.search_chatlog('KEKW'),
+        'search_stream': lambda: twitch.search_chatlog('KEKW', CHANNEL_ID, STREAM_ID),
+        'delete': lambda: twitch.delete_chatlog(CHANNEL_ID, STREAM_ID),
+    }
+    seconds = {}
+    for read in READS:
+        # a stream is only deleted once
+        for run in range(1 if read == 'delete' else repeat):
+            start = time.perf_counter()
+            reads[read]()
+            seconds[read] = min(seconds.get(read, float('inf')), round(time.perf_counter() - start, 3))
+    db_handler.close()
+
+    return {
+        'dropped_index': dropped_index,
+        'ingest_seconds': round(ingest_seconds, 3),
+        'seconds': seconds,
+        'database_megabytes': database_megabytes,
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark the ingest cost and read benefit of every index')
+    argument_parser.add_argument('--comments', type=int, default=300000)
+    argument_parser.add_argument('--streams', type=int, default=4)
+    argument_parser.add_argument('--repeat', type=int, default=3)
+    argument_parser.add_argument('--indexes', nargs='+', choices=INDEXES, default=INDEXES)
+    argument_parser.add_argument('--directory', help='reuse the chatlogs written by a previous run')
+    # runs a single variant, used for the process of every variant
+    argument_parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser = argument_parser.parse_args()
+
+    directory = parser.directory or tempfile.mkdtemp(prefix='index_benchmark_')
+    if parser.run is not None:
+        filenames = [os.path.join(directory, 'chatlog_{}.json'.format(stream)) for stream in range(parser.streams)]
+        print(json.dumps(run_variant(directory, parser.run, filenames, parser.repeat)))
+        return
+
+    if not parser.directory:
+        write_chatlogs(directory, parser.comments, parser.streams)
+
+    results = []
+    for dropped_index in [''] + parser.indexes:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', dropped_index, '--directory', \
+            directory, '--streams', str(parser.streams), '--repeat', str(parser.repeat)], cwd=ROOT_DIR, \
+            stdout=subprocess.PIPE, check=True).stdout
+        result = json.loads(output.decode().splitlines()[-1])
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Times Twitch.ingest_chatlog of a synthetic export of --comments comments (200k by default) with
+# logging at every level of --levels (TWITCH_LOG_LEVEL), each in a fresh process, database and log
+# file. seconds is the ingest alone, flush_seconds the time the log listener took to write the
+# records left once it returned. insert_top_spam logs a DEBUG line per row, --threshold 0 inserts
+# every distinct comment into top_spam.
+#
+# Usage (from the repository root):
+#   python benchmarks/logging_benchmark.py --comments 200000 --levels INFO DEBUG --threshold 0
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Runs a single measurement in this process, from a directory of its own, and prints the result as json
+def run_measurement(filename, threshold):
+    sys.path.insert(0, ROOT_DIR)
+    import settings
+    from models.twitch_model import Twitch
+
+    twitch = Twitch()
+    twitch.parse_chatlog(filename, stream=True)
+    start = time.perf_counter()
+    comment_count = twitch.ingest_chatlog(filename, threshold)[0]
+    seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    settings.log_listener.stop()
+    flush_seconds = time.perf_counter() - start
+
+    with open(settings.LOG_FILE) as file:
+        log_lines = sum(1 for line in file)
+
+    print(json.dumps({
+        'level': settings.LOG_LEVEL,
+        'threshold': threshold,
+        'comments': comment_count,
+        'seconds': round(seconds, 3),
+        'flush_seconds': round(flush_seconds, 3),
+        'log_lines': log_lines,
+        'log_megabytes': round(os.path.getsize(settings.LOG_FILE) / 1000000, 2),
+    }))
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark ingest with logging at several levels')
+    argument_parser.add_argument('--comments', type=int, default=200000)
+    argument_parser.add_argument('--levels', nargs='+', default=['INFO', 'DEBUG'])
+    argument_parser.add_argument('--threshold', type=int, default=0)
+    argument_parser.add_argument('--measure', metavar='FILE', help=argparse.SUPPRESS)
+    parser = argument_parser.parse_args()
+
+    if parser.measure:
+        run_measurement(parser.measure, parser.threshold)
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from chatlog_generator import write_chatlog
+
+    filename = os.path.join(tempfile.mkdtemp(prefix='logging_benchmark_'), 'synthetic.json')
+    write_chatlog(filename, comments=parser.comments)
+
+    results = []
+    for level in parser.levels:
+        # the database and the log file are created in the working directory
+        directory = tempfile.mkdtemp(prefix='logging_benchmark_')
+        os.mkdir(os.path.join(directory, 'logs'))
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', filename, '--threshold', \
+            str(parser.threshold)], cwd=directory, env=dict(os.environ, TWITCH_LOG_LEVEL=level), stdout=subprocess.PIPE, \
+            check=True).stdout
+        result = json.loads(output)
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Compares reading chat_log rows as a dict per row (the previous select_from_database, which
+# copied every tuple into a dict through cursor.description) against the Row factory, and the
+# renaming of top_spam keys on every dict against SQL aliases. Reports time and allocated blocks
+# per 1M rows, allocations are counted with tracemalloc in a second, untimed run.
+#
+# Usage (from the repository root):
+#   python benchmarks/rows_benchmark.py --rows 1000000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from models.db_model import Row
+
+
+def create_database(database_name, rows):
+    connection = sqlite3.connect(database_name)
+    connection.execute("CREATE TABLE chat_log (channel_id TEXT, stream_id TEXT, text TEXT, user TEXT, chat_time TEXT, offset REAL)")
+    connection.execute("CREATE TABLE top_spam (channel_id TEXT, stream_id TEXT, spam_text TEXT, spam_occurrences INTEGER, spam_user_count INTEGER)")
+    connection.executemany("INSERT INTO chat_log VALUES(?,?,?,?,?,?)", \
+        (('137512364', '451603129', 'message {}'.format(index), 'viewer{}'.format(index % 5000), \
+        '2019-07-12T04:00:00.000Z', index / 5) for index in range(rows)))
+    connection.executemany("INSERT INTO top_spam VALUES(?,?,?,?,?)", \
+        (('137512364', '451603129', 'spam {}'.format(index), index, index) for index in range(rows)))
+    connection.commit()
+    connection.close()
+
+
+# previous select_from_database: a dict per row built from cursor.description
+def dict_rows(connection, query):
+    results = connection.execute(query)
+    column_names = [name[0] for name in results.description]
+    list_of_rows = []
+    for row in results:
+        row_dict = {}
+        for index, name, in enumerate(column_names):
+            row_dict[name] = row[index]
+        list_of_rows.append(row_dict)
+    return list_of_rows
+
+
+# previous get_top_spam: dict rows with two keys renamed on every row
+def renamed_dict_rows(connection, query):
+    top_spam = dict_rows(connection, query)
+    for spam in top_spam:
+        spam["occurrences"] = spam.pop("spam_occurrences")
+        spam["user_count"] = spam.pop("spam_user_count")
+    return top_spam
+
+
+def row_factory_rows(connection, query):
+    return connection.execute(query).fetchall()
+
+
+CASES = [
+    ('chat_log dict per row', False, dict_rows, "SELECT * FROM chat_log"),
+    ('chat_log Row', True, row_factory_rows, "SELECT * FROM chat_log"),
+    ('top_spam dict per row, renamed keys', False, renamed_dict_rows, \
+        "SELECT spam_text, spam_occurrences, spam_user_count FROM top_spam"),
+    ('top_spam Row, SQL aliases', True, row_factory_rows, \
+        "SELECT spam_text, spam_occurrences AS occurrences, spam_user_count AS user_count FROM top_spam"),
+]
+
+
+def measure(database_name, rows, name, use_row_factory, select, query):
+    connection = sqlite3.connect(database_name)
+    if use_row_factory:
+        connection.row_factory = Row
+
+    start = time.perf_counter()
+    result = select(connection, query)
+    seconds = time.perf_counter() - start
+    del result
+
+    # Blocks still allocated once the rows are built, i.e. what holding the result costs
+    tracemalloc.start()
+    result = select(connection, query)
+    current, peak = tracemalloc.get_traced_memory()
+    blocks = sum(statistic.count for statistic in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del result
+    connection.close()
+
+    per_million = 1000000 / rows
+    return {
+        'method': name,
+        'rows': rows,
+        'seconds_per_1m_rows': round(seconds * per_million, 3),
+        'allocated_blocks_per_1m_rows': round(blocks * per_million),
+        'allocated_mb_per_1m_rows': round(current * per_million / 1000000, 1),
+        'peak_mb_per_1m_rows': round(peak * per_million / 1000000, 1),
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark dict rows against the Row factory')
+    argument_parser.add_argument('--rows', type=int, default=1000000)
+    parser = argument_parser.parse_args()
+
+    database_name = os.path.join(tempfile.mkdtemp(prefix='rows_benchmark_'), 'benchmark.db')
+    create_database(database_name, parser.rows)
+
+    results = []
+    for case in CASES:
+        result = measure(database_name, parser.rows, *case)
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
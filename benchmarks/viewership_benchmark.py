@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Times the viewership metrics of a single synthetic stream of --messages messages (10M by default)
+# for every method, each one run in its own process so its peak RSS is its own:
+#  - sql_per_second: the previous get_viewer_metrics query, messages and distinct users per second
+#    of chat_time grouped in SQL, before they were folded into minutes
+#  - sql_per_window: messages and COUNT(DISTINCT user) per window of offset grouped in SQL
+#  - fetch: loading the (offset, user) columns only, the floor of the ViewerMetrics methods
+#  - numpy, python, python_sketch: ViewerMetrics counting the windows of the chat_log rows with
+#    numpy, in python with a set of users per window and with a HyperLogLog per window
+#  - rollups: Twitch.get_viewer_metrics, which reads the rollup windows (1m, 5m) from chat_windows
+#  - sql_top_spam, rollup_top_spam: the previous gettopspam2 query grouping every chat_log row
+#    against Twitch.get_top_spam2 reading chat_texts
+# The rollups of the generated stream are built by Twitch.rebuild_rollups, which is timed too.
+#
+# Usage (from the repository root):
+#   python benchmarks/viewership_benchmark.py --messages 10000000 --users 200000 --window 1m
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import settings
+from models.db_model import DbHandler
+from models.twitch_model import Twitch
+from models.viewer_metrics import ViewerMetrics, numpy
+from chatlog_generator import CHANNEL_ID, STREAM_ID, generate_messages
+
+METHODS = ['sql_per_second', 'sql_per_window', 'fetch', 'numpy', 'python', 'python_sketch', 'rollups', \
+    'sql_top_spam', 'rollup_top_spam']
+
+# generate_messages writes 5 messages per second of stream
+GENERATED_MESSAGES_PER_SECOND = 5
+
+
+def create_database(database_name, messages, users, messages_per_second):
+    db_handler = DbHandler(database_name)
+    db_handler.set_sqlite_profile('bulk-load')
+    scale = GENERATED_MESSAGES_PER_SECOND / messages_per_second
+
+    rows = []
+    with db_handler.transaction():
+        for user, body, offset in generate_messages(messages, users=users):
+            offset = round(offset * scale, 3)
+            chat_time = '2019-07-12T{:02d}:{:02d}:{:02d}.000Z'.format((4 + int(offset) // 3600) % 24, \
+                (int(offset) // 60) % 60, int(offset) % 60)
+            rows.append([CHANNEL_ID, STREAM_ID, body, user, chat_time, offset])
+            if len(rows) == settings.CHATLOG_INSERT_BATCH_SIZE:
+                db_handler.insert_multiple_values('chat_log', rows)
+                rows = []
+        db_handler.insert_multiple_values('chat_log', rows)
+
+    start = time.perf_counter()
+    Twitch().rebuild_rollups(CHANNEL_ID, STREAM_ID)
+    rebuild_seconds = time.perf_counter() - start
+    db_handler.close()
+    return rebuild_seconds
+
+
+def run_method(database_name, method, window):
+    db_handler = DbHandler(database_name)
+    conditions = ['channel_id eq ' + CHANNEL_ID, 'stream_id eq ' + STREAM_ID]
+    window_seconds = settings.VIEWERSHIP_WINDOWS[window]
+
+    start = time.perf_counter()
+    if method == 'sql_per_second':
+        windows = len(db_handler.select_from_database('chat_log', ['chat_time', 'COUNT(*) as messages', \
+            'COUNT(DISTINCT user) as viewers'], conditions, 'AND', 'chat_time', 'ASC', \
+            "strftime('%Y-%m-%dT%H:%M:%S.000', chat_time)"))
+    elif method == 'sql_per_window':
+        windows = len(db_handler.select_from_database('chat_log', ['CAST(offset / {} AS INTEGER) AS window'\
+            .format(window_seconds), 'COUNT(*) as messages', 'COUNT(DISTINCT user) as viewers'], conditions, \
+            'AND', '', '', 'window'))
+    elif method == 'fetch':
+        windows = sum([len(offsets) for offsets, users in db_handler.iter_select_columns('chat_log', \
+            ['offset', 'user'], conditions, page_size=settings.VIEWERSHIP_PAGE_SIZE)])
+    elif method in ['numpy', 'python', 'python_sketch']:
+        metrics = ViewerMetrics(window_seconds, method != 'python_sketch', method == 'numpy')
+        for offsets, users in db_handler.iter_select_columns('chat_log', ['offset', 'user'], conditions, \
+            page_size=settings.VIEWERSHIP_PAGE_SIZE):
+            metrics.add(offsets, users)
+        windows = len(metrics.metrics())
+    elif method == 'rollups':
+        metrics = Twitch().get_viewer_metrics(CHANNEL_ID, STREAM_ID, True, window)[0]
+        windows = len(metrics['per_minute' if window == '1m' else 'per_window'])
+    elif method == 'sql_top_spam':
+        windows = len(db_handler.select_from_database('chat_log', ['text as spam_text', 'COUNT(*) as occurrences', \
+            'COUNT(DISTINCT user) as user_count'], conditions, 'AND', 'occurrences desc, user_count desc, spam_text', '', \
+            'text HAVING occurrences > ' + str(settings.TOP_SPAM_THRESHOLD)))
+    else:
+        windows = len(Twitch().get_top_spam2(CHANNEL_ID, STREAM_ID))
+    seconds = time.perf_counter() - start
+
+    db_handler.close()
+    return {
+        'method': method,
+        'window': window,
+        'result_rows': windows,
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000, 1),
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Benchmark viewership metrics of a large stream')
+    argument_parser.add_argument('--messages', type=int, default=10000000)
+    argument_parser.add_argument('--users', type=int, default=200000)
+    argument_parser.add_argument('--messages-per-second', type=float, default=200)
+    argument_parser.add_argument('--window', choices=list(settings.VIEWERSHIP_WINDOWS), default=settings.VIEWERSHIP_WINDOW)
+    argument_parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS)
+    argument_parser.add_argument('--database', help='reuse a database created by a previous run')
+    # runs a single method on an existing database, used for the process of every method
+    argument_parser.add_argument('--run', choices=METHODS, help=argparse.SUPPRESS)
+    parser = argument_parser.parse_args()
+
+    if parser.run:
+        print(json.dumps(run_method(parser.database, parser.run, parser.window)))
+        return
+
+    database_name = parser.database
+    if not database_name:
+        database_name = os.path.join(tempfile.mkdtemp(prefix='viewership_benchmark_'), 'benchmark.db')
+        start = time.perf_counter()
+        rebuild_seconds = create_database(database_name, parser.messages, parser.users, parser.messages_per_second)
+        print(json.dumps({'database': database_name, 'messages': parser.messages, 'users': parser.users, \
+            'seconds': round(time.perf_counter() - start, 1), 'rebuild_rollups_seconds': round(rebuild_seconds, 1)}), \
+            file=sys.stderr)
+
+    results = []
+    for method in parser.methods:
+        if method == 'numpy' and numpy is None:
+            print(json.dumps({'method': method, 'skipped': 'numpy is not installed'}), file=sys.stderr)
+            continue
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', method, '--database', \
+            database_name, '--window', parser.window], check=True, stdout=subprocess.PIPE, cwd=ROOT_DIR).stdout
+        result = json.loads(output)
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,11 @@ class Channel():
     def save(self, db_handler):
         try:
             db_handler.insert_values(self.table_name, [self.channel_id, self.channel_name])
-            self.logger.info("added new instance of channel with id: {} and name {}"\
-                             .format(self.channel_id, self.channel_name))
+            self.logger.info('added new instance of channel with id: %s and name %s', self.channel_id, \
+                self.channel_name)
         except sqlite3.DatabaseError as e:
-            self.logger.error("failed to add new instance of channel with id: {} and name {}" \
-                             .format(self.channel_id, self.channel_name))
+            self.logger.error('failed to add new instance of channel with id: %s and name %s', self.channel_id, \
+                self.channel_name)
             raise sqlite3.DatabaseError(e)
 
     def __str__(self):
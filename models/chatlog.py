@@ -1,43 +1,350 @@
 import json
+import os
+import sys
+import time
+from array import array
+from collections import namedtuple
+from models.hyperloglog import HyperLogLog
+from models.space_saving import SpaceSaving
+from models.fingerprint import SpamFingerprinter
+from models.stats import Stats
 import settings
 
+# Compact record of a single comment holding only the fields the application reads,
+# in the column order of the chat_log table
+Comment = namedtuple('Comment', ['channel_id', 'stream_id', 'body', 'user', 'created_at', 'offset'])
+
+
 class ChatLog():
 
-    def __init__(self, filename):
+    # stream=True reads the comments lazily from the file instead of loading the whole export.
+    # columnar=True reads the comments into CommentColumns as the file is parsed, like compact without
+    # ever holding the export
+    def __init__(self, filename, stream=False, columnar=False):
         self.filename = filename
         self.chat_log = None
+        self.stream = stream
+        # the CommentColumns of the comments once compacted, see compact
+        self.columns = None
+        self.size = 0
         self.logger = settings.chatlog_logger
         try:
             with open(self.filename) as file:
-                self.chat_log = json.load(file)
-                self.logger.info('Chatlog instance was created and ({}) was successfully imported.'.format(self.filename))
+                if columnar and not self.stream:
+                    self.__read_columns(map(to_comment, CommentStreamReader(file)))
+                    if self.columns is not None:
+                        Stats.count('comments_parsed', len(self.columns))
+                elif not self.stream:
+                    Stats.count('bytes_read', os.fstat(file.fileno()).st_size)
+                    self.chat_log = json.load(file)
+                self.logger.info('Chatlog instance was created and (%s) was successfully imported.', self.filename)
         except FileNotFoundError as e:
-            self.logger.error('Chatlog constructor failed to open ({}). Needed json.'.format(self.filename))
+            self.logger.error('Chatlog constructor failed to open (%s). Needed json.', self.filename)
             raise e
 
     def get_chatlog(self):
         return self.chat_log
 
+    # Replaces the loaded export by CommentColumns holding only the fields of its Comment records, and sets
+    # size to an estimate of their bytes. get_chatlog returns None afterwards. An export with a comment missing
+    # a field is streamed instead, so the KeyError is raised when its comments are read, as before. Returns the chatlog
+    def compact(self):
+        if self.chat_log is not None:
+            self.__read_columns(self.comments())
+            self.chat_log = None
+        return self
+
+    def __read_columns(self, comments):
+        columns = CommentColumns()
+        try:
+            for comment in comments:
+                columns.append(comment)
+        except KeyError:
+            self.stream = True
+            return
+
+        self.columns = columns
+        self.size = columns.nbytes()
+
+    # yields a Comment record for every comment in the chatlog, in file order
+    def comments(self):
+        if self.columns is not None:
+            yield from self.columns
+            return
+
+        comment_count = 0
+        try:
+            if self.stream:
+                with open(self.filename) as file:
+                    for comment in CommentStreamReader(file):
+                        yield to_comment(comment)
+                        comment_count += 1
+            else:
+                for comment in self.chat_log['comments']:
+                    yield to_comment(comment)
+                    comment_count += 1
+        finally:
+            Stats.count('comments_parsed', comment_count)
+
+    # returns (channel_id, stream_id) of the first comment, raises IndexError if there are no comments
+    def get_stream_ids(self):
+        for comment in self.comments():
+            return comment.channel_id, comment.stream_id
+        raise IndexError("({}) has no comments".format(self.filename))
+
     # count the occurences of comments and track users that made each comment
     # returns dictionary {comment<str>: tupple(count<int>, users<set>)}
-    def count_comments(self):
+    # With exact=False users are counted by a HyperLogLog sketch instead of a set, len() of either
+    # is the number of distinct users
+    def count_comments(self, exact=True):
 
         try:
             count_comments_and_users = {}
 
             # iterate through comments and count occurences
-            for comment in self.chat_log['comments']:
-                user = comment["commenter"]["display_name"]
-                message_body = comment["message"]["body"]
-                channel_id = comment["channel_id"]
-                stream_id = comment["content_id"]
-                (count, users, channel_id, stream_id) = count_comments_and_users.get(message_body, (0, set(), channel_id, stream_id))
-                count += 1
-                users.add(user)
-                count_comments_and_users[message_body] = (count, users, channel_id, stream_id)
-
-            self.logger.info('Comments at ({})successfully counted based on repetition.'.format(self.filename))
+            for comment in self.comments():
+                count_comment(count_comments_and_users, comment, set if exact else HyperLogLog)
+
+            self.logger.info('Comments at (%s)successfully counted based on repetition.', self.filename)
             return count_comments_and_users
         except KeyError as e:
-            self.logger.error('Could not count comments at ({}).'.format(self.filename))
+            self.logger.error('Could not count comments at (%s).', self.filename)
+            raise e
+
+    # Same as count_comments but only the `capacity` most repeated comments are counted, in bounded
+    # memory, with a Space-Saving summary. The tuple of every comment has a fifth element, the error:
+    # its count overestimates the occurrences by at most the error. Every comment repeated more than
+    # (number of comments / capacity) times is returned.
+    # returns dictionary {comment<str>: tupple(count<int>, users<set>, channel_id, stream_id, error<int>)}
+    def count_top_comments(self, capacity=settings.TOP_K_CAPACITY, exact=True):
+
+        try:
+            top_comments = SpaceSaving(capacity, set if exact else HyperLogLog)
+            channel_id = None
+            stream_id = None
+
+            for comment in self.comments():
+                top_comments.add(comment.body).add(comment.user)
+                channel_id = comment.channel_id
+                stream_id = comment.stream_id
+
+            self.logger.info('Top %s comments at (%s) successfully counted, counts overestimated by at most %s.', \
+                capacity, self.filename, top_comments.min_count())
+            return {body: (count, users, channel_id, stream_id, error) for body, count, error, users in top_comments.items()}
+        except KeyError as e:
+            self.logger.error('Could not count comments at (%s).', self.filename)
+            raise e
+
+    # Same as count_comments but near duplicate comments ("KEKW KEKW" and "kekw  KEKW", or texts
+    # differing by a few characters) are counted together, see SpamFingerprinter. Every group of
+    # comments is keyed by its most repeated body
+    def count_fingerprints(self, exact=True):
+
+        try:
+            fingerprinter = SpamFingerprinter()
+            clusters = {}
+
+            for comment in self.comments():
+                cluster_id = fingerprinter.cluster(comment.body)
+                cluster = clusters.get(cluster_id)
+                if cluster is None:
+                    # [count, users, channel_id, stream_id, {body: count}]
+                    cluster = [0, set() if exact else HyperLogLog(), comment.channel_id, comment.stream_id, {}]
+                    clusters[cluster_id] = cluster
+                cluster[0] += 1
+                cluster[1].add(comment.user)
+                cluster[4][comment.body] = cluster[4].get(comment.body, 0) + 1
+
+            self.logger.info('Comments at (%s) successfully counted in %s groups of near duplicates.', \
+                self.filename, len(fingerprinter))
+            return {max(bodies, key=bodies.get): (count, users, channel_id, stream_id) \
+                for count, users, channel_id, stream_id, bodies in clusters.values()}
+        except KeyError as e:
+            self.logger.error('Could not count comments at (%s).', self.filename)
             raise e
+
+
+# Comment records stored by field: channel ids, stream ids, bodies and users in lists where repeated
+# strings are a single object, created_at timestamps encoded one after the other in a bytearray with
+# an array of their end positions, and offsets in an array of doubles (integer offsets are stored as
+# equal floats). Iterating yields the Comment records. It pickles several times faster than records
+class CommentColumns():
+
+    def __init__(self):
+        self.channel_ids = []
+        self.stream_ids = []
+        self.bodies = []
+        self.users = []
+        self.timestamps = bytearray()
+        self.timestamp_ends = array('Q')
+        self.offsets = array('d')
+        # every distinct string of the lists
+        self.strings = {}
+
+    def append(self, comment):
+        strings = self.__strings()
+        self.channel_ids.append(strings.setdefault(comment.channel_id, comment.channel_id))
+        self.stream_ids.append(strings.setdefault(comment.stream_id, comment.stream_id))
+        self.bodies.append(strings.setdefault(comment.body, comment.body))
+        self.users.append(strings.setdefault(comment.user, comment.user))
+        self.timestamps += comment.created_at.encode('utf-8')
+        self.timestamp_ends.append(len(self.timestamps))
+        self.offsets.append(comment.offset)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return map(Comment._make, zip(self.channel_ids, self.stream_ids, self.bodies, self.users, \
+            self.__created_at(), self.offsets))
+
+    def __created_at(self):
+        timestamps = self.timestamps
+        start = 0
+        for end in self.timestamp_ends:
+            yield timestamps[start:end].decode('utf-8')
+            start = end
+
+    # Returns an estimate of the bytes held by the columns
+    def nbytes(self):
+        return sum([sys.getsizeof(column) for column in [self.channel_ids, self.stream_ids, self.bodies, self.users, \
+            self.timestamps, self.timestamp_ends, self.offsets, self.__strings()]]) + \
+            sum([sys.getsizeof(string) for string in self.strings])
+
+    # the strings are pickled with the lists, the index of distinct ones is rebuilt if more comments are appended
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['strings'] = None
+        return state
+
+    def __strings(self):
+        if self.strings is None:
+            self.strings = dict([(string, string) for column in [self.channel_ids, self.stream_ids, self.bodies, \
+                self.users] for string in column])
+        return self.strings
+
+
+# adds a Comment record to a dictionary in the format returned by count_comments, distinct_users
+# creates the set (or sketch) of users of a comment seen for the first time
+def count_comment(count_comments_and_users, comment, distinct_users=set):
+    (count, users, channel_id, stream_id) = count_comments_and_users.get(comment.body, \
+        (0, None, comment.channel_id, comment.stream_id))
+    if users is None:
+        users = distinct_users()
+    users.add(comment.user)
+    count_comments_and_users[comment.body] = (count + 1, users, channel_id, stream_id)
+
+
+# Reads and counts a chatlog file like Twitch.ingest_chatlog, in a worker process of Twitch.iter_ingest_chatlogs.
+# Returns (columns, spam, seconds): the CommentColumns of its comments, which are pickled to the writing
+# process, its comments repeated more than threshold sorted by count and the seconds it took
+def read_chatlog(filename, threshold=settings.TOP_SPAM_THRESHOLD, exact=True):
+    start = time.perf_counter()
+    comments = {}
+    columns = CommentColumns()
+    for comment in ChatLog(filename, stream=True).comments():
+        count_comment(comments, comment, set if exact else HyperLogLog)
+        columns.append(comment)
+
+    spam = sorted([item for item in comments.items() if item[1][0] > threshold], key=lambda kv:kv[1][0], reverse=True)
+    return columns, spam, time.perf_counter() - start
+
+
+# projects a raw comment dictionary onto a Comment record, raises KeyError on missing fields
+def to_comment(comment):
+    return Comment(comment['channel_id'], comment['content_id'], comment['message']['body'], \
+        comment['commenter']['display_name'], comment['created_at'], comment['content_offset_seconds'])
+
+
+# Iterates over the top level "comments" array of a chatlog export one comment dictionary
+# at a time. Only a small window of the file is kept in memory.
+class CommentStreamReader():
+
+    CHUNK_SIZE = 1 << 16
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def __iter__(self):
+        self.__expect('{')
+        while True:
+            if self.__peek() == '}':
+                # Export without a comments array
+                raise KeyError('comments')
+
+            key = self.__decode_value()
+            self.__expect(':')
+
+            if key == 'comments':
+                yield from self.__iter_array()
+                # Nothing after the comments array is needed
+                return
+
+            # Skip values of other keys
+            self.__decode_value()
+            if self.__peek() == ',':
+                self.position += 1
+
+    def __iter_array(self):
+        self.__expect('[')
+        if self.__peek() == ']':
+            return
+        while True:
+            yield self.__decode_value()
+            character = self.__peek()
+            self.position += 1
+            if character == ']':
+                return
+            if character != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", self.buffer, self.position - 1)
+
+    # Reads the next chunk of the file into the buffer, dropping what has been consumed
+    def __fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if Stats.current() is not None:
+            Stats.count('bytes_read', len(chunk.encode('utf-8')))
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    # Returns the next non whitespace character without consuming it
+    def __peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.__fill():
+                raise json.JSONDecodeError("Expecting value", self.buffer, self.position)
+
+    def __expect(self, character):
+        if self.__peek() != character:
+            raise json.JSONDecodeError("Expecting '{}'".format(character), self.buffer, self.position)
+        self.position += 1
+
+    # Decodes the next complete json value, reading more of the file while the value is cut off
+    def __decode_value(self):
+        self.__peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number close to the end of the buffer may continue in the next chunk
+                if not isinstance(value, (int, float)) or end < len(self.buffer) - 2 or not self.__fill():
+                    self.position = end
+                    return value
+            except json.JSONDecodeError as e:
+                if not self.__is_truncated(e) or not self.__fill():
+                    raise e
+
+    # An error close to the end of the buffer, or in a string running past it, means the value is truncated
+    def __is_truncated(self, error):
+        return error.pos >= len(self.buffer) - 6 or error.msg.startswith('Unterminated string')
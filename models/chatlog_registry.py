@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+from models.chatlog import ChatLog
+from models.stats import Stats
+import settings
+
+
+# The chatlogs parsed by Twitch, by filename. Chatlogs are kept compacted (see ChatLog.compact), up to
+# max_entries chatlogs and max_bytes of their comments, the least recently used evicted first. An evicted
+# chatlog is parsed again from its file the next time it is needed, so only its filename is kept
+class ChatLogRegistry():
+
+    def __init__(self, max_entries=settings.CHATLOG_REGISTRY_ENTRIES, max_bytes=settings.CHATLOG_REGISTRY_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.logger = settings.chatlog_logger
+        # filename: ChatLog, least recently used first
+        self.chatlogs = OrderedDict()
+        # filename: stream of every chatlog added, to parse the evicted ones again
+        self.streams = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the server parses chatlogs from several threads
+        self.lock = threading.RLock()
+
+    # Adds a parsed chatlog, replacing the one of the same file
+    def add(self, chatlog):
+        chatlog.compact()
+        with self.lock:
+            self.streams[chatlog.filename] = chatlog.stream
+            self.__load(chatlog)
+
+    # Returns the chatlog of filename, parsed again if it was evicted. Raises KeyError if it was never added
+    def __getitem__(self, filename):
+        with self.lock:
+            chatlog = self.chatlogs.get(filename)
+            if chatlog is not None:
+                self.chatlogs.move_to_end(filename)
+                self.hits += 1
+                Stats.count('chatlogs.hits')
+                return chatlog
+
+            if filename not in self.streams:
+                raise KeyError("({}) is not in chatlogs".format(filename))
+
+            self.misses += 1
+            Stats.count('chatlogs.misses')
+            self.logger.info('(%s) was evicted from the chatlogs, it is parsed again.', filename)
+            chatlog = ChatLog(filename, self.streams[filename], columnar=True)
+            self.__load(chatlog)
+            return chatlog
+
+    def __contains__(self, filename):
+        return filename in self.streams
+
+    def __len__(self):
+        return len(self.chatlogs)
+
+    # filenames of every chatlog added, loaded or not
+    def keys(self):
+        return self.streams.keys()
+
+    # Returns the counters of the registry
+    def stats(self):
+        with self.lock:
+            return {'chatlogs': len(self.chatlogs), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses, \
+                'evictions': self.evictions}
+
+    def __load(self, chatlog):
+        previous = self.chatlogs.pop(chatlog.filename, None)
+        if previous is not None:
+            self.size -= previous.size
+
+        self.chatlogs[chatlog.filename] = chatlog
+        self.size += chatlog.size
+        # the chatlog just loaded is kept even if it is larger than max_bytes on its own
+        while len(self.chatlogs) > 1 and (len(self.chatlogs) > self.max_entries or self.size > self.max_bytes):
+            filename, evicted = self.chatlogs.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+            self.logger.info('(%s) was evicted from the chatlogs.', filename)
@@ -1,8 +1,195 @@
+import json
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from models.hyperloglog import ApproxCountDistinct
+from models.stats import Stats
 import settings
 
+# Row returned by every select. Rows are built by sqlite3 in C and only keep the values and a
+# reference to the column names shared by all the rows of a query, instead of a dict per row.
+# Values can be read by column name or index, and dict(row) or json.dumps(row, default=dict)
+# converts a row where a real dict is needed. Rows compare equal to dicts with the same items.
+class Row(sqlite3.Row):
+
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self) == other
+        return sqlite3.Row.__eq__(self, other)
+
+    __hash__ = sqlite3.Row.__hash__
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class DbHandler():
 
+    # Schema migrations applied in order on top of the tables created by set_up_twitch_db.
+    # Migration i upgrades the database to schema version i + 1, which is stored in
+    # PRAGMA user_version. Released migrations must never change, append new ones instead.
+    SCHEMA_MIGRATIONS = [
+        # 1: indexes for the per stream access paths of top_spam and chat_log
+        '''
+            CREATE INDEX if not exists top_spam_stream ON top_spam (channel_id, stream_id, spam_occurrences);
+            CREATE INDEX if not exists chat_log_stream_offset ON chat_log (channel_id, stream_id, offset);
+            CREATE INDEX if not exists chat_log_stream_text ON chat_log (channel_id, stream_id, text);
+            CREATE INDEX if not exists chat_log_stream_time ON chat_log (channel_id, stream_id, chat_time);
+            CREATE INDEX if not exists chat_log_stream_user ON chat_log (stream_id, user);
+        ''',
+        # 2: per stream counters kept by Twitch.update_top_spam to maintain top_spam incrementally
+        '''
+            CREATE TABLE if not exists spam_streams (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            processed_comments integer, PRIMARY KEY (channel_id, stream_id));
+
+            CREATE TABLE if not exists spam_counts (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            spam_text string, spam_occurrences integer, PRIMARY KEY (channel_id, stream_id, spam_text));
+
+            CREATE TABLE if not exists spam_users (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            spam_text string, user string, PRIMARY KEY (channel_id, stream_id, spam_text, user)) WITHOUT ROWID;
+
+            CREATE INDEX if not exists spam_counts_stream ON spam_counts (channel_id, stream_id, spam_occurrences);
+            CREATE INDEX if not exists top_spam_stream_text ON top_spam (channel_id, stream_id, spam_text);
+        ''',
+        # 3: distinct user sketches of the counted messages, and whether the counters of a stream count users exactly.
+        # Like spam_counts every message has one, a message under the threshold may get above it in a later update
+        # and its users counted until then are in its sketch. A message seen once keeps a 4 bytes sparse sketch
+        '''
+            CREATE TABLE if not exists spam_sketches (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            spam_text string, user_sketch blob, PRIMARY KEY (channel_id, stream_id, spam_text)) WITHOUT ROWID;
+
+            ALTER TABLE spam_streams ADD COLUMN exact_user_counts integer NOT NULL DEFAULT 1;
+        ''',
+        # 4: rollups of chat_log kept by Twitch as comments are stored, filled here for the existing rows: messages and
+        # distinct chatters per window of offset for the 1 and 5 minute windows of settings.VIEWERSHIP_ROLLUP_WINDOWS,
+        # the chatters of every minute and messages per text. Texts repeated once are left out of chat_texts_repeated
+        '''
+            CREATE TABLE if not exists chat_windows (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            window_seconds integer NOT NULL, window integer NOT NULL, messages integer, chatters integer,
+            PRIMARY KEY (channel_id, stream_id, window_seconds, window)) WITHOUT ROWID;
+
+            CREATE TABLE if not exists chat_minute_users (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            minute integer NOT NULL, user string, PRIMARY KEY (channel_id, stream_id, minute, user)) WITHOUT ROWID;
+
+            CREATE TABLE if not exists chat_texts (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            text string, messages integer, PRIMARY KEY (channel_id, stream_id, text)) WITHOUT ROWID;
+
+            CREATE INDEX if not exists chat_texts_repeated ON chat_texts (channel_id, stream_id, messages) WHERE messages > 1;
+
+            INSERT INTO chat_windows SELECT channel_id, stream_id, 60, CAST(offset / 60 AS INTEGER) AS window, COUNT(*),
+            COUNT(DISTINCT user) FROM chat_log GROUP BY channel_id, stream_id, window;
+
+            INSERT INTO chat_windows SELECT channel_id, stream_id, 300, CAST(offset / 300 AS INTEGER) AS window, COUNT(*),
+            COUNT(DISTINCT user) FROM chat_log GROUP BY channel_id, stream_id, window;
+
+            INSERT INTO chat_minute_users SELECT channel_id, stream_id, CAST(offset / 60 AS INTEGER) AS minute, user
+            FROM chat_log GROUP BY channel_id, stream_id, minute, user;
+
+            INSERT INTO chat_texts SELECT channel_id, stream_id, text, COUNT(*) FROM chat_log GROUP BY channel_id, stream_id, text;
+        ''',
+        # 5: generation of the rows of every stream, given a new value by Twitch whenever it writes them so the
+        # results cached for them are not read any more. '' stands for every channel or every stream
+        '''
+            CREATE TABLE if not exists result_generations (channel_id text NOT NULL, stream_id text NOT NULL,
+            generation integer, PRIMARY KEY (channel_id, stream_id)) WITHOUT ROWID;
+        ''',
+        # 6: full text index of chat_log kept by Twitch as comments are stored and deleted, filled here for the existing
+        # rows. Its content is read from chat_log by rowid, the ids are indexed so a search is limited to a stream by
+        # the index itself. Matches are ranked by bm25 of text alone
+        '''
+            CREATE VIRTUAL TABLE if not exists chat_search USING fts5(text, channel_id, stream_id, content='chat_log',
+            content_rowid='rowid');
+
+            INSERT INTO chat_search (chat_search, rank) VALUES ('rank', 'bm25(1.0, 0.0, 0.0)');
+
+            INSERT INTO chat_search (chat_search) VALUES ('rebuild');
+        ''',
+        # 7: dictionary encoded chat_log. Every distinct user and text is stored once, in users and messages, and the
+        # rows of chat_rows refer to them by id. chat_log becomes a view of chat_rows with the columns of the table it
+        # replaces, its triggers keep the inserts and deletes through it working. chat_search indexes messages, kept
+        # in sync by a trigger, so every text is indexed once whatever the number of rows repeating it. Users and
+        # texts have text affinity, "string" would store "123" as an integer and read it back under another value.
+        # chat_log columns are "string" (numeric affinity), they are cast to text to be looked up by the UNIQUE index
+        # of users and messages instead of a scan of them for every row.
+        # The rollups of users and texts keep their ids, chat_texts_text finds the streams of a text for search.
+        # chat_log_stream_offset is not kept, no query reads it (see benchmarks/index_benchmark.py)
+        '''
+            CREATE TABLE if not exists users (user_id integer PRIMARY KEY, user text NOT NULL UNIQUE);
+
+            CREATE TABLE if not exists messages (text_id integer PRIMARY KEY, text text NOT NULL UNIQUE);
+
+            CREATE TABLE if not exists chat_rows (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            text_id integer, user_id integer, chat_time datetime, offset int,
+            FOREIGN KEY(channel_id) REFERENCES channels(channel_id));
+
+            INSERT OR IGNORE INTO users (user) SELECT user FROM chat_log WHERE user IS NOT NULL ORDER BY rowid;
+
+            INSERT OR IGNORE INTO messages (text) SELECT text FROM chat_log WHERE text IS NOT NULL ORDER BY rowid;
+
+            INSERT INTO chat_rows (rowid, channel_id, stream_id, text_id, user_id, chat_time, offset)
+            SELECT chat_log.rowid, channel_id, stream_id, text_id, user_id, chat_time, offset FROM chat_log
+            LEFT JOIN messages ON messages.text = CAST(chat_log.text AS TEXT)
+            LEFT JOIN users ON users.user = CAST(chat_log.user AS TEXT);
+
+            DROP TABLE if exists chat_search;
+
+            DROP TABLE chat_log;
+
+            CREATE INDEX if not exists chat_rows_stream_text ON chat_rows (channel_id, stream_id, text_id);
+            CREATE INDEX if not exists chat_rows_stream_time ON chat_rows (channel_id, stream_id, chat_time);
+            CREATE INDEX if not exists chat_rows_stream_user ON chat_rows (stream_id, user_id);
+
+            DROP TABLE chat_minute_users;
+
+            CREATE TABLE chat_minute_users (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            minute integer NOT NULL, user_id integer, PRIMARY KEY (channel_id, stream_id, minute, user_id)) WITHOUT ROWID;
+
+            INSERT INTO chat_minute_users SELECT channel_id, stream_id, CAST(offset / 60 AS INTEGER) AS minute, user_id
+            FROM chat_rows GROUP BY channel_id, stream_id, minute, user_id;
+
+            DROP TABLE chat_texts;
+
+            CREATE TABLE chat_texts (channel_id integer NOT NULL, stream_id integer NOT NULL,
+            text_id integer, messages integer, PRIMARY KEY (channel_id, stream_id, text_id)) WITHOUT ROWID;
+
+            CREATE INDEX chat_texts_repeated ON chat_texts (channel_id, stream_id, messages) WHERE messages > 1;
+            CREATE INDEX chat_texts_text ON chat_texts (text_id);
+
+            INSERT INTO chat_texts SELECT channel_id, stream_id, text_id, COUNT(*) FROM chat_rows
+            GROUP BY channel_id, stream_id, text_id;
+
+            CREATE VIEW if not exists chat_log AS SELECT channel_id, stream_id, text, user, chat_time, offset
+            FROM chat_rows LEFT JOIN messages USING (text_id) LEFT JOIN users USING (user_id);
+
+            CREATE TRIGGER if not exists chat_log_insert INSTEAD OF INSERT ON chat_log BEGIN
+                INSERT OR IGNORE INTO users (user) SELECT NEW.user WHERE NEW.user IS NOT NULL;
+                INSERT OR IGNORE INTO messages (text) SELECT NEW.text WHERE NEW.text IS NOT NULL;
+                INSERT INTO chat_rows VALUES (NEW.channel_id, NEW.stream_id, (SELECT text_id FROM messages WHERE text = NEW.text),
+                (SELECT user_id FROM users WHERE user = NEW.user), NEW.chat_time, NEW.offset);
+            END;
+
+            CREATE TRIGGER if not exists chat_log_delete INSTEAD OF DELETE ON chat_log BEGIN
+                DELETE FROM chat_rows WHERE rowid = (SELECT rowid FROM chat_rows WHERE channel_id = OLD.channel_id
+                AND stream_id = OLD.stream_id AND text_id IS (SELECT text_id FROM messages WHERE text = OLD.text)
+                AND user_id IS (SELECT user_id FROM users WHERE user = OLD.user) AND chat_time IS OLD.chat_time
+                AND offset IS OLD.offset LIMIT 1);
+            END;
+
+            CREATE VIRTUAL TABLE if not exists chat_search USING fts5(text, content='messages', content_rowid='text_id');
+
+            INSERT INTO chat_search (chat_search) VALUES ('rebuild');
+
+            CREATE TRIGGER if not exists messages_search AFTER INSERT ON messages BEGIN
+                INSERT INTO chat_search (rowid, text) VALUES (NEW.text_id, NEW.text);
+            END;
+        ''',
+    ]
+
     # SINGLETON PATTERN
     __instance = None
     def __init__(self, database_name):
@@ -10,13 +197,16 @@ class DbHandler():
         if DbHandler.__instance == None:
             self.database_name = database_name
             self.logger = settings.db_logger
+            # every thread keeps its own long lived connection
+            self.__local = threading.local()
+            self.set_sqlite_profile(settings.SQLITE_PROFILE)
 
             try:
                 # set up twitch database
                 self.set_up_twitch_db()
-                self.logger.info('Database ({}) set up complete'.format(self.database_name))
+                self.logger.info('Database (%s) set up complete', self.database_name)
             except sqlite3.DatabaseError as e:# pragma: no cover
-                self.logger.error('Database ({}) set up failed.\n\tError: {}'.format(self.database_name, e))
+                self.logger.error('Database (%s) set up failed.\n\tError: %s', self.database_name, e)
 
             DbHandler.__instance = self
         else:
@@ -41,8 +231,6 @@ class DbHandler():
             CREATE TABLE if not exists channels
             (channel_id integer primary key, channel_name text);
 
-            PRAGMA foreign_keys = ON;
-
             CREATE TABLE if not exists top_spam (channel_id integer NOT NULL,
             stream_id integer NOT NULL, spam_text string, spam_occurrences integer, spam_user_count integer, FOREIGN KEY(channel_id) REFERENCES channels(channel_id));
 
@@ -57,10 +245,36 @@ class DbHandler():
         if not self.__commit(connection):
             raise sqlite3.DatabaseError("Could not commit to database")# pragma: no cover
 
-        self.__close_connection(connection)
+        self.__migrate(cursor)
+
+
+    # Returns the schema version of the database, the number of migrations applied to it
+    def get_schema_version(self):
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if not connection:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        return self.__get_cursor(connection).execute('PRAGMA user_version').fetchone()[0]
+
+
+    # Upgrades the database in place by applying the migrations it is missing, each one in its own transaction
+    def __migrate(self, cursor):
+        version = self.get_schema_version()
+
+        for new_version, migration in enumerate(self.SCHEMA_MIGRATIONS[version:], version + 1):
+            migration_query = 'BEGIN; ' + migration + '; PRAGMA user_version = {}; COMMIT;'.format(new_version)
+
+            if not self.__execute_multiple_query(cursor, migration_query):
+                cursor.execute('ROLLBACK')# pragma: no cover
+                raise sqlite3.DatabaseError("Could not migrate database to version {}".format(new_version))# pragma: no cover
+
+            self.logger.info('Database (%s) migrated to schema version %s', self.database_name, new_version)
 
 
     # Insert list of values into table table_name
+    @Stats.timed('sql.insert')
     def insert_values(self, table_name, values):
 
         connection = self.__open_connection()
@@ -72,24 +286,23 @@ class DbHandler():
             raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
 
         # Generate query with correct number of arguments
-        query = "INSERT INTO " + table_name + " VALUES("
-        for index in range(len(values)):
-            query += '?,'
-        query = query[:-1]
-        query += ')'
+        query = QueryBuilder.insert(table_name, len(values))
 
         if not self.__execute_query_values(cursor, query, values):
+            self.__rollback(connection)
             raise sqlite3.DatabaseError("Could not insert to database")
 
         if not self.__commit(connection):
             raise sqlite3.DatabaseError("Could not commit to database")# pragma: no cover
 
-        self.__close_connection(connection)
-        self.logger.info('Database ({}) insert to {} complete'.format(self.database_name, table_name))
+        Stats.count('rows_inserted')
+        self.logger.debug('Database (%s) insert to %s complete', self.database_name, table_name)
 
 
     # values must be a list of (list of insert values)
+    # Rows are inserted in chunks with executemany, only a chunk that fails is retried row by row
     # Raises error on failures that do not affect insert, returns number of failures
+    @Stats.timed('sql.insert')
     def insert_multiple_values(self, table_name, values):
 
         connection = self.__open_connection()
@@ -100,62 +313,163 @@ class DbHandler():
         else:
             raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
 
-        not_inserted = 0
-        for value in values:
-            # Generate query with correct number of arguments
-            query = "INSERT INTO " + table_name + " VALUES("
+        # Chunks are undone through savepoints, which must be nested in a transaction to not commit on release
+        if not connection.in_transaction:
+            connection.execute('BEGIN')
 
-            # Construct the rest of the query
-            for index in range(len(value)):
-                query += '?,'
-            query = query[:-1]
-            query += ')'
-
-            # If couldn't be added to database, count and move to next
-            if not self.__execute_query_values(cursor, query, value):
-                not_inserted += 1
+        not_inserted = 0
+        for start in range(0, len(values), settings.INSERT_CHUNK_SIZE):
+            not_inserted += self.__insert_chunk(cursor, table_name, values[start:start + settings.INSERT_CHUNK_SIZE])
 
         if not self.__commit(connection):
             raise sqlite3.DatabaseError("Could not commit to database")# pragma: no cover
 
-        self.__close_connection(connection)
-
+        Stats.count('rows_inserted', len(values) - not_inserted)
         if not_inserted > 0:
-            self.logger.info('Database ({}) inserted {} values into {} but failed \
-            to insert {} values'.format(self.database_name, len(values) - not_inserted, table_name, not_inserted))
+            self.logger.info('Database (%s) inserted %s values into %s but failed to insert %s values', \
+                self.database_name, len(values) - not_inserted, table_name, not_inserted)
+        else:
+            self.logger.debug('Database (%s) insert %s values to %s complete', self.database_name, len(values), table_name)
+
+        return not_inserted
+
+
+    # values must be a list of (list of insert values). A row whose key_columns match an existing
+    # row is not inserted, instead add_columns of the existing row are incremented by its values
+    # and replace_columns are set to its values (the row is left unchanged if there are neither).
+    # key_columns must be a primary key or unique index of the table. Raises error if any row can not be written
+    @Stats.timed('sql.upsert')
+    def upsert_multiple_values(self, table_name, values, key_columns, add_columns=[], replace_columns=[]):
+
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if connection:
+            cursor = self.__get_cursor(connection)
+        else:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        if not values:
+            return
+
+        query = QueryBuilder.upsert(table_name, len(values[0]), tuple(key_columns), tuple(add_columns), \
+            tuple(replace_columns))
+
+        with self.transaction():
+            for start in range(0, len(values), settings.INSERT_CHUNK_SIZE):
+                cursor.executemany(query, values[start:start + settings.INSERT_CHUNK_SIZE])
+
+        Stats.count('rows_upserted', len(values))
+        self.logger.debug('Database (%s) upsert %s values to %s complete', self.database_name, len(values), table_name)
+
+
+    # Returns {value: id} for every one of values in the dictionary table_name, a table of unique value_column
+    # values identified by the integer primary key id_column. The values missing from it are inserted first.
+    # Raises error if the values can not be written
+    @Stats.timed('sql.dictionary')
+    def insert_dictionary_values(self, table_name, id_column, value_column, values):
+
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if connection:
+            cursor = self.__get_cursor(connection)
         else:
-            self.logger.info('Database ({}) insert {} values to {} complete'.format(self.database_name, len(values), table_name))
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        ids = {}
+        if not values:
+            return ids
+
+        # the ids of new values are returned by the insert, only the other values are selected
+        insert_query = 'INSERT OR IGNORE INTO {0} ({2}) SELECT value FROM json_each(?) RETURNING {2}, {1}'.format(table_name, \
+            id_column, value_column)
+        select_query = 'SELECT {2}, {1} FROM {0} WHERE {2} IN (SELECT value FROM json_each(?))'.format(table_name, \
+            id_column, value_column)
+
+        # the values of a chunk are bound as a single json array
+        values = list(values)
+        with self.transaction():
+            for start in range(0, len(values), settings.INSERT_CHUNK_SIZE):
+                chunk = values[start:start + settings.INSERT_CHUNK_SIZE]
+                new_ids = cursor.execute(insert_query, (json.dumps(chunk),)).fetchall()
+                ids.update(new_ids)
+                Stats.count('rows_inserted', len(new_ids))
+                if len(new_ids) < len(chunk):
+                    chunk = [value for value in chunk if value not in ids]
+                    ids.update(cursor.execute(select_query, (json.dumps(chunk),)).fetchall())
+
+        self.logger.debug('Database (%s) %s ids of %s values read', self.database_name, table_name, len(values))
+        return ids
+
+
+    # Inserts into table_name the rows selected from source_table, columns being in the column order of
+    # table_name. Conditions are in the select_from_database format.
+    # Returns the number of inserted rows, raises error if the rows can not be written
+    @Stats.timed('sql.insert_from_select')
+    def insert_from_select(self, table_name, source_table, columns, conditions=[], and_or='AND', group_by=''):
+
+        # Set and_or to default if correct options not provided
+        if and_or != 'AND' and and_or != 'OR':
+            and_or = 'AND'
+
+        query, parameters, invalid_condition_count = QueryBuilder.select(source_table, columns, conditions, \
+            and_or, '', '', group_by)
+
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if connection:
+            cursor = self.__get_cursor(connection)
+        else:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        with self.transaction():
+            cursor.execute('INSERT INTO ' + table_name + ' ' + query, parameters)
+
+        Stats.count('rows_inserted', cursor.rowcount)
+        self.logger.debug('Database (%s) insert %s values from %s to %s complete', self.database_name, \
+            cursor.rowcount, source_table, table_name)
+        return cursor.rowcount
+
+
+    # Inserts a chunk of rows with a single executemany. If the chunk fails it is rolled back
+    # and every row is inserted on its own so only the failing rows are lost.
+    # returns number of rows that could not be inserted
+    def __insert_chunk(self, cursor, table_name, chunk):
+        cursor.execute('SAVEPOINT insert_chunk')
+        try:
+            cursor.executemany(QueryBuilder.insert(table_name, len(chunk[0])), chunk)
+            cursor.execute('RELEASE insert_chunk')
+            return 0
+        except sqlite3.DatabaseError as e:
+            cursor.execute('ROLLBACK TO insert_chunk')
+            cursor.execute('RELEASE insert_chunk')
+            self.logger.info('Database (%s) bulk insert to %s failed, inserting rows one by one.\n\tError: %s', \
+                self.database_name, table_name, e)
+
+        not_inserted = 0
+        for value in chunk:
+            # If couldn't be added to database, count and move to next
+            if not self.__execute_query_values(cursor, QueryBuilder.insert(table_name, len(value)), value):
+                not_inserted += 1
 
         return not_inserted
 
 
+    @Stats.timed('sql.delete')
     def delete_from_database(self, table_name, conditions=[], and_or='AND'):
         # Set and_or to default if correct options not provided
         if and_or != 'AND' or and_or != 'OR':
             and_or = 'AND'
 
-        query = 'DELETE FROM ' + table_name + ' WHERE '
-
         if conditions == []:
             raise sqlite3.DatabaseError("Invalid syntax: conditions must be provided")
 
-        invalid_condition_count = 0
-        for index, condition in enumerate(conditions):
-            # Check that condition is in valid format
-            if not isinstance(condition, str) or len(condition.split(' ')) != 3:
-                invalid_condition_count += 1
-                continue
-            else:
-                condition_str = self.__condition_to_sql_str(condition)
-
-                # Check if more conditions
-                if index < len(conditions) - 1:
-                    condition_str += ' ' + and_or + ' '
-
-                query += condition_str
+        query, parameters, invalid_condition_count = QueryBuilder.delete(table_name, conditions, and_or)
 
         # Check if no conditions got added
-        if conditions != [] and invalid_condition_count == len(conditions):
+        if invalid_condition_count == len(conditions):
             raise sqlite3.DatabaseError("Invalid syntax: valid conditions must be provided")
 
         # Connect to database
@@ -167,80 +481,141 @@ class DbHandler():
         else:
             raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
 
-        self.__execute_select_query(cursor, query)
+        results = self.__execute_select_query(cursor, query, parameters)
+        if results:
+            Stats.count('rows_deleted', results.rowcount)
 
         if not self.__commit(connection):
             raise sqlite3.DatabaseError("Could not commit to database")# pragma: no cover
 
-        self.__close_connection(connection)
-
         return invalid_condition_count
 
 
-    # Query the database and return result as a list of dicts{column<key>: value<value>}
-    # where each dict is a row in the database
+    # Query the database and return result as a list of Row{column<key>: value<value>}
+    # where each Row is a row in the database
     #
     # Parameters:
     # table_name<str>: name of the table to query
     # columns<list of str>: name of columns to be returned; '*' for all columns
     # conditions<list of str>: list of conditions in string representation for the query
     #  -> string in condition must be in the following format:
-    #     "COLUMN_NAME [ eq | gt | lt| gteq | lteq | like ] VLAUE"
+    #     "COLUMN_NAME [ eq | gt | lt| gteq | lteq | like | match ] VLAUE"
+    #  -> VALUE may contain spaces and is passed to SQLite as a bound parameter, conditions
+    #     in any other format are ignored. match takes a full text query, COLUMN_NAME being the search table.
+    #     COLUMN_NAME may name its table, e.g. chat_texts.stream_id, for a column of a join
+    # limit<int>: maximum number of rows returned, every row if None
+    @Stats.timed('sql.select')
     def select_from_database(self, table_name, columns=['*'], conditions=[], and_or='AND', \
-        order_by='', ASC_DESC='', group_by=''):
+        order_by='', ASC_DESC='', group_by='', limit=None):
 
         # Set and_or to default if correct options not provided
         if and_or != 'AND' and and_or != 'OR':
             and_or = 'AND'
 
-        query = 'SELECT '
+        if '*' in columns and len(columns) != 1:
+            raise sqlite3.DatabaseError("Invalid syntax: catch all with multiple columns")
 
-        for column_name in columns:
-            if column_name == '*' and len(columns) != 1:
-                raise sqlite3.DatabaseError("Invalid syntax: catch all with multiple columns")
-            query += column_name + ','
-        # remove last ',' from query
-        query = query[:-1]
+        query, parameters, invalid_condition_count = QueryBuilder.select(table_name, columns, conditions, \
+            and_or, order_by, ASC_DESC, group_by, limit)
 
-        query += ' FROM ' + table_name
+        # Connect to database
+        connection = self.__open_connection()
 
-        if conditions != []:
-            WHERE_STATEMENT = ' WHERE '
-            query += WHERE_STATEMENT
+        # Check that connection is made
+        if connection:
+            cursor = self.__get_cursor(connection)
+        else:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
 
-        invalid_condition_count = 0
-        for index, condition in enumerate(conditions):
-            # Check that condition is in valid format
-            if not isinstance(condition, str) or len(condition.split(' ')) != 3:
-                invalid_condition_count += 1
-                # Remove and_or if at end of query
-                if query[len(query) - len(and_or) - 2:] == (' ' + and_or + ' '):
-                    # +2 for empty space around AND_OR
-                    query = query[:len(query)-(len(and_or) + 2)]
-                continue
-            else:
-                condition_str = self.__condition_to_sql_str(condition)
+        results = self.__execute_select_query(cursor, query, parameters)
 
+        if not results:
+            raise sqlite3.DatabaseError("Could not query the database")
 
-                # Check if more conditions
-                if index < len(conditions) - 1:
-                    condition_str += ' ' + and_or + ' '
+        # Rows are built by sqlite3 itself, see Row
+        list_of_rows = results.fetchall()
+        Stats.count('rows_selected', len(list_of_rows))
+        return list_of_rows
 
-                query += condition_str
 
+    # Same as select_from_database but yields the rows one at a time, reading them from a single
+    # cursor page_size rows at a time so memory stays constant whatever the number of rows
+    def iter_select_from_database(self, table_name, columns=['*'], conditions=[], and_or='AND', \
+        order_by='', ASC_DESC='', group_by='', page_size=settings.SELECT_PAGE_SIZE):
 
-        # Check if no conditions got added
-        if conditions != [] and invalid_condition_count == len(conditions):
-            # remove WHERE statement
-            query = query[:len(query)-len(WHERE_STATEMENT)]
+        # Set and_or to default if correct options not provided
+        if and_or != 'AND' and and_or != 'OR':
+            and_or = 'AND'
 
-        # Only group results if group by column(s) provided in form of string
-        if group_by != '' and isinstance(group_by, str):
-            query += ' GROUP BY ' + group_by
+        if '*' in columns and len(columns) != 1:
+            raise sqlite3.DatabaseError("Invalid syntax: catch all with multiple columns")
 
-        # Only order results if order by column(s) provided in form of string
-        if order_by != '' and isinstance(order_by, str):
-            query += ' ORDER BY ' + order_by + ' ' + ASC_DESC
+        query, parameters, invalid_condition_count = QueryBuilder.select(table_name, columns, conditions, \
+            and_or, order_by, ASC_DESC, group_by)
+
+        # Connect to database, the cursor is private to this iterator
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if connection:
+            cursor = self.__get_cursor(connection)
+        else:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        for page in self.__fetch_pages(cursor, query, parameters, page_size):
+            yield from page
+
+
+    # Same as iter_select_from_database but yields a page of page_size rows at a time as a tuple
+    # of columns, e.g. (offsets, users), to load columns in bulk into arrays. The rows are plain
+    # tuples transposed by zip, no Row is built for them
+    def iter_select_columns(self, table_name, columns, conditions=[], and_or='AND', \
+        order_by='', ASC_DESC='', page_size=settings.SELECT_PAGE_SIZE):
+
+        # Set and_or to default if correct options not provided
+        if and_or != 'AND' and and_or != 'OR':
+            and_or = 'AND'
+
+        if '*' in columns:
+            raise sqlite3.DatabaseError("Invalid syntax: columns must be named")
+
+        query, parameters, invalid_condition_count = QueryBuilder.select(table_name, columns, conditions, \
+            and_or, order_by, ASC_DESC)
+
+        # Connect to database, the cursor is private to this iterator
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if connection:
+            cursor = self.__get_cursor(connection)
+            cursor.row_factory = None
+        else:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        for page in self.__fetch_pages(cursor, query, parameters, page_size):
+            yield tuple(zip(*page))
+
+
+    # Returns (rows<list of Row>, next_key<tuple>) with the page_size rows ordered by key_columns that
+    # come after after_key, using keyset pagination so any page is as fast as the first one.
+    # key_columns must identify a row (e.g. ['rowid']) and should be covered by an index, they are
+    # added at the end of the selected columns. A key holding NULL raises sqlite3.DatabaseError, as views
+    # such as chat_log have no rowid, page them on columns of their own.
+    # next_key is passed as after_key to get the next page, it is None after the last page.
+    @Stats.timed('sql.select')
+    def select_page(self, table_name, columns=['*'], conditions=[], and_or='AND', key_columns=['rowid'], \
+        after_key=None, page_size=settings.SELECT_PAGE_SIZE):
+
+        # Set and_or to default if correct options not provided
+        if and_or != 'AND' and and_or != 'OR':
+            and_or = 'AND'
+
+        if '*' in columns and len(columns) != 1:
+            raise sqlite3.DatabaseError("Invalid syntax: catch all with multiple columns")
+
+        query, parameters, invalid_condition_count = QueryBuilder.page(table_name, columns + key_columns, conditions, \
+            and_or, key_columns, after_key is not None)
+        parameters += tuple(after_key or ()) + (page_size,)
 
         # Connect to database
         connection = self.__open_connection()
@@ -251,63 +626,177 @@ class DbHandler():
         else:
             raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
 
-        results = self.__execute_select_query(cursor, query)
+        results = self.__execute_select_query(cursor, query, parameters)
 
         if not results:
             raise sqlite3.DatabaseError("Could not query the database")
 
-        # Get names of columns selected
-        column_names = [name[0] for name in cursor.description]
+        list_of_rows = results.fetchall()
+        Stats.count('rows_selected', len(list_of_rows))
 
-        list_of_rows = []
-        for row in results:
-            row_dict = {}
-            # Get required column values and add it to dict for results
-            for index, name, in enumerate(column_names):
-                row_dict[name] = row[index]
-            list_of_rows.append(row_dict)
+        # NULL keys compare to nothing, the next page would be empty
+        if list_of_rows and None in tuple(list_of_rows[-1][-len(key_columns):]):
+            raise sqlite3.DatabaseError("Key columns %s of %s hold NULL" % (', '.join(key_columns), table_name))
 
-        self.__close_connection(connection)
+        # A short page is the last one, otherwise the next one starts after the key of the last row
+        next_key = None
+        if len(list_of_rows) == page_size:
+            next_key = tuple(list_of_rows[-1][-len(key_columns):])
 
+        return list_of_rows, next_key
+
+
+    # Returns the rows of table_name whose value_column is one of values, in a single query whatever the number
+    # of values: they are bound as one json array, each one looked up by the index of value_column (CROSS JOIN
+    # keeps json_each first, SQLite would otherwise go through json_each for every row of the table). Every row
+    # starts with the value it was found by as "value", the one stored may read back under another type
+    # (e.g. "123" as 123 in a column of numeric affinity). Conditions are in the select_from_database format
+    @Stats.timed('sql.select')
+    def select_by_values(self, table_name, value_column, values, columns, conditions=[], and_or='AND'):
+
+        # Set and_or to default if correct options not provided
+        if and_or != 'AND' and and_or != 'OR':
+            and_or = 'AND'
+
+        where_clause, parameters, invalid_condition_count = QueryBuilder.where(conditions, and_or)
+        query = 'SELECT json_each.value AS value,' + ','.join(columns) + ' FROM json_each(?) CROSS JOIN ' + table_name + \
+            ' ON ' + table_name + '.' + value_column + ' = json_each.value' + where_clause
+
+        # Connect to database
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if connection:
+            cursor = self.__get_cursor(connection)
+        else:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        results = self.__execute_select_query(cursor, query, (json.dumps(list(values)),) + parameters)
+
+        if not results:
+            raise sqlite3.DatabaseError("Could not query the database")
+
+        list_of_rows = results.fetchall()
+        Stats.count('rows_selected', len(list_of_rows))
         return list_of_rows
 
 
-    # take condition string with user provided condition and convert to sql
-    def __condition_to_sql_str(self, condition):
+    # Groups every write made inside the block into a single commit, rolling all of them back if
+    # the block raises. Transactions can be nested, only the outermost one commits.
+    #
+    # with db_handler.transaction():
+    #     db_handler.insert_values(...)
+    #     db_handler.insert_values(...)
+    @contextmanager
+    def transaction(self):
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if not connection:
+            raise sqlite3.DatabaseError("Could not connect to database")
+
+        if self.__local.transaction_depth == 0 and not connection.in_transaction:
+            connection.execute('BEGIN')
+        self.__local.transaction_depth += 1
+
+        try:
+            yield
+        except BaseException:
+            self.__local.transaction_depth -= 1
+            if self.__local.transaction_depth == 0:
+                self.__rollback(connection)
+            raise
+
+        self.__local.transaction_depth -= 1
+        if self.__local.transaction_depth == 0 and not self.__commit(connection):
+            raise sqlite3.DatabaseError("Could not commit to database")# pragma: no cover
+
+
+    # Calls callback once the changes made so far by the calling thread are committed, right away outside of a
+    # transaction. If the transaction rolls back callback is dropped and rollback_callback, when given, is called
+    # instead, so state derived from its changes, such as ids read in it, is only kept once they are in the database
+    def after_commit(self, callback, rollback_callback=None):
+        connection = self.__open_connection()
+        if connection is None or not connection.in_transaction:
+            callback()
+            return
+
+        self.__local.commit_callbacks.append((callback, rollback_callback))
+
 
-        [column, operator, value] = condition.split(' ')
+    # Selects the settings.SQLITE_PROFILES profile applied to every connection,
+    # the connection of the calling thread is updated right away
+    def set_sqlite_profile(self, profile_name):
+        if profile_name not in settings.SQLITE_PROFILES:
+            raise ValueError("Unknown SQLite profile ({})".format(profile_name))
+
+        self.sqlite_profile = profile_name
+        connection = getattr(self.__local, 'connection', None)
+        if connection:
+            self.__apply_sqlite_profile(connection)
+
+
+    # Returns the current value of every pragma of the SQLite profile on the calling thread's connection
+    def get_sqlite_settings(self):
+        connection = self.__open_connection()
+
+        # Check that connection is made
+        if not connection:
+            raise sqlite3.DatabaseError("Could not connect to database")# pragma: no cover
+
+        return {pragma: connection.execute('PRAGMA ' + pragma).fetchone()[0] \
+            for pragma in settings.SQLITE_PROFILES[self.sqlite_profile]}
 
-        condition_str = column
-        # Put condition into correct sql syntax
-        if operator == "eq":
-            condition_str += " = " + value
-        elif operator == "gt":
-            condition_str += " > " + value
-        elif operator == "lt":
-            condition_str += " < " + value
-        elif operator == "gteq":
-            condition_str += " >= " + value
-        elif operator == "lteq":
-            condition_str += " <= " + value
-        elif operator == "like":
-            condition_str += " like " + value
 
-        return condition_str
+    # Closes the connection of the calling thread, the next call opens a new one. A transaction left open is rolled back
+    def close(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection:
+            self.__close_connection(connection)
+        self.__local.connection = None
+        self.__local.transaction_depth = 0
+        callbacks = getattr(self.__local, 'commit_callbacks', [])
+        self.__local.commit_callbacks = []
+        for callback, rollback_callback in callbacks:
+            if rollback_callback is not None:
+                rollback_callback()
 
 
-    # Opens connection to databse
+    # Returns the connection of the calling thread, opening it on first use or if the database changed
     # returns connection on success or None on failure
     def __open_connection(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection and self.__local.connection_database == self.database_name:
+            return connection
+
+        # Database name changed, drop the connection to the old one
+        if connection:
+            self.close()
+
         try:
-            connection = sqlite3.connect(self.database_name)
-            self.logger.info('Database ({}) connection opened'.format(self.database_name))
+            connection = sqlite3.connect(self.database_name, cached_statements=settings.SQLITE_STATEMENT_CACHE_SIZE)
+            connection.row_factory = Row
+            # approximate COUNT(DISTINCT value) in bounded memory, see HyperLogLog
+            connection.create_aggregate('approx_count_distinct', 1, ApproxCountDistinct)
+            self.__apply_sqlite_profile(connection)
+            self.__local.connection = connection
+            self.__local.connection_database = self.database_name
+            self.__local.transaction_depth = 0
+            self.__local.commit_callbacks = []
+            self.logger.debug('Database (%s) connection opened', self.database_name)
             return connection
         except TypeError as e:
             # log Error
-            self.logger.error('Database ({}) connection open failed'.format(self.database_name))
+            self.logger.error('Database (%s) connection open failed', self.database_name)
             return None
 
 
+    def __apply_sqlite_profile(self, connection):
+        for pragma, value in settings.SQLITE_PROFILES[self.sqlite_profile].items():
+            connection.execute('PRAGMA {} = {}'.format(pragma, value))
+        self.logger.debug('Database (%s) using SQLite profile %s', self.database_name, self.sqlite_profile)
+
+
     def __close_connection(self, connection):
         connection.close()
 
@@ -316,14 +805,39 @@ class DbHandler():
         return connection.cursor()
 
 
-    def __execute_select_query(self, cursor, query):
+    # Executes a select and yields its rows page_size at a time. The execution and the fetching of every
+    # page, not the time the caller takes between pages, are timed as a single sql.select
+    def __fetch_pages(self, cursor, query, parameters, page_size):
+        start = time.perf_counter()
+        results = self.__execute_select_query(cursor, query, parameters)
+
+        if not results:
+            raise sqlite3.DatabaseError("Could not query the database")
+
+        row_count = 0
+        seconds = 0.0
+        try:
+            page = results.fetchmany(page_size)
+            while page:
+                seconds += time.perf_counter() - start
+                row_count += len(page)
+                yield page
+                start = time.perf_counter()
+                page = results.fetchmany(page_size)
+            seconds += time.perf_counter() - start
+        finally:
+            Stats.add_time('sql.select', seconds)
+            Stats.count('rows_selected', row_count)
+
+
+    def __execute_select_query(self, cursor, query, parameters=()):
         try:
-            result = cursor.execute(query)
-            self.logger.info('Database ({}) executed select command successfully'.format(self.database_name))
+            result = cursor.execute(query, parameters)
+            self.logger.debug('Database (%s) executed select command successfully', self.database_name)
             return result
         except sqlite3.DatabaseError as e:
             # log Error
-            self.logger.error('Database ({}) select execution failed.\n\tError: {}'.format(self.database_name, e))
+            self.logger.error('Database (%s) select execution failed.\n\tError: %s', self.database_name, e)
             return None
 
 
@@ -335,7 +849,7 @@ class DbHandler():
             return True
         except sqlite3.DatabaseError as e:
             # log Error
-            self.logger.error('Database ({}) execution failed.\n\tError: {}'.format(self.database_name, e))
+            self.logger.error('Database (%s) execution failed.\n\tError: %s', self.database_name, e)
             return False
 
 
@@ -344,21 +858,176 @@ class DbHandler():
     def __execute_multiple_query(self, cursor, query):
         try:
             cursor.executescript(query)
-            self.logger.info('Database ({}) executed command successfully'.format(self.database_name))
+            self.logger.debug('Database (%s) executed command successfully', self.database_name)
             return True
         except sqlite3.DatabaseError as e:# pragma: no cover
             # log Error
-            self.logger.error('Database ({}) execution failed.\n\tError: {}'.format(self.database_name, e))
+            self.logger.error('Database (%s) execution failed.\n\tError: %s', self.database_name, e)
             return False
 
 
-    # Commit any changes to database provided connection
+    # Commit any changes to database provided connection, deferred while inside a transaction
     # returns Boolean: True on success, False on failure
     def __commit(self, connection):
+        if self.__local.transaction_depth > 0:
+            return True
         try:
+            start = time.perf_counter()
             connection.commit()
-            self.logger.info('Database ({}) committed successfully'.format(self.database_name))
+            Stats.add_time('sql.commit', time.perf_counter() - start)
+            self.logger.debug('Database (%s) committed successfully', self.database_name)
+            self.__run_commit_callbacks()
             return True
         except sqlite3.DatabaseError as e:# pragma: no cover
-            self.logger.error('Database ({}) commit failed.\n\tError: {}'.format(self.database_name, e))
+            self.logger.error('Database (%s) commit failed.\n\tError: %s', self.database_name, e)
             return False
+
+
+    # Discard uncommitted changes so a failed statement does not keep the database locked,
+    # left to the outermost transaction when inside one
+    def __rollback(self, connection):
+        if self.__local.transaction_depth > 0:
+            return
+        callbacks = self.__local.commit_callbacks
+        self.__local.commit_callbacks = []
+        try:
+            connection.rollback()
+        except sqlite3.DatabaseError as e:# pragma: no cover
+            self.logger.error('Database (%s) rollback failed.\n\tError: %s', self.database_name, e)
+        for callback, rollback_callback in callbacks:
+            if rollback_callback is not None:
+                rollback_callback()
+
+
+    def __run_commit_callbacks(self):
+        callbacks = self.__local.commit_callbacks
+        self.__local.commit_callbacks = []
+        for callback, rollback_callback in callbacks:
+            callback()
+
+
+# Builds parameterized SQL from the condition strings accepted by DbHandler.
+# Values are never written into the statement, they are returned as bind parameters, so every
+# query with the same shape has the same text and reuses SQLite's prepared statement for it.
+class QueryBuilder():
+
+    OPERATORS = {'eq': '=', 'gt': '>', 'lt': '<', 'gteq': '>=', 'lteq': '<=', 'like': 'like', 'match': 'MATCH'}
+    COLUMN_NAME = re.compile(r'([A-Za-z_][A-Za-z0-9_]*\.)?[A-Za-z_][A-Za-z0-9_]*$')
+
+    # Splits "COLUMN_NAME OPERATOR VALUE" into (column_name, sql operator, value), VALUE may contain
+    # spaces and is unquoted if given as an sql string literal. Returns None for invalid conditions
+    @staticmethod
+    def parse_condition(condition):
+        if not isinstance(condition, str):
+            return None
+
+        parts = condition.split(' ', 2)
+        if len(parts) != 3 or parts[1] not in QueryBuilder.OPERATORS or \
+            not QueryBuilder.COLUMN_NAME.match(parts[0]) or parts[2] == '':
+            return None
+
+        [column, operator, value] = parts
+        if len(value) > 1 and value[0] == "'" and value[-1] == "'":
+            value = value[1:-1].replace("''", "'")
+
+        return column, QueryBuilder.OPERATORS[operator], value
+
+    # Returns (where_clause<str>, parameters<tuple>, invalid_condition_count<int>) for the valid
+    # conditions joined by and_or, where_clause is empty if there are none
+    @staticmethod
+    def where(conditions, and_or='AND'):
+        shape, parameters, invalid_condition_count = QueryBuilder.__parse_conditions(conditions)
+        return QueryBuilder.__where_clause(shape, and_or), parameters, invalid_condition_count
+
+    # Returns (query<str>, parameters<tuple>, invalid_condition_count<int>)
+    @staticmethod
+    def select(table_name, columns=['*'], conditions=[], and_or='AND', order_by='', ASC_DESC='', group_by='', limit=None):
+        where_clause, parameters, invalid_condition_count = QueryBuilder.where(conditions, and_or)
+        query = 'SELECT ' + ','.join(columns) + ' FROM ' + table_name + where_clause
+
+        # Only group results if group by column(s) provided in form of string
+        if group_by != '' and isinstance(group_by, str):
+            query += ' GROUP BY ' + group_by
+
+        # Only order results if order by column(s) provided in form of string
+        if order_by != '' and isinstance(order_by, str):
+            query += ' ORDER BY ' + order_by + ' ' + ASC_DESC
+
+        if limit is not None:
+            query += ' LIMIT ?'
+            parameters += (limit,)
+
+        return query, parameters, invalid_condition_count
+
+    # Returns (query<str>, parameters<tuple>, invalid_condition_count<int>)
+    @staticmethod
+    def delete(table_name, conditions, and_or='AND'):
+        where_clause, parameters, invalid_condition_count = QueryBuilder.where(conditions, and_or)
+        return 'DELETE FROM ' + table_name + where_clause, parameters, invalid_condition_count
+
+    # Returns (query<str>, parameters<tuple>, invalid_condition_count<int>) selecting the page of rows
+    # ordered by key_columns. With after_key the page starts after a key whose values must be bound
+    # after the returned parameters, followed by the page size
+    @staticmethod
+    def page(table_name, columns, conditions, and_or, key_columns, after_key=False):
+        shape, parameters, invalid_condition_count = QueryBuilder.__parse_conditions(conditions)
+        return QueryBuilder.__page_query(table_name, tuple(columns), shape, and_or, tuple(key_columns), \
+            after_key), parameters, invalid_condition_count
+
+    # Generate insert query with correct number of arguments
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def insert(table_name, column_count):
+        return "INSERT INTO " + table_name + " VALUES(" + ",".join(["?"] * column_count) + ")"
+
+    # Generate an insert query that updates the row with the same key_columns instead, adding the
+    # inserted values to add_columns and replacing replace_columns, or doing nothing if there are neither
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def upsert(table_name, column_count, key_columns, add_columns=(), replace_columns=()):
+        updates = [column + ' = ' + column + ' + excluded.' + column for column in add_columns] + \
+            [column + ' = excluded.' + column for column in replace_columns]
+        action = 'DO UPDATE SET ' + ','.join(updates) if updates else 'DO NOTHING'
+        return QueryBuilder.insert(table_name, column_count) + ' ON CONFLICT (' + ','.join(key_columns) + ') ' + action
+
+    # Returns "COLUMN_NAME OPERATOR VALUE" with VALUE quoted, so it is read back as is by parse_condition
+    @staticmethod
+    def condition(column, operator, value):
+        return column + ' ' + operator + " '" + str(value).replace("'", "''") + "'"
+
+    # Returns (shape<tuple>, parameters<tuple>, invalid_condition_count<int>) where shape holds the
+    # (column, sql operator) of every valid condition
+    @staticmethod
+    def __parse_conditions(conditions):
+        shape = []
+        parameters = []
+        invalid_condition_count = 0
+        for condition in conditions:
+            parsed_condition = QueryBuilder.parse_condition(condition)
+            if parsed_condition is None:
+                invalid_condition_count += 1
+                continue
+            shape.append(parsed_condition[:2])
+            parameters.append(parsed_condition[2])
+
+        return tuple(shape), tuple(parameters), invalid_condition_count
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def __where_clause(shape, and_or):
+        if not shape:
+            return ''
+        return ' WHERE ' + (' ' + and_or + ' ').join([column + ' ' + operator + ' ?' for column, operator in shape])
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def __page_query(table_name, columns, shape, and_or, key_columns, after_key):
+        where_clause = QueryBuilder.__where_clause(shape, and_or)
+        if after_key:
+            # conditions are grouped so an OR between them does not swallow the key condition
+            key_condition = '(' + ','.join(key_columns) + ') > (' + ','.join(['?'] * len(key_columns)) + ')'
+            where_clause = ' WHERE (' + where_clause[len(' WHERE '):] + ') AND ' + key_condition if where_clause \
+                else ' WHERE ' + key_condition
+
+        return 'SELECT ' + ','.join(columns) + ' FROM ' + table_name + where_clause + \
+            ' ORDER BY ' + ','.join(key_columns) + ' LIMIT ?'
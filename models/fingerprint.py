@@ -0,0 +1,127 @@
+import re
+import zlib
+from array import array
+import settings
+
+REPEATED_CHARACTERS = re.compile(r'(.)\1{2,}')
+
+# value of a signature bin no shingle fell in, larger than any hashed value
+EMPTY_BIN = 0xffffffff
+
+
+# Returns the text a comment is compared by: case folded, runs of a character shortened to two,
+# whitespace collapsed and repeated words or groups of words kept once, so that
+# "KEKW  kekw KEKW" and "kekw", "LOOOOL" and "lool", or "Pog LUL Pog LUL" and "pog lul" are the same text
+def normalize(body):
+    words = REPEATED_CHARACTERS.sub(r'\1\1', body.casefold()).split()
+    words = [word for index, word in enumerate(words) if index == 0 or word != words[index - 1]]
+
+    # an emote wall repeats its shortest period
+    for period in range(1, len(words) // 2 + 1):
+        if all([words[index] == words[index % period] for index in range(period, len(words))]):
+            words = words[:period]
+            break
+
+    return ' '.join(words)
+
+
+# MinHash signature of the 3-grams of the utf-8 bytes of text with one permutation hashing: every
+# 3-gram is hashed once into one of `bins` bins, which keep the lowest value. Two signatures agree
+# on a bin with a probability equal to the Jaccard similarity of the 3-grams of their texts.
+# crc32 keeps signatures the same in every process, unlike hash()
+def signature(text, bins=settings.FINGERPRINT_BINS):
+    data = text.encode('utf-8')
+    shingles = set([data[index:index + 3] for index in range(len(data) - 2)]) or set([data])
+
+    minimums = array('I', [EMPTY_BIN] * bins)
+    for shingle in shingles:
+        # crc32 is mixed by a multiplicative hash so that every bin is as likely
+        hashed = (zlib.crc32(shingle) * 2654435761) & 0xffffffff
+        value = hashed // bins
+        if value < minimums[hashed % bins]:
+            minimums[hashed % bins] = value
+
+    return minimums
+
+
+# Estimated Jaccard similarity of the texts of two signatures, the fraction of equal bins among
+# the bins that are not empty in both
+def similarity(first, second):
+    equal = 0
+    both_empty = 0
+    for first_value, second_value in zip(first, second):
+        if first_value == second_value:
+            if first_value == EMPTY_BIN:
+                both_empty += 1
+            else:
+                equal += 1
+
+    if both_empty == len(first):
+        return 1.0
+    return equal / (len(first) - both_empty)
+
+
+# Groups comment bodies into clusters of near duplicates. Every distinct body is normalized and
+# hashed once, bodies with the same normalized text share a cluster, and a new text joins the
+# cluster of the first text whose signature shares a band (FINGERPRINT_BAND_ROWS consecutive bins)
+# with its own and is at least `similarity` similar. Only the first text of every cluster is
+# indexed, so texts are compared to it and clusters do not drift. With 16 bins in bands of 4, texts
+# 80% similar are found 88% of the time and 90% similar ones 99% of the time.
+# The work per comment is a dict lookup once its body was seen, so the cost stays linear.
+class SpamFingerprinter():
+
+    def __init__(self, min_similarity=settings.FINGERPRINT_SIMILARITY, bins=settings.FINGERPRINT_BINS, \
+        band_rows=settings.FINGERPRINT_BAND_ROWS):
+        if bins % band_rows:
+            raise ValueError("Fingerprint bins must be a multiple of the band rows")
+
+        self.min_similarity = min_similarity
+        self.bins = bins
+        self.band_rows = band_rows
+        # body: cluster id
+        self.clusters_by_body = {}
+        # normalized text: cluster id
+        self.clusters_by_text = {}
+        # band key: cluster id, for the first text of every cluster
+        self.bands = {}
+        # cluster id: signature of the first text of the cluster
+        self.signatures = []
+
+    # Returns the cluster id of body, ids are numbered from 0 in order of appearance
+    def cluster(self, body):
+        cluster_id = self.clusters_by_body.get(body)
+        if cluster_id is None:
+            text = normalize(body)
+            cluster_id = self.clusters_by_text.get(text)
+            if cluster_id is None:
+                cluster_id = self.__cluster_text(text)
+                self.clusters_by_text[text] = cluster_id
+            self.clusters_by_body[body] = cluster_id
+        return cluster_id
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __cluster_text(self, text):
+        text_signature = signature(text, self.bins)
+        band_keys = self.__band_keys(text_signature)
+
+        for band_key in band_keys:
+            cluster_id = self.bands.get(band_key)
+            if cluster_id is not None and similarity(text_signature, self.signatures[cluster_id]) >= self.min_similarity:
+                return cluster_id
+
+        cluster_id = len(self.signatures)
+        self.signatures.append(text_signature)
+        for band_key in band_keys:
+            self.bands.setdefault(band_key, cluster_id)
+        return cluster_id
+
+    # Keys of the bands of a signature that are not entirely empty
+    def __band_keys(self, text_signature):
+        band_keys = []
+        for start in range(0, self.bins, self.band_rows):
+            band = tuple(text_signature[start:start + self.band_rows])
+            if any([value != EMPTY_BIN for value in band]):
+                band_keys.append(hash((start, band)))
+        return band_keys
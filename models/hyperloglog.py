@@ -0,0 +1,158 @@
+import hashlib
+import math
+import settings
+
+
+# Estimates the number of distinct values added to it in a fixed amount of memory: 2 ** precision
+# one byte registers, with a relative standard error of about 1.04 / sqrt(2 ** precision).
+# A sketch starts sparse, keeping only the registers that were set in a dict, and switches to a
+# bytearray of all the registers once that is smaller. Values are hashed with blake2b so sketches
+# written by different processes can be merged.
+class HyperLogLog():
+
+    __slots__ = ('precision', 'registers')
+
+    MIN_PRECISION = 4
+    MAX_PRECISION = 18
+
+    # bytes taken by a register of a sparse sketch, its dict entry and int key
+    SPARSE_ENTRY_SIZE = 128
+
+    def __init__(self, precision=settings.HLL_PRECISION):
+        if not isinstance(precision, int) or not self.MIN_PRECISION <= precision <= self.MAX_PRECISION:
+            raise ValueError("HyperLogLog precision must be between {} and {}".format(self.MIN_PRECISION, \
+                self.MAX_PRECISION))
+
+        self.precision = precision
+        self.registers = {}
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+        # the first bits pick the register, which keeps the longest run of leading zeros of the rest
+        index = hashed >> (64 - self.precision)
+        rank = 64 - self.precision - (hashed & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+
+        registers = self.registers
+        if isinstance(registers, dict):
+            if rank > registers.get(index, 0):
+                registers[index] = rank
+                if len(registers) * self.SPARSE_ENTRY_SIZE > (1 << self.precision):
+                    self.__densify()
+        elif rank > registers[index]:
+            registers[index] = rank
+
+    # Returns the estimated number of distinct values added, as a float. Uses the improved estimator
+    # of Ertl (2017) computed from the histogram of the registers, which unlike the original
+    # estimator is not biased while part of the registers are still empty
+    def count(self):
+        register_count = 1 << self.precision
+        max_rank = 64 - self.precision
+
+        # sparse sketches have so few registers set that linear counting is as accurate and much faster
+        if isinstance(self.registers, dict):
+            return register_count * math.log(register_count / (register_count - len(self.registers)))
+
+        histogram = [0] * (max_rank + 2)
+        for rank in self.registers:
+            histogram[rank] += 1
+
+        z = register_count * self.__tau(1 - histogram[max_rank + 1] / register_count)
+        for rank in range(max_rank, 0, -1):
+            z = 0.5 * (z + histogram[rank])
+        z += register_count * self.__sigma(histogram[0] / register_count)
+
+        return register_count * register_count / (2 * math.log(2) * z)
+
+    def __len__(self):
+        return int(round(self.count()))
+
+    # Adds every value counted by other to this sketch, both must have the same precision
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Can not merge HyperLogLog sketches of precision {} and {}".format(self.precision, \
+                other.precision))
+
+        other_registers = other.registers.items() if isinstance(other.registers, dict) else enumerate(other.registers)
+        for index, rank in other_registers:
+            if rank > (self.registers.get(index, 0) if isinstance(self.registers, dict) else self.registers[index]):
+                self.registers[index] = rank
+
+        if isinstance(self.registers, dict) and len(self.registers) * self.SPARSE_ENTRY_SIZE > (1 << self.precision):
+            self.__densify()
+
+        return self
+
+    # Serializes the sketch, a precision byte with the high bit set for sparse sketches followed
+    # by 3 bytes (index << 6 | rank) per set register, or by every register for dense ones
+    def to_bytes(self):
+        if isinstance(self.registers, dict):
+            return bytes([0x80 | self.precision]) + b''.join([((index << 6) | rank).to_bytes(3, 'big') \
+                for index, rank in sorted(self.registers.items())])
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @staticmethod
+    def from_bytes(data):
+        sketch = HyperLogLog(data[0] & 0x7f)
+        if data[0] & 0x80:
+            for start in range(1, len(data), 3):
+                packed = int.from_bytes(data[start:start + 3], 'big')
+                sketch.registers[packed >> 6] = packed & 0x3f
+        else:
+            sketch.registers = bytearray(data[1:])
+        return sketch
+
+    # Returns the number of bytes used by the registers
+    def memory_size(self):
+        if isinstance(self.registers, dict):
+            return len(self.registers) * self.SPARSE_ENTRY_SIZE
+        return len(self.registers)
+
+    def __densify(self):
+        registers = bytearray(1 << self.precision)
+        for index, rank in self.registers.items():
+            registers[index] = rank
+        self.registers = registers
+
+    @staticmethod
+    def __sigma(x):
+        if x == 1:
+            return math.inf
+        y = 1
+        z = x
+        while True:
+            x *= x
+            previous_z = z
+            z += x * y
+            y += y
+            if z == previous_z:
+                return z
+
+    @staticmethod
+    def __tau(x):
+        if x == 0 or x == 1:
+            return 0
+        y = 1.0
+        z = 1 - x
+        while True:
+            x = math.sqrt(x)
+            previous_z = z
+            y *= 0.5
+            z -= (1 - x) ** 2 * y
+            if z == previous_z:
+                return z / 3
+
+
+# SQLite aggregate estimating COUNT(DISTINCT value) with a HyperLogLog sketch, registered by
+# DbHandler on every connection as approx_count_distinct(value)
+class ApproxCountDistinct():
+
+    def __init__(self):
+        self.sketch = HyperLogLog()
+
+    def step(self, value):
+        if value is not None:
+            self.sketch.add(value)
+
+    def finalize(self):
+        return len(self.sketch)
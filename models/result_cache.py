@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from models.stats import Stats
+import settings
+
+
+# Results of the read methods of Twitch as json text, by key. Every result is stored with the generation
+# of the rows it was read from, and is only returned for that generation. Writers give the streams they
+# change a new generation in the transaction of the change (see Twitch), so a result is never read after
+# its rows changed, whichever process changed them.
+# Results are kept in memory up to max_bytes, the least recently used ones are evicted first, and
+# results larger than max_entry_bytes are not kept. With a filename they are also kept in that SQLite
+# file up to max_file_bytes, the oldest ones evicted first, so they survive between runs of twitch.py
+class ResultCache():
+
+    def __init__(self, max_bytes=settings.RESULT_CACHE_BYTES, max_entry_bytes=settings.RESULT_CACHE_ENTRY_BYTES, \
+        filename=settings.RESULT_CACHE_FILE, max_file_bytes=settings.RESULT_CACHE_FILE_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_file_bytes = max_file_bytes
+        self.logger = settings.twitch_logger
+        # key: (generation, text), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # the server reads results from several threads
+        self.lock = threading.Lock()
+
+        self.connection = None
+        if filename:
+            # writes are skipped rather than waited for while another process writes the file
+            self.connection = sqlite3.connect(filename, timeout=0, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('CREATE TABLE if not exists results (key text PRIMARY KEY, generation integer, result text)')
+            self.connection.commit()
+
+    # Returns the json text of the result of key for generation, or None
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                Stats.count('result_cache.hits')
+                return entry[1]
+
+            text = self.__get_from_file(key, generation)
+            if text is None:
+                self.misses += 1
+                Stats.count('result_cache.misses')
+                return None
+
+            self.hits += 1
+            Stats.count('result_cache.hits')
+            self.__put_in_memory(key, generation, text)
+            return text
+
+    # Keeps the json text of the result of key for generation
+    def put(self, key, generation, text):
+        if len(text) > self.max_entry_bytes:
+            return
+
+        with self.lock:
+            self.__put_in_memory(key, generation, text)
+            if self.connection is not None:
+                self.__put_in_file(key, generation, text)
+
+    # Removes every result, in memory and in the file
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            if self.connection is not None:
+                self.connection.execute('DELETE FROM results')
+                self.connection.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __put_in_memory(self, key, generation, text):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+        self.entries[key] = (generation, text)
+        self.size += len(text)
+        while self.size > self.max_bytes:
+            evicted_key, (evicted_generation, evicted_text) = self.entries.popitem(last=False)
+            self.size -= len(evicted_text)
+
+    def __get_from_file(self, key, generation):
+        if self.connection is None:
+            return None
+
+        row = self.connection.execute('SELECT result FROM results WHERE key = ? AND generation = ?', \
+            (key, generation)).fetchone()
+        return row[0] if row else None
+
+    # The file is shared with other processes, a result that can not be written right away is only kept in memory
+    def __put_in_file(self, key, generation, text):
+        try:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (key, generation, text))
+            size = self.connection.execute('SELECT SUM(length(result)) FROM results').fetchone()[0]
+            if size > self.max_file_bytes:
+                # the oldest half of the results is evicted
+                self.connection.execute('DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY rowid ' \
+                    'LIMIT (SELECT COUNT(*) FROM results) / 2 + 1)')
+            self.connection.commit()
+        except sqlite3.OperationalError as e:
+            self.connection.rollback()
+            self.logger.info('Result cache could not write (%s) to its file: %s', key, e)
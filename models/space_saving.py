@@ -0,0 +1,76 @@
+# Space-Saving heavy hitters (Metwally et al. 2005): counts the most frequent items of a stream
+# while monitoring at most `capacity` of them. When a new item arrives and all the slots are taken
+# it replaces an item with the lowest count and inherits that count as its error.
+# After n items:
+#  - every item occurring more than n / capacity times is monitored
+#  - the count of a monitored item overestimates its occurrences by at most its error, so the
+#    true count is between count - error and count
+#  - items that are not monitored occur at most min_count() times
+# Monitored items are grouped in buckets by count so every update takes constant time.
+class SpaceSaving():
+
+    # new_payload creates the value kept with an item while it is monitored (e.g. its set of users),
+    # it is dropped when the item is replaced
+    def __init__(self, capacity, new_payload=None):
+        if not isinstance(capacity, int) or capacity < 1:
+            raise ValueError("Space-Saving capacity must be a positive integer")
+
+        self.capacity = capacity
+        self.new_payload = new_payload
+        # item: [count, error, payload]
+        self.entries = {}
+        # count: {item: None}, the items with that count in insertion order
+        self.buckets = {}
+        self.minimum = 0
+        self.total = 0
+
+    # Counts one occurrence of item, returns the payload of the item
+    def add(self, item):
+        self.total += 1
+        entry = self.entries.get(item)
+
+        if entry is None:
+            error = 0
+            if len(self.entries) >= self.capacity:
+                # replace an item with the lowest count
+                error = self.minimum
+                replaced, ignored = self.buckets[error].popitem()
+                if not self.buckets[error]:
+                    del self.buckets[error]
+                del self.entries[replaced]
+
+            entry = [error, error, self.new_payload() if self.new_payload else None]
+            self.entries[item] = entry
+        else:
+            self.__remove_from_bucket(item, entry[0])
+
+        previous_count = entry[0]
+        entry[0] += 1
+        self.buckets.setdefault(entry[0], {})[item] = None
+
+        # the lowest count only changes when an item is added with a count of 1 or the last item
+        # with the lowest count moved up
+        if previous_count == 0:
+            self.minimum = 1
+        elif previous_count == self.minimum and previous_count not in self.buckets:
+            self.minimum = previous_count + 1
+
+        return entry[2]
+
+    # Returns the lowest count of a monitored item, the most an unmonitored item can occur
+    def min_count(self):
+        return self.minimum if len(self.entries) >= self.capacity else 0
+
+    # Returns [(item, count, error, payload)] of the monitored items, by descending count
+    def items(self):
+        return sorted([(item, entry[0], entry[1], entry[2]) for item, entry in self.entries.items()], \
+            key=lambda item: item[1], reverse=True)
+
+    def __remove_from_bucket(self, item, count):
+        bucket = self.buckets[count]
+        del bucket[item]
+        if not bucket:
+            del self.buckets[count]
+
+    def __len__(self):
+        return len(self.entries)
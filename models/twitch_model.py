@@ -1,12 +1,46 @@
-from models.db_model import DbHandler
-from models.chatlog import ChatLog
+from models.db_model import DbHandler, QueryBuilder
+from models.chatlog import ChatLog, count_comment, read_chatlog
+from models.chatlog_registry import ChatLogRegistry
 from models.channel import Channel
+from models.hyperloglog import HyperLogLog
+from models.result_cache import ResultCache
+from models.stats import Stats
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import random
 import sqlite3
+import threading
+import time
 import settings
 import json
 
 class Twitch():
 
+    # tables summarizing chat_log per stream, kept up to date as comments are stored, see rebuild_rollups
+    ROLLUP_TABLES = ['chat_windows', 'chat_minute_users', 'chat_texts']
+
+    # full text index of the texts of messages, kept up to date by the database, see search_chatlog
+    SEARCH_TABLE = 'chat_search'
+    # the rows of the matching texts: the streams of a text are found in chat_texts and its rows by their stream and
+    # text. CROSS JOIN keeps that order, otherwise a stream_id alone reads chat_rows by chat_rows_stream_user and goes
+    # through every row of the stream for every matching text
+    SEARCH_JOIN = SEARCH_TABLE + ' CROSS JOIN chat_texts ON chat_texts.text_id = ' + SEARCH_TABLE + '.rowid ' \
+        'CROSS JOIN chat_rows ON chat_rows.channel_id = chat_texts.channel_id AND chat_rows.stream_id = ' \
+        'chat_texts.stream_id AND chat_rows.text_id = chat_texts.text_id JOIN messages ON messages.text_id = ' \
+        'chat_rows.text_id LEFT JOIN users ON users.user_id = chat_rows.user_id'
+
+    # dictionary tables of the users and texts of chat_rows: (table, id column, value column)
+    USER_DICTIONARY = ('users', 'user_id', 'user')
+    TEXT_DICTIONARY = ('messages', 'text_id', 'text')
+
+    # smallest size of a chat_log row as json, its column names and chat_time alone take 100 characters
+    ROW_BYTES = 100
+
+    # the rows of the chat_log view with the rowid of chat_rows, read by query_chatlog_page
+    CHATLOG_PAGE_TABLE = 'chat_rows LEFT JOIN messages USING (text_id) LEFT JOIN users USING (user_id)'
+    CHATLOG_COLUMNS = ['channel_id', 'stream_id', 'text', 'user', 'chat_time', 'offset']
+
     # SINGLETON PATTERN
     __instance = None
     def __init__(self):
@@ -19,8 +53,16 @@ class Twitch():
                 # Already instantiated
                 self.db_handler = DbHandler.getInstance()
 
-            self.chatlogs = {}
+            # parsed chatlogs by filename, compacted and evicted past settings.CHATLOG_REGISTRY_BYTES
+            self.chatlogs = ChatLogRegistry()
             self.logger = settings.twitch_logger
+            # results of the read methods, see __cached_result
+            self.result_cache = ResultCache()
+            # ids of the users and texts stored by dictionary table, see __dictionary_ids
+            self.dictionary_ids = {}
+            self.dictionary_database = None
+            # ids read by the transaction of every thread, not committed yet
+            self.transaction_ids = threading.local()
             Twitch.__instance = self
         else:
             raise TypeError("Twitch model cannot have multiple instances")
@@ -42,33 +84,57 @@ class Twitch():
         return channel
 
     # parses a chatlog and returns a dictionary composed of chatlog file. Requires a json file path
-    def parse_chatlog(self, filename):
+    # With stream=True the file is read lazily by later calls and None is returned.
+    # The chatlog is kept compacted, the dictionary is not kept. With columnar=True the comments are
+    # read into columns as the file is parsed, the dictionary is never built and None is returned
+    @Stats.timed('parse_chatlog')
+    def parse_chatlog(self, filename, stream=False, columnar=False):
         try:
-            chatlog = ChatLog(filename)
-            #add the chatlog instace into the chatlogs dictionary
-            self.chatlogs[filename] = chatlog
-            return chatlog.get_chatlog()
+            chatlog = ChatLog(filename, stream, columnar)
+            parsed_chatlog = chatlog.get_chatlog()
+            #add the chatlog instace into the chatlogs registry
+            self.chatlogs.add(chatlog)
+            return parsed_chatlog
         except FileNotFoundError as e:
-            self.logger.error('Twitch failed to parse chatlog ({}). File not found.'.format(filename))
+            self.logger.error('Twitch failed to parse chatlog (%s). File not found.', filename)
             raise FileNotFoundError("Failed to parse {}. File not found.".format(filename))
 
 
+    # Returns (channel_id, stream_id) of an already parsed chatlog
+    def get_stream_ids(self, chatlog_name):
+        if not chatlog_name in self.chatlogs.keys():
+            self.logger.error('(%s) is not an imported chatlog.', chatlog_name)
+            raise KeyError("({}) is not in chatlogs".format(chatlog_name))
+
+        return self.chatlogs[chatlog_name].get_stream_ids()
+
+
     # Returns a list where each element is a dictionary with key comment body
     # and key value a tuple where the first element is the number of the comment's repetitions
     # in the chat log and the second element is the list of users who have posted this comment.
     # If `sort` is True, the elements will be sorted in the returned list.
-    def process_comments(self, chatlog_name, sort=False):
+    # With exact=False users are counted by HyperLogLog sketches instead of sets.
+    # With top_k only the top_k most repeated comments are counted in bounded memory, and each tuple
+    # gets the error of its count as a fifth element, see ChatLog.count_top_comments
+    # With fingerprint=True near duplicate comments are counted together, see ChatLog.count_fingerprints
+    @Stats.timed('count_comments')
+    def process_comments(self, chatlog_name, sort=False, exact=True, top_k=None, fingerprint=False):
         # check if the chatlog is already parsed
         if not chatlog_name in self.chatlogs.keys():
-            self.logger.error('({}) is not an imported chatlog.'.format(chatlog_name))
+            self.logger.error('(%s) is not an imported chatlog.', chatlog_name)
             raise KeyError("({}) is not in chatlogs".format(chatlog_name))
 
         # retrives the chatlog
         chatlog = self.chatlogs[chatlog_name]
 
         # counts the number of occurrences for each comment
-        comments = chatlog.count_comments()
-        self.logger.info('({}) successfully processed based on comment repetition.'.format(chatlog_name))
+        if fingerprint:
+            comments = chatlog.count_fingerprints(exact)
+        elif top_k:
+            comments = chatlog.count_top_comments(top_k, exact)
+        else:
+            comments = chatlog.count_comments(exact)
+        self.logger.info('(%s) successfully processed based on comment repetition.', chatlog_name)
         # sorts the return list if sort is true
         if (sort):
             return sorted(comments.items(), key=lambda kv:kv[1][0], reverse=True)
@@ -77,33 +143,172 @@ class Twitch():
 
 
 
-    # Deletes spam with channel_id and stream_id provided
+    # Deletes spam with channel_id and stream_id provided, along with the counters kept for the
+    # stream by update_top_spam so its next update starts over
     def delete_top_spam(self, channel_id, stream_id):
-        self.db_handler.delete_from_database('top_spam', ['channel_id eq ' + channel_id,\
-            'stream_id eq ' + stream_id], 'AND')
+        conditions = ['channel_id eq ' + channel_id, 'stream_id eq ' + stream_id]
+        with self.db_handler.transaction():
+            for table_name in ['top_spam', 'spam_counts', 'spam_users', 'spam_sketches', 'spam_streams']:
+                self.db_handler.delete_from_database(table_name, conditions, 'AND')
+            self.__new_result_generation(channel_id, stream_id)
+
+
+    # Updates the top spam of an already parsed chatlog incrementally. The comment counts, users and
+    # number of processed comments of every stream are kept in the database, so when the export was
+    # extended with new comments since the last update only those are counted and only the top_spam
+    # rows of the comments they repeat are rewritten. An export shorter than the processed one is
+    # counted again from the start.
+    # With exact=False the users of every comment are kept as a HyperLogLog sketch in spam_sketches
+    # instead of one spam_users row per user. Switching between the two counts the stream again.
+    # Returns [new_comment_count, updated_spam_count, stream_id, channel_id]
+    @Stats.timed('update_top_spam')
+    def update_top_spam(self, filename, threshold = settings.TOP_SPAM_THRESHOLD, exact=True):
+        # Check if chat log has been imported & parsed
+        if not filename in self.chatlogs.keys():
+            self.logger.error('(%s) is not an imported chatlog.', filename)
+            raise KeyError("File is not in chatlogs")
+
+        chatlog = self.chatlogs[filename]
+        channel_id, stream_id = chatlog.get_stream_ids()
+        conditions = ['channel_id eq ' + channel_id, 'stream_id eq ' + stream_id]
+
+        processed = self.db_handler.select_from_database('spam_streams', ['processed_comments', 'exact_user_counts'], \
+            conditions)
+        processed_count = 0
+        if processed and bool(processed[0]['exact_user_counts']) == exact:
+            processed_count = processed[0]['processed_comments']
+
+        # count the comments after the ones already processed
+        comments = {}
+        comment_count = 0
+        for comment in chatlog.comments():
+            if comment_count >= processed_count:
+                count_comment(comments, comment, set if exact else HyperLogLog)
+            comment_count += 1
+
+        if comment_count < processed_count:
+            self.logger.info('(%s) has less comments than were processed for stream %s, counting from the start.', \
+                filename, stream_id)
+            self.delete_top_spam(channel_id, stream_id)
+            return self.update_top_spam(filename, threshold, exact)
+
+        try:
+            # counters and top spam are committed together
+            with self.db_handler.transaction():
+                # nothing was counted for the stream, top spam inserted by insert_top_spam is replaced
+                if processed_count == 0:
+                    self.delete_top_spam(channel_id, stream_id)
+
+                self.db_handler.upsert_multiple_values('spam_counts', \
+                    [[comment_channel_id, comment_stream_id, comment_body, count] \
+                    for comment_body, (count, users, comment_channel_id, comment_stream_id) in comments.items()], \
+                    ['channel_id', 'stream_id', 'spam_text'], ['spam_occurrences'])
+
+                if exact:
+                    self.db_handler.upsert_multiple_values('spam_users', \
+                        [[comment_channel_id, comment_stream_id, comment_body, user] \
+                        for comment_body, (count, users, comment_channel_id, comment_stream_id) in comments.items() \
+                        for user in users], ['channel_id', 'stream_id', 'spam_text', 'user'])
+                    user_sketches = None
+                else:
+                    user_sketches = self.__merge_user_sketches(conditions, comments)
+
+                self.db_handler.upsert_multiple_values('spam_streams', \
+                    [[channel_id, stream_id, comment_count - processed_count, int(exact)]], \
+                    ['channel_id', 'stream_id'], ['processed_comments'], ['exact_user_counts'])
+                spam_count = self.__update_top_spam_rows(conditions, comments.keys(), threshold, user_sketches)
+                self.__new_result_generation(channel_id, stream_id)
+
+        except sqlite3.DatabaseError as e:
+            self.logger.error('Failed to update top spam of stream %s', stream_id)
+            raise e
+
+        self.logger.info('(%s) top spam updated with %s new comments, %s top spam records changed.', filename, \
+            comment_count - processed_count, spam_count)
+
+        return [comment_count - processed_count, spam_count, stream_id, channel_id]
+
+
+    # Merges the user sketches of the counted comments into the ones stored in spam_sketches, read in a
+    # single query, returns the merged sketches {comment<str>: sketch<HyperLogLog>}
+    def __merge_user_sketches(self, conditions, comments):
+        stored = self.db_handler.select_by_values('spam_sketches', 'spam_text', comments.keys(), ['user_sketch'], \
+            conditions)
+        stored = dict([(row['value'], row['user_sketch']) for row in stored])
+
+        user_sketches = {}
+        values = []
+        for comment_body, (count, users, comment_channel_id, comment_stream_id) in comments.items():
+            if comment_body in stored:
+                users.merge(HyperLogLog.from_bytes(stored[comment_body]))
+            user_sketches[comment_body] = users
+            values.append([comment_channel_id, comment_stream_id, comment_body, users.to_bytes()])
+
+        self.db_handler.upsert_multiple_values('spam_sketches', values, ['channel_id', 'stream_id', 'spam_text'], \
+            [], ['user_sketch'])
+        return user_sketches
+
+
+    # Rewrites the top_spam rows of the updated comments that are repeated more than the threshold
+    # from the stream counters, returns the number of rows written. Users are counted from
+    # user_sketches when given, from spam_users otherwise
+    def __update_top_spam_rows(self, conditions, updated_comments, threshold, user_sketches=None):
+        spam = self.db_handler.select_from_database('spam_counts', ['channel_id', 'stream_id', 'spam_text', \
+            'spam_occurrences'], conditions + ['spam_occurrences gt ' + str(threshold)])
+
+        spam_count = 0
+        for row in spam:
+            if not row['spam_text'] in updated_comments:
+                continue
+
+            spam_conditions = conditions + [QueryBuilder.condition('spam_text', 'eq', row['spam_text'])]
+            if user_sketches is None:
+                [users] = self.db_handler.select_from_database('spam_users', ['COUNT(*) AS user_count'], spam_conditions)
+                user_count = users['user_count']
+            else:
+                user_count = len(user_sketches[row['spam_text']])
+
+            # values is [channel_id, stream_id, comment, comment_count, user_count]
+            self.db_handler.delete_from_database('top_spam', spam_conditions)
+            self.db_handler.insert_values('top_spam', list(row) + [user_count])
+            spam_count += 1
+
+        return spam_count
 
 
     # Recives a list of comments and a threshold to return all the comments that have been repeated
-    # more than the threshold
+    # more than the threshold. Users counted by a HyperLogLog sketch have the sketch stored in spam_sketches
+    # Comments counted with an error (top_k) are only inserted if they are certainly above the threshold
+    @Stats.timed('insert_top_spam')
     def insert_top_spam(self, comments, threshold = settings.TOP_SPAM_THRESHOLD):
         try:
             spam_count = 0
-            for index,(comment_body,comment_data) in enumerate(comments):
-                # check number of comment occurences
-                if comment_data[0] > threshold:
-                    # values is [channel_id, stream_id, comment, comment_count, user_count]
-                    values = [comment_data[2], comment_data[3], comment_body, comment_data[0], len(comment_data[1])]
-                    self.db_handler.insert_values('top_spam', values)
-                    self.logger.info("Channel id: ({}) Inserted comment.".format(comment_data[2]))
-                    spam_count += 1
-
-            self.logger.info('Successfully inserted {} comments into database'.format(spam_count))
+            streams = set()
+            # all the rows are committed together
+            with self.db_handler.transaction():
+                for index,(comment_body,comment_data) in enumerate(comments):
+                    # check number of comment occurences
+                    if comment_data[0] - (comment_data[4] if len(comment_data) > 4 else 0) > threshold:
+                        # values is [channel_id, stream_id, comment, comment_count, user_count]
+                        values = [comment_data[2], comment_data[3], comment_body, comment_data[0], len(comment_data[1])]
+                        self.db_handler.insert_values('top_spam', values)
+                        if isinstance(comment_data[1], HyperLogLog):
+                            self.db_handler.upsert_multiple_values('spam_sketches', [values[:3] + \
+                                [comment_data[1].to_bytes()]], ['channel_id', 'stream_id', 'spam_text'], [], ['user_sketch'])
+                        self.logger.debug('Channel id: (%s) Inserted comment.', comment_data[2])
+                        streams.add((comment_data[2], comment_data[3]))
+                        spam_count += 1
+
+                for channel_id, stream_id in streams:
+                    self.__new_result_generation(channel_id, stream_id)
+
+            self.logger.info('Successfully inserted %s comments into database', spam_count)
 
             return spam_count
 
         except (sqlite3.DatabaseError, TypeError) as e:
             self.logger.error('Failed to insert comments into database')
-            raise e("failed to insert comments into database")
+            raise e
 
     # Returns from the databse all the comments that have channel_id and stream_id
     def get_top_spam(self, channel_id, stream_id):
@@ -111,123 +316,540 @@ class Twitch():
         conditions = ['channel_id eq ' + channel_id, 'stream_id eq ' + stream_id]
 
         # Select 'spam_text', 'occurrences', 'user_count'
-        top_spam = self.db_handler.select_from_database('top_spam', ['spam_text', \
-            'spam_occurrences', 'spam_user_count'], conditions, 'AND', \
-            'spam_occurrences desc, spam_user_count desc, spam_text', '')
+        return self.__cached_result(['get_top_spam', channel_id, stream_id], channel_id, stream_id, \
+            lambda: self.db_handler.select_from_database('top_spam', ['spam_text', \
+            'spam_occurrences AS occurrences', 'spam_user_count AS user_count'], conditions, 'AND', \
+            'spam_occurrences desc, spam_user_count desc, spam_text', ''))
 
-        # Rename column names in dictionary
-        for spam in top_spam:
-            spam["occurrences"] = spam.pop("spam_occurrences")
-            spam["user_count"] = spam.pop("spam_user_count")
 
-        return top_spam
+    # Returns the comments of a stream repeated more than the threshold with their number of distinct users.
+    # The comments are found in the chat_texts rollup, only the chat_rows of those comments are
+    # read to count their users. With exact=False distinct users are estimated by approx_count_distinct
+    def get_top_spam2(self, channel_id, stream_id, threshold = settings.TOP_SPAM_THRESHOLD, exact=True):
 
+        conditions = ['channel_id eq ' + str(channel_id), 'stream_id eq ' + str(stream_id), 'messages gt ' + str(threshold)]
+        count_users = 'COUNT(DISTINCT user_id)' if exact else 'approx_count_distinct(user_id)'
 
-    def get_top_spam2(self, channel_id, stream_id, threshold = settings.TOP_SPAM_THRESHOLD):# pragma: no cover
-
-        conditions = ['channel_id eq ' + channel_id, 'stream_id eq ' + stream_id]
+        # the partial index of repeated texts is only used by queries stating its literal condition
+        table_name = 'chat_texts'
+        if threshold >= 1:
+            table_name = '(SELECT * FROM chat_texts WHERE messages > 1) AS chat_texts'
+        table_name += ' JOIN messages USING (text_id)'
 
         # Select 'spam_text', 'occurrences', 'user_count'
-        top_spam = self.db_handler.select_from_database('chat_log', ['text as spam_text', \
-            'COUNT(*) as occurrences', 'COUNT(DISTINCT user) as user_count'], conditions, 'AND', \
-            'occurrences desc, user_count desc, spam_text', '', \
-            'text HAVING occurrences > ' + str(threshold))
+        return self.__cached_result(['get_top_spam2', channel_id, stream_id, threshold, exact], channel_id, stream_id, \
+            lambda: self.db_handler.select_from_database(table_name, ['text as spam_text', \
+            'messages as occurrences', '(SELECT ' + count_users + ' FROM chat_rows WHERE chat_rows.channel_id = ' \
+            'chat_texts.channel_id AND chat_rows.stream_id = chat_texts.stream_id AND chat_rows.text_id = ' \
+            'chat_texts.text_id) as user_count'], conditions, 'AND', 'occurrences desc, user_count desc, spam_text', ''))
 
-        return top_spam
 
-    def delete_chatlog(self, channel_id, stream_id):# pragma: no cover
-        self.db_handler.delete_from_database('chat_log', ['channel_id eq ' + channel_id,\
-            'stream_id eq ' + stream_id], 'AND')
+    # Deletes the chat_log rows of a stream and its rollups. The users and texts of the rows are left in
+    # their dictionary tables, other streams may refer to them
+    def delete_chatlog(self, channel_id, stream_id):
+        conditions = ['channel_id eq ' + channel_id, 'stream_id eq ' + stream_id]
+        with self.db_handler.transaction():
+            for table_name in ['chat_rows'] + self.ROLLUP_TABLES:
+                self.db_handler.delete_from_database(table_name, conditions, 'AND')
+            self.__new_result_generation(channel_id, stream_id)
+
+
+    # Computes the rollups of a stream again from its chat_log rows, or of every stream when no stream
+    # is given (e.g. for rows stored without them). Returns the number of streams rebuilt
+    @Stats.timed('rebuild_rollups')
+    def rebuild_rollups(self, channel_id=None, stream_id=None):
+        if channel_id is None or stream_id is None:
+            streams = self.db_handler.select_from_database('chat_rows', ['channel_id', 'stream_id'], [], 'AND', \
+                '', '', 'channel_id, stream_id')
+        else:
+            streams = [(channel_id, stream_id)]
+
+        with self.db_handler.transaction():
+            for channel_id, stream_id in streams:
+                conditions = ['channel_id eq ' + str(channel_id), 'stream_id eq ' + str(stream_id)]
+                for table_name in self.ROLLUP_TABLES:
+                    self.db_handler.delete_from_database(table_name, conditions, 'AND')
+
+                # users and texts are told apart by id
+                for window_seconds in self.__rollup_window_seconds():
+                    self.db_handler.insert_from_select('chat_windows', 'chat_rows', ['channel_id', 'stream_id', \
+                        str(window_seconds), 'CAST(offset / {} AS INTEGER) AS window'.format(window_seconds), 'COUNT(*)', \
+                        'COUNT(DISTINCT user_id)'], conditions, 'AND', 'window')
+                self.db_handler.insert_from_select('chat_minute_users', 'chat_rows', ['channel_id', 'stream_id', \
+                    'CAST(offset / 60 AS INTEGER) AS minute', 'user_id'], conditions, 'AND', 'minute, user_id')
+                self.db_handler.insert_from_select('chat_texts', 'chat_rows', ['channel_id', 'stream_id', 'text_id', \
+                    'COUNT(*)'], conditions, 'AND', 'text_id')
+                self.__new_result_generation(channel_id, stream_id)
+
+        self.logger.info('Rollups of %s streams rebuilt.', len(streams))
+        return len(streams)
+
+
+    # Seconds of the windows of settings.VIEWERSHIP_ROLLUP_WINDOWS, kept in chat_windows
+    @staticmethod
+    def __rollup_window_seconds():
+        window_seconds = [settings.VIEWERSHIP_WINDOWS[window] for window in settings.VIEWERSHIP_ROLLUP_WINDOWS]
+        if [seconds for seconds in window_seconds if seconds % 60]:
+            raise ValueError("Viewership rollup windows must be whole minutes")
+        return window_seconds
 
 
     # Inserts an already parsed chatlog file into the database, chat_logs table
     def insert_chatlog(self, filename):
         # Check if chat log has been imported & parsed
         if not filename in self.chatlogs.keys():
-            self.logger.error('({}) is not an imported chatlog.'.format(filename))
+            self.logger.error('(%s) is not an imported chatlog.', filename)
             raise KeyError("File is not in chatlogs")
 
-        # Retrieves this files data from the chatlogs dictionary
-        chatlog = self.chatlogs[filename].get_chatlog()
+        # Retrieves this files chatlog from the chatlogs dictionary
+        chatlog = self.chatlogs[filename]
+        return self.__store_comments(chatlog.comments())
+
 
+    # Inserts an already parsed chatlog file into the chat_log table and counts its comments in
+    # the same pass, then inserts the comments repeated more than the threshold into top_spam.
+    # With exact=False users are counted by HyperLogLog sketches instead of sets.
+    # Returns [comment_count, insert_failure_count, stream_id, channel_id, spam_count]
+    def ingest_chatlog(self, filename, threshold = settings.TOP_SPAM_THRESHOLD, exact=True):
+        # Check if chat log has been imported & parsed
+        if not filename in self.chatlogs.keys():
+            self.logger.error('(%s) is not an imported chatlog.', filename)
+            raise KeyError("File is not in chatlogs")
+
+        comments = {}
+
+        # counts every comment as it is handed over to the database
+        def count_while_storing(chatlog):
+            for comment in chatlog.comments():
+                count_comment(comments, comment, set if exact else HyperLogLog)
+                yield comment
+
+        inserted_chatlog_stat = self.__store_comments(count_while_storing(self.chatlogs[filename]))
+
+        # Only the comments above the threshold are sorted and written
+        spam = sorted([item for item in comments.items() if item[1][0] > threshold], \
+            key=lambda kv:kv[1][0], reverse=True)
+        spam_count = self.insert_top_spam(spam, threshold)
+        self.logger.info('(%s) successfully ingested.', filename)
+
+        return inserted_chatlog_stat + [spam_count]
+
+
+    # Ingests chatlog files like ingest_chatlog, replacing the chat_log and top_spam rows of their streams.
+    # The files are read and counted by `workers` processes while this process, the only one writing to
+    # the database, stores them one at a time in the order of filenames.
+    # Yields [filename, comment_count, insert_failure_count, stream_id, channel_id, spam_count, read_seconds,
+    # store_seconds, error] for every file once stored, error being the message of the error a file
+    # could not be read with, or None
+    def iter_ingest_chatlogs(self, filenames, workers=settings.INGEST_WORKERS, threshold = settings.TOP_SPAM_THRESHOLD, \
+        exact=True):
+        filenames = iter(filenames)
+        # workers are spawned rather than forked from a process holding database connections and threads
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            # files read ahead of the writer are kept in memory, at most two per worker
+            pending = deque()
+            for filename in filenames:
+                pending.append((filename, executor.submit(read_chatlog, filename, threshold, exact)))
+                if len(pending) == 2 * workers:
+                    break
+
+            while pending:
+                filename, future = pending.popleft()
+                for next_filename in filenames:
+                    pending.append((next_filename, executor.submit(read_chatlog, next_filename, threshold, exact)))
+                    break
+                yield self.__store_chatlog(filename, future, threshold)
+
+
+    # Stores a chatlog read by read_chatlog in a single transaction, returns the row of iter_ingest_chatlogs
+    def __store_chatlog(self, filename, future, threshold):
+        try:
+            columns, spam, read_seconds = future.result()
+            if not columns:
+                raise IndexError("({}) has no comments".format(filename))
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            self.logger.error('(%s) could not be ingested.\n\tError: %s', filename, e)
+            return [filename, 0, 0, None, None, 0, 0, 0, '{}: {}'.format(type(e).__name__, e)]
+
+        # the worker processes do not collect stats, their reads are added here
+        Stats.add_time('read_chatlog', read_seconds)
+        Stats.count('comments_parsed', len(columns))
+        start = time.perf_counter()
+        channel_id = str(columns.channel_ids[0])
+        stream_id = str(columns.stream_ids[0])
+        with self.db_handler.transaction():
+            self.delete_chatlog(channel_id, stream_id)
+            self.delete_top_spam(channel_id, stream_id)
+            inserted_chatlog_stat = self.__store_comments(iter(columns))
+            spam_count = self.insert_top_spam(spam, threshold)
+        self.logger.info('(%s) successfully ingested.', filename)
+
+        return [filename] + inserted_chatlog_stat + [spam_count, read_seconds, time.perf_counter() - start, None]
+
+
+    # Inserts Comment records into chat_log in batches, see __insert_comments
+    # Returns [comment_count, insert_failure_count, stream_id, channel_id]
+    @Stats.timed('store_comments')
+    def __store_comments(self, comments):
         channel_id = ''
         stream_id = ''
+        insert_count = 0
+        insert_failure_count = 0
         insert_values = []
-        # Get the values from comments needed to insert into chatlog
-        for comment in chatlog['comments']:
-            channel_id = comment['channel_id']
-            stream_id = comment['content_id']
-            comment_body = comment['message']['body']
-            commenter_display_name = comment['commenter']['display_name']
-            created_at = comment['created_at']
-            content_offset_seconds = comment['content_offset_seconds']
-            # Append list to list of values
-            insert_values.append([channel_id, stream_id, comment_body, commenter_display_name,\
-                      created_at, content_offset_seconds])
-
+        streams = set()
         try:
-            # insert into the data base the comments that have been processed
-            insert_failure_count = self.db_handler.insert_multiple_values('chat_log', insert_values)
-            return [len(insert_values), insert_failure_count, stream_id, channel_id]
+            # the batches are committed together once the whole chatlog is stored
+            with self.db_handler.transaction():
+                # Get the values from comments needed to insert into chatlog, inserting them in batches
+                for comment in comments:
+                    channel_id = comment.channel_id
+                    stream_id = comment.stream_id
+                    insert_values.append(comment)
+
+                    if len(insert_values) >= settings.CHATLOG_INSERT_BATCH_SIZE:
+                        streams.update([(comment.channel_id, comment.stream_id) for comment in insert_values])
+                        insert_failure_count += self.__insert_comments(insert_values, not insert_failure_count)
+                        insert_count += len(insert_values)
+                        insert_values = []
+
+                # insert into the data base the comments that have been processed
+                streams.update([(comment.channel_id, comment.stream_id) for comment in insert_values])
+                insert_failure_count += self.__insert_comments(insert_values, not insert_failure_count)
+                insert_count += len(insert_values)
+                for stream in streams:
+                    self.__new_result_generation(*stream)
+
+                # the rollups of rows that could not be inserted are not known, they are computed again
+                if insert_failure_count:
+                    self.rebuild_rollups(channel_id, stream_id)
+            return [insert_count, insert_failure_count, stream_id, channel_id]
         except sqlite3.DatabaseError as e:# pragma: no cover
-            self.logger.error("could not insert values with channel id {} to database".format(channel_id))
-            raise e("could not insert values")
-
+            self.logger.error('could not insert values with channel id %s to database', channel_id)
+            raise e
+
+    # Inserts a batch of Comment records into chat_rows, their users and texts replaced by their ids, and adds
+    # them to the rollups if update_rollups is True and every row was inserted. Returns the number of rows
+    # that could not be inserted
+    def __insert_comments(self, comments, update_rollups):
+        user_ids = self.__dictionary_ids(self.USER_DICTIONARY, set([comment.user for comment in comments]))
+        text_ids = self.__dictionary_ids(self.TEXT_DICTIONARY, set([comment.body for comment in comments]))
+        rows = [(comment.channel_id, comment.stream_id, text_ids.get(comment.body), user_ids.get(comment.user), \
+            comment.created_at, comment.offset) for comment in comments]
+
+        insert_failure_count = self.db_handler.insert_multiple_values('chat_rows', rows)
+        if update_rollups and not insert_failure_count:
+            self.__update_rollups(rows)
+        return insert_failure_count
+
+    # Returns {value: id} of the values in the dictionary table (table, id column, value column), None being
+    # left out. Only the values whose id is not kept in memory are read from the database (and inserted into
+    # the table when new). Ids read in a transaction are kept for the calling thread until it ends, then in
+    # self.dictionary_ids if it commits and dropped if it rolls back, as the ids may then be given to other values.
+    # Up to settings.DICTIONARY_CACHE_ENTRIES ids are kept per table, the committed ones are all dropped when full
+    def __dictionary_ids(self, dictionary, values):
+        # ids are those of a single database
+        if self.dictionary_database != self.db_handler.database_name:
+            self.dictionary_ids = {}
+            self.dictionary_database = self.db_handler.database_name
+            self.transaction_ids = threading.local()
+        cached_ids = self.dictionary_ids.setdefault(dictionary[0], {})
+        if not hasattr(self.transaction_ids, 'ids'):
+            self.transaction_ids.ids = {}
+        transaction_ids = self.transaction_ids.ids.setdefault(dictionary[0], {})
+
+        ids = {}
+        missing_values = []
+        for value in values:
+            if value is None:
+                continue
+            id = cached_ids.get(value)
+            if id is None:
+                id = transaction_ids.get(value)
+            if id is None:
+                missing_values.append(value)
+            else:
+                ids[value] = id
+        Stats.count('dictionary_ids.hits', len(ids))
+        Stats.count('dictionary_ids.misses', len(missing_values))
+
+        if missing_values:
+            new_ids = self.db_handler.insert_dictionary_values(*dictionary, missing_values)
+            ids.update(new_ids)
+
+            first_ids = not transaction_ids
+            if len(transaction_ids) + len(new_ids) <= settings.DICTIONARY_CACHE_ENTRIES:
+                transaction_ids.update(new_ids)
+            if first_ids and transaction_ids:
+                self.db_handler.after_commit(lambda: self.__cache_ids(cached_ids, transaction_ids), \
+                    transaction_ids.clear)
+        return ids
+
+    # Moves the ids of a committed transaction to the ids kept between transactions
+    @staticmethod
+    def __cache_ids(cached_ids, transaction_ids):
+        if len(cached_ids) + len(transaction_ids) > settings.DICTIONARY_CACHE_ENTRIES:
+            cached_ids.clear()
+        cached_ids.update(transaction_ids)
+        transaction_ids.clear()
+
+    # Adds rows stored in chat_rows, (channel_id, stream_id, text_id, user_id, chat_time, offset), to the
+    # rollups. Messages per window and per text are added to chat_windows and chat_texts, the (minute, user_id)
+    # pairs to chat_minute_users, and the chatters of the windows of the batch are counted again from chat_minute_users
+    @Stats.timed('update_rollups')
+    def __update_rollups(self, rows):
+        minutes = {}
+        minute_users = set()
+        texts = {}
+        for channel_id, stream_id, text_id, user_id, chat_time, offset in rows:
+            minute = (channel_id, stream_id, int(offset // 60))
+            minutes[minute] = minutes.get(minute, 0) + 1
+            minute_users.add(minute + (user_id,))
+            text = (channel_id, stream_id, text_id)
+            texts[text] = texts.get(text, 0) + 1
+
+        self.db_handler.upsert_multiple_values('chat_texts', [list(text) + [count] for text, count in texts.items()], \
+            ['channel_id', 'stream_id', 'text_id'], ['messages'])
+        self.db_handler.upsert_multiple_values('chat_minute_users', [list(pair) for pair in minute_users], \
+            ['channel_id', 'stream_id', 'minute', 'user_id'])
+
+        rows = []
+        for window_seconds in self.__rollup_window_seconds():
+            minutes_per_window = window_seconds // 60
+            windows = {}
+            for (channel_id, stream_id, minute), count in minutes.items():
+                window = (channel_id, stream_id, window_seconds, minute // minutes_per_window)
+                windows[window] = windows.get(window, 0) + count
+
+            # a batch holds a few consecutive windows of a stream, their chatters are counted with a range scan
+            chatters = {}
+            for channel_id, stream_id in set([window[:2] for window in windows]):
+                stream_windows = [window[3] for window in windows if window[:2] == (channel_id, stream_id)]
+                conditions = [QueryBuilder.condition('channel_id', 'eq', channel_id), \
+                    QueryBuilder.condition('stream_id', 'eq', stream_id), \
+                    'minute gteq ' + str(min(stream_windows) * minutes_per_window), \
+                    'minute lt ' + str((max(stream_windows) + 1) * minutes_per_window)]
+                for row in self.db_handler.select_from_database('chat_minute_users', ['minute / {} AS window'\
+                    .format(minutes_per_window), 'COUNT(DISTINCT user_id) AS chatters'], conditions, 'AND', '', '', 'window'):
+                    chatters[(channel_id, stream_id, window_seconds, row['window'])] = row['chatters']
+
+            rows += [list(window) + [count, chatters[window]] for window, count in windows.items()]
+
+        self.db_handler.upsert_multiple_values('chat_windows', rows, ['channel_id', 'stream_id', 'window_seconds', \
+            'window'], ['messages'], ['chatters'])
+
+    # Returns the chat_log rows matching all the filters, ordered by chat time. Each filter is
+    # "COLUMN_NAME [ eq | gt | lt| gteq | lteq | like ] VALUE" where VALUE may contain spaces
     def query_chatlog(self, filters):
-        string_columns = ['text', 'user']
 
-        # Make sure filter is in correct format for string columns
-        for index, filter in enumerate(filters):
+        # Make sure every filter is in the correct format
+        for filter in filters:
+            if QueryBuilder.parse_condition(filter) is None:
+                raise TypeError("All filters are not in the correct format")
+
+        channel_id, stream_id = self.__filtered_stream(filters)
+        return self.__cached_result(['query_chatlog'] + sorted(filters), channel_id, stream_id, \
+            lambda: self.db_handler.select_from_database('chat_log', ['*'], filters, 'AND', 'chat_time', ''))
+
+
+    # Same as query_chatlog but yields the rows one at a time, reading them from the database
+    # page_size rows at a time so memory does not grow with the number of matching rows
+    def iter_query_chatlog(self, filters, page_size=settings.SELECT_PAGE_SIZE):
 
-            if not isinstance(filter, str) or len(filter.split(' ')) != 3:
+        # Make sure every filter is in the correct format
+        for filter in filters:
+            if QueryBuilder.parse_condition(filter) is None:
                 raise TypeError("All filters are not in the correct format")
 
-            [column, operator, value] = filter.split(' ')
-            if column in string_columns:
-                value = "'" + value + "'"
-            filters[index] = " ".join([column, operator, value])
+        channel_id, stream_id = self.__filtered_stream(filters)
+        return self.__iter_cached_rows(['query_chatlog'] + sorted(filters), channel_id, stream_id, \
+            lambda: self.db_handler.iter_select_from_database('chat_log', ['*'], filters, 'AND', 'chat_time', '', '', \
+            page_size))
 
-        return self.db_handler.select_from_database('chat_log', ['*'], filters, 'AND', 'chat_time', '')
 
+    # Returns (rows, after): at most limit chat_log rows matching all the filters, ordered by chat time, that come
+    # after the row of the key after, and the key to pass as after to get the next page (None after the last one).
+    # Pages are read with keyset pagination on the chat_time and rowid of chat_rows, so any page is read as fast
+    # as the first one when the filters name the channel and the stream (chat_rows_stream_time holds their order),
+    # the rows matching other filters are sorted again for every page
+    def query_chatlog_page(self, filters, after=None, limit=settings.SELECT_PAGE_SIZE):
 
-    # Get per minutes metrics of comments made by users in a given channel and
-    # stream
-    def get_viewer_metrics(self, channel_id, stream_id):# pragma: no cover
-        conditions = ['channel_id eq ' + channel_id, 'stream_id eq ' + stream_id]
+        # Make sure every filter is in the correct format
+        for filter in filters:
+            if QueryBuilder.parse_condition(filter) is None:
+                raise TypeError("All filters are not in the correct format")
+
+        rows, after = self.db_handler.select_page(self.CHATLOG_PAGE_TABLE, self.CHATLOG_COLUMNS, filters, 'AND', \
+            ['chat_time', 'chat_rows.rowid'], None if after is None else tuple(after), limit)
+        return [dict([(column, row[column]) for column in self.CHATLOG_COLUMNS]) for row in rows], after
+
+
+    # Returns the best ranked chat_log rows matching a full text query, at most limit of them and only those of
+    # channel_id and stream_id when given, as dicts with the bm25 rank of the row (lower is better) as "rank".
+    # query is an FTS5 query of the message text: words, "phrases", prefixes* and AND, OR, NOT, NEAR and ( )
+    # e.g. '"good game" OR gg*'. Rows of the same rank are in chat time order. Raises ValueError for a query
+    # SQLite can not parse. Rows are found through the chat_texts rollup, those inserted through the chat_log view
+    # are found once the rollups of their stream are rebuilt
+    def search_chatlog(self, query, channel_id=None, stream_id=None, limit=settings.SEARCH_LIMIT):
+        if not query.strip():
+            raise ValueError("Invalid search query ({})".format(query))
+
+        columns = ['chat_rows.channel_id AS channel_id', 'chat_rows.stream_id AS stream_id', 'messages.text AS text', \
+            'users.user AS user', 'chat_rows.chat_time AS chat_time', 'chat_rows.offset AS offset', \
+            self.SEARCH_TABLE + '.rank AS rank']
+        conditions = [QueryBuilder.condition(self.SEARCH_TABLE, 'match', query)]
+        for column, value in [('channel_id', channel_id), ('stream_id', stream_id)]:
+            if value is not None:
+                conditions.append(QueryBuilder.condition('chat_texts.' + column, 'eq', value))
+
+        channel_id = '' if channel_id is None else str(channel_id)
+        stream_id = '' if stream_id is None else str(stream_id)
+        try:
+            return self.__cached_result(['search_chatlog', query, channel_id, stream_id, limit], channel_id, stream_id, \
+                lambda: self.db_handler.select_from_database(self.SEARCH_JOIN, columns, conditions, 'AND', \
+                'rank, chat_rows.chat_time, chat_rows.rowid', '', '', limit))
+        except sqlite3.DatabaseError as e:
+            self.logger.error('Search of (%s) failed.\n\tError: %s', query, e)
+            raise ValueError("Invalid search query ({})".format(query))
 
-        # Get metrics from database
-        metrics = self.db_handler.select_from_database('chat_log', ['channel_id', \
-            'stream_id', 'chat_time', 'COUNT(*) as messages',\
-            'COUNT(DISTINCT user) as viewers'], conditions, 'AND', \
-            'chat_time', 'ASC', \
-            "strftime('%Y-%m-%dT%H:%M:%S.000', chat_time)")
 
-        # Return empty list if database is empty
-        if not len(metrics):
-            return metrics
+    # Returns (channel_id, stream_id) of the stream the chat_log filters are limited to, '' when they are
+    # not limited to a single channel or stream
+    def __filtered_stream(self, filters):
+        stream = {'channel_id': '', 'stream_id': ''}
+        for filter in filters:
+            column, operator, value = QueryBuilder.parse_condition(filter)
+            if column in stream and operator == '=':
+                stream[column] = value
+        return stream['channel_id'], stream['stream_id']
 
-        # Create viewer ship dictionary to be returned
-        viewership_metrics = {"channel_id": channel_id, "stream_id": stream_id,
-            "starttime": metrics[0]['chat_time'], "per_minute": []}
 
-        # Create first per minute dictionary with no data
-        current_offset = 1
-        metric = {"offset": current_offset, "viewers": 0, "messages": 0}
-        viewership_metrics['per_minute'].append(metric)
+    # Get the messages and distinct viewers (users who commented) of a stream per window of
+    # content_offset_seconds, window being one of settings.VIEWERSHIP_WINDOWS, as "per_minute" numbered
+    # from 1 for 1m windows and as "per_window" starting at offset seconds for the others. The windows of
+    # settings.VIEWERSHIP_ROLLUP_WINDOWS are read from the chat_windows rollup, others are counted from chat_log.
+    # With exact=False distinct viewers of chat_log windows are estimated with a HyperLogLog sketch per window
+    def get_viewer_metrics(self, channel_id, stream_id, exact=True, window=settings.VIEWERSHIP_WINDOW):
+        if window not in settings.VIEWERSHIP_WINDOWS:
+            raise ValueError("Unknown viewership window {}".format(window))
 
-        # Iterate through per second metrics and add to per minute dictionary
-        for index, seconds_metric in enumerate(metrics):
-            # Check if index is at new offset and create new per minute dictionary
-            if current_offset != ((index // 60) + 1):
-                current_offset = ((index // 60) + 1)
-                viewership_metrics['per_minute'].append(\
-                {"offset": current_offset, "viewers": 0, "messages": 0})
+        return self.__cached_result(['get_viewer_metrics', channel_id, stream_id, exact, window], channel_id, stream_id, \
+            lambda: self.__read_viewer_metrics(channel_id, stream_id, exact, window))
 
-            # Get last metric
-            current_metric = viewership_metrics['per_minute'][-1]
 
-            # current_metric['viewers'] += seconds_metric['viewers']
-            current_metric['messages'] += seconds_metric['messages']
+    def __read_viewer_metrics(self, channel_id, stream_id, exact, window):
+        conditions = ['channel_id eq ' + str(channel_id), 'stream_id eq ' + str(stream_id)]
+        window_seconds = settings.VIEWERSHIP_WINDOWS[window]
+
+        if window in settings.VIEWERSHIP_ROLLUP_WINDOWS:
+            metrics = self.__rollup_viewer_metrics(conditions, window_seconds)
+        else:
+            metrics = self.__chatlog_viewer_metrics(conditions, window_seconds, exact)
 
+        # Return empty list if database is empty
+        if not metrics:
+            return []
+
+        starttime = self.db_handler.select_from_database('chat_rows', ['MIN(chat_time) AS starttime'], \
+            conditions)[0]['starttime']
+
+        # Create viewer ship dictionary to be returned. 1m windows keep the shape viewership had before there were
+        # other windows, "per_minute" with minutes numbered from 1
+        viewership_metrics = {"channel_id": channel_id, "stream_id": stream_id, "starttime": starttime}
+        if window == '1m':
+            viewership_metrics['per_minute'] = [{"offset": offset // window_seconds + 1, "viewers": viewers, \
+                "messages": messages} for offset, messages, viewers in metrics]
+        else:
+            viewership_metrics['window'] = window
+            viewership_metrics['per_window'] = [{"offset": offset, "viewers": viewers, "messages": messages} \
+                for offset, messages, viewers in metrics]
 
         return [viewership_metrics]
+
+
+    # Gives the rows of a stream a new generation, so the results cached for the stream, its channel or every
+    # stream are not read any more. Called in the transaction writing the rows, so readers see the new rows
+    # and the new generation together. Generations are random so they are not reused after a purge
+    def __new_result_generation(self, channel_id, stream_id):
+        channel_id = str(channel_id)
+        stream_id = str(stream_id)
+        generation = random.getrandbits(62)
+        rows = [[channel_id, stream_id, generation], [channel_id, '', generation], ['', stream_id, generation], \
+            ['', '', generation]]
+        self.db_handler.upsert_multiple_values('result_generations', rows, ['channel_id', 'stream_id'], [], \
+            ['generation'])
+
+
+    # Returns the generation of the rows of a stream, '' standing for every channel or stream, or None
+    # if Twitch never wrote them
+    def __result_generation(self, channel_id, stream_id):
+        rows = self.db_handler.select_from_database('result_generations', ['generation'], \
+            [QueryBuilder.condition('channel_id', 'eq', str(channel_id)), \
+            QueryBuilder.condition('stream_id', 'eq', str(stream_id))], 'AND')
+        return rows[0]['generation'] if rows else None
+
+
+    # Returns the rows returned by read as dicts, from self.result_cache while the rows of the stream keep the
+    # generation they were read with. The generation is read before the rows, rows written after it are cached
+    # under a generation that is already stale and never read again. Only rows small enough to be cached are
+    # serialized
+    def __cached_result(self, arguments, channel_id, stream_id, read):
+        key = json.dumps(arguments)
+        generation = self.__result_generation(channel_id, stream_id)
+        text = self.result_cache.get(key, generation) if generation is not None else None
+        if text is not None:
+            return json.loads(text)
+
+        rows = [dict(row) for row in read()]
+        # a row is at least ROW_BYTES long as json, so more rows are larger than a cache entry
+        if generation is not None and len(rows) * self.ROW_BYTES <= self.result_cache.max_entry_bytes:
+            self.result_cache.put(key, generation, json.dumps(rows))
+        return rows
+
+
+    # Same as __cached_result for the rows yielded by read. Rows are serialized while they are yielded, until
+    # they are more than a cache entry holds, the rest of the rows are streamed without being kept
+    def __iter_cached_rows(self, arguments, channel_id, stream_id, read):
+        key = json.dumps(arguments)
+        generation = self.__result_generation(channel_id, stream_id)
+        text = self.result_cache.get(key, generation) if generation is not None else None
+        if text is not None:
+            yield from json.loads(text)
+            return
+
+        texts = [] if generation is not None else None
+        size = 2
+        for row in read():
+            yield row
+            if texts is not None:
+                texts.append(json.dumps(row, default=dict))
+                size += len(texts[-1]) + 1
+                if size > self.result_cache.max_entry_bytes:
+                    texts = None
+
+        if texts is not None:
+            self.result_cache.put(key, generation, '[' + ','.join(texts) + ']')
+
+
+    # Returns [(window start offset, messages, viewers)] of a stream from chat_windows, a row per window
+    def __rollup_viewer_metrics(self, conditions, window_seconds):
+        counts = self.db_handler.select_from_database('chat_windows', ['window', 'messages', 'chatters'], \
+            conditions + [QueryBuilder.condition('window_seconds', 'eq', window_seconds)])
+
+        counts = dict([(row['window'], row) for row in counts])
+        metrics = []
+        for window in range(max(counts) + 1 if counts else 0):
+            row = counts.get(window, {'messages': 0, 'chatters': 0})
+            metrics.append((window * window_seconds, row['messages'], row['chatters']))
+        return metrics
+
+
+    # Returns [(window start offset, messages, viewers)] of a stream counted from its chat_log rows.
+    # The offsets and user ids are loaded in pages of columns and counted by ViewerMetrics, with numpy
+    # when it is installed. It is only imported here, importing numpy doubles the start time of twitch.py
+    def __chatlog_viewer_metrics(self, conditions, window_seconds, exact):
+        from models.viewer_metrics import ViewerMetrics
+        metrics = ViewerMetrics(window_seconds, exact)
+        for offsets, users in self.db_handler.iter_select_columns('chat_rows', ['offset', 'user_id'], conditions, \
+            page_size=settings.VIEWERSHIP_PAGE_SIZE):
+            metrics.add(offsets, users)
+        return metrics.metrics()
@@ -3,13 +3,37 @@ import sqlite3
 conn = sqlite3.connect('twitch.db')
 c = conn.cursor()
 
-c.execute("drop table if exists chat_log")
+# chat_log is a view of chat_rows from schema version 7 on, a table before
+c.execute("select type from sqlite_master where name = 'chat_log'")
+row = c.fetchone()
+c.execute("drop {} if exists chat_log".format(row[0] if row else 'table'))
 print("dropped chat_log")
 
+for table in ['chat_rows', 'users', 'messages']:
+    c.execute("drop table if exists " + table)
+print("dropped chat log rows, users and messages")
+
 c.execute("drop table if exists top_spam")
 print("dropped top_spam")
 
 c.execute("drop table if exists channels")
 print("channels dropped")
 
+for table in ['spam_streams', 'spam_counts', 'spam_users', 'spam_sketches']:
+    c.execute("drop table if exists " + table)
+print("dropped spam counters")
+
+for table in ['chat_windows', 'chat_minute_users', 'chat_texts']:
+    c.execute("drop table if exists " + table)
+print("dropped chat log rollups")
+
+c.execute("drop table if exists result_generations")
+print("dropped result generations")
+
+c.execute("drop table if exists chat_search")
+print("dropped chat log search index")
+
+# migrations are applied again on the next set up
+c.execute("PRAGMA user_version = 0")
+
 conn.close()
\ No newline at end of file
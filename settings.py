@@ -1,21 +1,135 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 
+# Records at LOG_LEVEL and above are written to LOG_FILE. Per row and per statement messages are DEBUG,
+# set TWITCH_LOG_LEVEL=DEBUG to see them
+LOG_LEVEL = os.environ.get('TWITCH_LOG_LEVEL', 'INFO').upper()
+LOG_FILE = './logs/std_logs.log'
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%m-%d %H:%M',
-                    filename='./logs/std_logs.log',
-                    filemode='a')
+# Loggers put their records on a queue, a listener thread writes them to the file, so the threads
+# logging never wait on the disk. The records left are written when the process exits
+log_queue = queue.SimpleQueue()
+log_file_handler = logging.FileHandler(LOG_FILE, 'a')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M'))
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler)
+# the records are queued with their message only, the file handler formats the line
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 
 db_logger = logging.getLogger('db_model')
 chatlog_logger = logging.getLogger('chatlog_model')
 twitch_logger = logging.getLogger('twitch_model')
 channel_logger = logging.getLogger('channel_logger')
+server_logger = logging.getLogger('twitch_server')
 
 TOP_SPAM_THRESHOLD = 10
 
+# Number of chat_log rows buffered before they are written to the database
+CHATLOG_INSERT_BATCH_SIZE = 10000
+
+# Number of ids of users, and of texts, kept in memory while storing chat_log rows so the dictionary
+# tables are only read for the values missing from them
+DICTIONARY_CACHE_ENTRIES = 200000
+
+# Number of rows written by a single executemany in DbHandler.insert_multiple_values
+INSERT_CHUNK_SIZE = 5000
+
+# Number of prepared statements each SQLite connection keeps for reuse
+SQLITE_STATEMENT_CACHE_SIZE = 256
+
+# Number of rows read per page by DbHandler.iter_select_from_database
+SELECT_PAGE_SIZE = 1000
+
+# Number of best ranked messages returned by the searchchatlog command when --limit is not given
+SEARCH_LIMIT = 100
+
+# Distinct users of a message are counted with HyperLogLog sketches of 2 ** HLL_PRECISION one byte
+# registers unless exact counts are asked for, the standard error is about 1.04 / sqrt(2 ** HLL_PRECISION)
+HLL_PRECISION = 14
+
+# Whether parsetopspam and ingest count distinct users exactly, --exact and --approx override it for a
+# command. Exact by default so the output matches validation_output
+EXACT_USER_COUNTS = True
+
+# Number of comments monitored by parsetopspam --top-k when no number is given, counts are
+# overestimated by at most (number of comments) / TOP_K_CAPACITY
+TOP_K_CAPACITY = 1000
+
+# parsetopspam --fingerprint groups near duplicate comments: texts are normalized, then compared by
+# MinHash signatures of FINGERPRINT_BINS bins indexed in bands of FINGERPRINT_BAND_ROWS bins, and
+# grouped when the estimated Jaccard similarity of their 3-grams is at least FINGERPRINT_SIMILARITY
+FINGERPRINT_BINS = 16
+FINGERPRINT_BAND_ROWS = 4
+FINGERPRINT_SIMILARITY = 0.8
+
+# Windows of content_offset_seconds the viewership command counts messages and chatters in, by name.
+# VIEWERSHIP_WINDOW is used when --window is not given
+VIEWERSHIP_WINDOWS = {'10s': 10, '1m': 60, '5m': 300}
+VIEWERSHIP_WINDOW = '1m'
+
+# Windows whose messages and chatters are kept in the chat_windows rollup as comments are stored, so the
+# viewership command reads a row per window. They must be whole minutes, run rebuildrollups after changing them.
+# Other windows are counted from chat_log
+VIEWERSHIP_ROLLUP_WINDOWS = ['1m', '5m']
+
+# Number of processes ingestbatch reads and counts chatlog files with, --workers overrides it.
+# The files are stored by a single process
+INGEST_WORKERS = min(os.cpu_count() or 1, 4)
+
+# Number of (offset, user) rows loaded at a time by Twitch.get_viewer_metrics
+VIEWERSHIP_PAGE_SIZE = 100000
+
 # Build database paths
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 DATABASE_NAME = 'twitch.db'
+
+# SQLite pragmas applied by DbHandler to every connection it opens. The profile can be picked
+# with the TWITCH_SQLITE_PROFILE environment variable or the --sqlite-profile option of twitch.py
+#  - default: WAL so readers are not blocked by ingest, fsync only at checkpoints
+#  - bulk-load: no fsync and a large cache, for backfills that can be rerun if the machine crashes
+#  - read-heavy: large cache and memory mapped reads for query commands
+#  - durable: fsync on every commit
+SQLITE_PROFILES = {
+    'default': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -64000,
+                'mmap_size': 268435456, 'temp_store': 'MEMORY'},
+    'bulk-load': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -512000,
+                  'mmap_size': 1073741824, 'temp_store': 'MEMORY'},
+    'read-heavy': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -256000,
+                   'mmap_size': 4294967296, 'temp_store': 'MEMORY'},
+    'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'cache_size': -16000,
+                'mmap_size': 0, 'temp_store': 'DEFAULT'},
+}
+
+SQLITE_PROFILE = os.environ.get('TWITCH_SQLITE_PROFILE', 'default')
+
+# Unix socket `twitch.py serve` listens on and `twitch.py --server` forwards commands to, --socket overrides it
+SERVER_SOCKET = os.environ.get('TWITCH_SERVER_SOCKET', './twitch.sock')
+
+# Number of threads of `twitch.py serve` running commands, each keeping its own database connection.
+# Commands writing to the database are run one at a time
+SERVER_WORKERS = 4
+
+# Number of characters of command output the server buffers before sending them to the client
+SERVER_OUTPUT_BUFFER_SIZE = 65536
+
+# Results of gettopspam, gettopspam2, querychatlog and viewership are cached by Twitch, see ResultCache.
+# Up to RESULT_CACHE_BYTES of json text is kept in memory, results larger than RESULT_CACHE_ENTRY_BYTES
+# are not cached. With RESULT_CACHE_FILE results are also kept in that SQLite file, up to
+# RESULT_CACHE_FILE_BYTES, so they are reused by the next runs of twitch.py
+RESULT_CACHE_BYTES = 32 * 1024 * 1024
+RESULT_CACHE_ENTRY_BYTES = 4 * 1024 * 1024
+RESULT_CACHE_FILE = os.environ.get('TWITCH_RESULT_CACHE_FILE')
+RESULT_CACHE_FILE_BYTES = 256 * 1024 * 1024
+
+# Chatlogs parsed by Twitch.parse_chatlog kept loaded, see ChatLogRegistry. Up to CHATLOG_REGISTRY_ENTRIES
+# chatlogs and CHATLOG_REGISTRY_BYTES of their compacted comments are kept, the least recently used are
+# parsed again from their file when they are needed
+CHATLOG_REGISTRY_ENTRIES = 16
+CHATLOG_REGISTRY_BYTES = 256 * 1024 * 1024
@@ -0,0 +1,61 @@
+import unittest
+import json
+import os
+import tempfile
+from models.chatlog import ChatLog
+from models.chatlog_registry import ChatLogRegistry
+
+class TestChatLogRegistry(unittest.TestCase):
+
+
+    def test_get(self):
+
+        registry = ChatLogRegistry()
+        with self.assertRaises(KeyError):
+            registry['tests/test_files/test_comment.json']
+
+        registry.add(ChatLog('tests/test_files/test_comment.json'))
+        self.assertIn('tests/test_files/test_comment.json', registry)
+        self.assertEqual(list(registry.keys()), ['tests/test_files/test_comment.json'])
+
+        # chatlogs are kept compacted
+        chatlog = registry['tests/test_files/test_comment.json']
+        self.assertEqual(chatlog.get_chatlog(), None)
+        self.assertEqual([comment.user for comment in chatlog.comments()], ['seaskythe'])
+        self.assertEqual(registry.stats(), {'chatlogs': 1, 'bytes': chatlog.size, 'hits': 1, 'misses': 0, 'evictions': 0})
+
+    def test_eviction(self):
+
+        directory = tempfile.mkdtemp()
+        with open('tests/test_files/test_comment.json') as file:
+            export = json.load(file)
+        filenames = []
+        for index in range(3):
+            filenames.append(os.path.join(directory, '{}.json'.format(index)))
+            with open(filenames[-1], 'w') as file:
+                json.dump(export, file)
+
+        # the least recently used chatlogs are evicted
+        registry = ChatLogRegistry(max_entries=2)
+        for filename in filenames:
+            registry.add(ChatLog(filename))
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.evictions, 1)
+
+        # and parsed again when they are needed
+        chatlog = registry[filenames[0]]
+        self.assertEqual([comment.user for comment in chatlog.comments()], ['seaskythe'])
+        self.assertEqual((registry.hits, registry.misses, registry.evictions), (0, 1, 2))
+        self.assertIs(registry[filenames[0]], chatlog)
+
+        # a single chatlog larger than max_bytes is kept until another one is added
+        registry = ChatLogRegistry(max_bytes=1)
+        registry.add(ChatLog(filenames[0]))
+        self.assertEqual(len(registry), 1)
+        registry.add(ChatLog(filenames[1], stream=True))
+        self.assertEqual(registry.stats(), {'chatlogs': 1, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 1})
+        self.assertEqual(len(list(registry[filenames[1]].comments())), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
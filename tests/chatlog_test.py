@@ -1,8 +1,15 @@
 import unittest
 import sqlite3
+import json
+import io
+import os
+import tempfile
+import pickle
+from array import array
 from models.channel import Channel
 from models.twitch_model import Twitch
-from models.chatlog import ChatLog
+from models.chatlog import ChatLog, CommentStreamReader
+from models.hyperloglog import HyperLogLog
 
 class TestChatlog(unittest.TestCase):
 
@@ -25,5 +32,101 @@ class TestChatlog(unittest.TestCase):
         with self.assertRaises(KeyError):
             chatlog.count_comments()
 
+        # users can be counted by a sketch instead of a set
+        chatlog = ChatLog('tests/test_files/test_comment.json')
+        [(count, users, channel_id, stream_id)] = chatlog.count_comments(exact=False).values()
+        self.assertIsInstance(users, HyperLogLog)
+        self.assertEqual((count, len(users)), (1, 1))
+
+        # top comments carry the error of their count
+        outcome = {'PLEASE BE A FAIR MATCH, to get more hours of tokens': (1, {'seaskythe'}, '137512364', '451603129', 0)}
+        self.assertEqual(chatlog.count_top_comments(10), outcome)
+
+    def test_compact(self):
+
+        chatlog = ChatLog('tests/test_files/test_comment.json')
+        comments = list(chatlog.comments())
+        self.assertIs(chatlog.compact(), chatlog)
+        self.assertEqual(chatlog.get_chatlog(), None)
+        self.assertEqual(list(chatlog.comments()), comments)
+        self.assertGreater(chatlog.size, 0)
+
+        # repeated strings are kept once
+        with open('tests/test_files/test_comment.json') as file:
+            export = json.load(file)
+        export['comments'] = export['comments'] * 2
+        filename = os.path.join(tempfile.mkdtemp(), 'repeated.json')
+        with open(filename, 'w') as file:
+            json.dump(export, file)
+        chatlog = ChatLog(filename).compact()
+        self.assertEqual(len(list(chatlog.comments())), 2)
+        self.assertIs(chatlog.columns.users[0], chatlog.columns.users[1])
+
+        # comments can be read into columns without loading the export
+        chatlog = ChatLog(filename, columnar=True)
+        self.assertEqual(chatlog.get_chatlog(), None)
+        self.assertEqual(list(chatlog.comments()), comments * 2)
+
+        # columns are pickled to ingestbatch workers
+        columns = pickle.loads(pickle.dumps(chatlog.columns))
+        self.assertEqual(list(columns), comments * 2)
+        self.assertIsInstance(columns.offsets, array)
+
+        # a corrupt export is read from its file like a streamed one
+        chatlog = ChatLog('tests/test_files/test_corrupt_comment.json').compact()
+        self.assertTrue(chatlog.stream)
+        with self.assertRaises(KeyError):
+            chatlog.count_comments()
+
+    def test_stream_count_comments(self):
+
+        with self.assertRaises(FileNotFoundError):
+            chatlog = ChatLog('notjson.json', stream=True)
+
+        chatlog = ChatLog('tests/test_files/test_comment.json', stream=True)
+        outcome = {'PLEASE BE A FAIR MATCH, to get more hours of tokens': (1, {'seaskythe'}, '137512364', '451603129')}
+        self.assertEqual(chatlog.get_chatlog(), None)
+        self.assertEqual(chatlog.count_comments(), outcome)
+        self.assertEqual(chatlog.get_stream_ids(), ('137512364', '451603129'))
+
+        chatlog = ChatLog('tests/test_files/test_corrupt_comment.json', stream=True)
+        with self.assertRaises(KeyError):
+            chatlog.count_comments()
+
+        chatlog = ChatLog('tests/test_files/not_valid_json.json', stream=True)
+        with self.assertRaises(json.JSONDecodeError):
+            chatlog.count_comments()
+
+    def test_count_fingerprints(self):
+        with open('tests/test_files/test_comment.json') as file:
+            comment = json.load(file)['comments'][0]
+
+        # near duplicates are counted under their most repeated body
+        comments = []
+        for user, body in [('user1', 'KEKW KEKW'), ('user2', 'kekw  KEKW'), ('user1', 'kekw  KEKW'), ('user3', 'gg wp')]:
+            comments.append(json.loads(json.dumps(comment)))
+            comments[-1]['commenter']['display_name'] = user
+            comments[-1]['message']['body'] = body
+
+        filename = os.path.join(tempfile.mkdtemp(), 'fingerprints.json')
+        with open(filename, 'w') as file:
+            json.dump({'comments': comments}, file)
+
+        outcome = {'kekw  KEKW': (3, {'user1', 'user2'}, '137512364', '451603129'), \
+            'gg wp': (1, {'user3'}, '137512364', '451603129')}
+        self.assertEqual(ChatLog(filename, stream=True).count_fingerprints(), outcome)
+
+    def test_stream_reader(self):
+        # the reader must give the same comments as json.load whatever the chunk size
+        with open('tests/test_files/test_comment.json') as file:
+            comments = json.load(file)['comments']
+
+        for chunk_size in [1, 7, 4096]:
+            with open('tests/test_files/test_comment.json') as file:
+                self.assertEqual(list(CommentStreamReader(file, chunk_size)), comments)
+
+        with self.assertRaises(KeyError):
+            list(CommentStreamReader(io.StringIO('{"_next": 12.5}')))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,9 @@
 import unittest
 import sqlite3
-from models.db_model import DbHandler
+import json
+import os
+import tempfile
+from models.db_model import DbHandler, QueryBuilder
 
 class MyTestCase(unittest.TestCase):
 
@@ -53,6 +56,199 @@ class MyTestCase(unittest.TestCase):
         #asseriting equal
         self.assertEqual(test_outcome, out)
 
+    def test_multiple_insert_fallback(self):
+
+        # a chunk with a failing row is retried row by row so only that row is lost
+        channels = [[20, 'test'], [21, 'test'], [20, 'duplicate'], [22, 'test']]
+        self.assertEqual(self.db_handler.insert_multiple_values('channels', channels), 1)
+
+        test_outcome = [{'channel_id': 20, 'channel_name': 'test'}, {'channel_id': 21, 'channel_name': 'test'},\
+                        {'channel_id': 22, 'channel_name': 'test'}]
+        self.assertEqual(self.db_handler.select_from_database('channels', ['*'], \
+            ['channel_id gteq 20', 'channel_id lteq 22']), test_outcome)
+
+        self.db_handler.delete_from_database('channels', conditions=['channel_id gteq 20', 'channel_id lteq 22'])
+
+    def test_schema_migrations(self):
+
+        self.assertEqual(self.db_handler.get_schema_version(), len(DbHandler.SCHEMA_MIGRATIONS))
+
+        # an existing database without indexes is upgraded in place
+        database_name = os.path.join(tempfile.mkdtemp(), 'old.db')
+        connection = sqlite3.connect(database_name)
+        connection.execute("CREATE TABLE chat_log (channel_id integer NOT NULL, stream_id integer NOT NULL, \
+            text string, user string, chat_time datetime, offset int)")
+        connection.execute("INSERT INTO chat_log VALUES(1, 2, 'text', 'user', '2019-07-12T04:17:23Z', 1)")
+        connection.commit()
+        connection.close()
+
+        self.db_handler.database_name = database_name
+        try:
+            self.db_handler.set_up_twitch_db()
+            self.assertEqual(self.db_handler.get_schema_version(), len(DbHandler.SCHEMA_MIGRATIONS))
+
+            indexes = self.db_handler.select_from_database('sqlite_master', ['name'], ["tbl_name eq 'chat_rows'", \
+                "type eq 'index'"])
+            self.assertIn({'name': 'chat_rows_stream_time'}, indexes)
+            self.assertNotIn({'name': 'chat_rows_stream_offset'}, indexes)
+            # its rows are dictionary encoded, and read the same through the chat_log view
+            self.assertEqual(self.db_handler.select_from_database('chat_rows', ['text_id', 'user_id']), \
+                [{'text_id': 1, 'user_id': 1}])
+            self.assertEqual(self.db_handler.select_from_database('chat_log'), [{'channel_id': 1, 'stream_id': 2, \
+                'text': 'text', 'user': 'user', 'chat_time': '2019-07-12T04:17:23Z', 'offset': 1}])
+            # and so are its rollups
+            self.assertEqual(self.db_handler.select_from_database('chat_texts', ['text_id', 'messages']), \
+                [{'text_id': 1, 'messages': 1}])
+            self.assertEqual(self.db_handler.select_from_database('chat_minute_users', ['minute', 'user_id']), \
+                [{'minute': 0, 'user_id': 1}])
+            # and its texts are indexed for search
+            self.assertEqual(self.db_handler.select_from_database('chat_search', ['rowid'], ['chat_search match text']), \
+                [{'rowid': 1}])
+        finally:
+            self.db_handler.database_name = 'twitch.db'
+
+    def test_sqlite_profile(self):
+
+        # the pragmas of the profile are applied to the open connection
+        self.db_handler.set_sqlite_profile('durable')
+        sqlite_settings = self.db_handler.get_sqlite_settings()
+        self.assertEqual(sqlite_settings['journal_mode'], 'wal')
+        self.assertEqual(sqlite_settings['synchronous'], 2)
+
+        self.db_handler.set_sqlite_profile('default')
+        self.assertEqual(self.db_handler.get_sqlite_settings()['synchronous'], 1)
+
+        with self.assertRaises(ValueError):
+            self.db_handler.set_sqlite_profile('fake_profile')
+
+    def test_query_builder(self):
+
+        # values are bound as parameters, never written into the statement
+        query, parameters, invalid = QueryBuilder.select('channels', ['*'], \
+            ['channel_id gt 1', "channel_name like 'it''s a test'", 'channel_name 12'])
+        self.assertEqual(query, 'SELECT * FROM channels WHERE channel_id > ? AND channel_name like ?')
+        self.assertEqual(parameters, ('1', "it's a test"))
+        self.assertEqual(invalid, 1)
+
+        # values may contain spaces
+        self.assertEqual(QueryBuilder.parse_condition('channel_name eq test channel'), ('channel_name', '=', 'test channel'))
+        self.assertEqual(QueryBuilder.parse_condition('channel_name is test'), None)
+        self.assertEqual(QueryBuilder.parse_condition('1=1; eq 1'), None)
+        self.assertEqual(QueryBuilder.parse_condition('chat_texts.stream_id eq 1'), ('chat_texts.stream_id', '=', '1'))
+        self.assertEqual(QueryBuilder.parse_condition('a.b.c eq 1'), None)
+
+        query, parameters, invalid = QueryBuilder.select('chat_search', ['rowid'], ['chat_search match good game'], \
+            'AND', 'rank', '', '', 10)
+        self.assertEqual(query, 'SELECT rowid FROM chat_search WHERE chat_search MATCH ? ORDER BY rank  LIMIT ?')
+        self.assertEqual(parameters, ('good game', 10))
+
+        self.db_handler.insert_values("channels", [30, "test channel's name"])
+        self.assertEqual(self.db_handler.select_from_database('channels', ['*'], ["channel_name eq test channel's name"]),\
+            [{'channel_id': 30, 'channel_name': "test channel's name"}])
+        self.db_handler.delete_from_database('channels', conditions=['channel_id eq 30'])
+
+    def test_iter_select_and_select_page(self):
+
+        channels = [[40 + index, 'test'] for index in range(5)]
+        self.db_handler.insert_multiple_values('channels', channels)
+        conditions = ['channel_id gteq 40', 'channel_id lt 45']
+        test_outcome = self.db_handler.select_from_database('channels', ['*'], conditions, order_by='channel_id')
+
+        # rows are streamed in the same order as select_from_database returns them
+        rows = self.db_handler.iter_select_from_database('channels', ['*'], conditions, order_by='channel_id', page_size=2)
+        self.assertEqual(list(rows), test_outcome)
+
+        # keyset pagination returns every row once across pages
+        pages = []
+        rows, next_key = self.db_handler.select_page('channels', ['*'], conditions, key_columns=['channel_id'], page_size=2)
+        pages.append(rows)
+        while next_key is not None:
+            rows, next_key = self.db_handler.select_page('channels', ['*'], conditions, key_columns=['channel_id'], \
+                after_key=next_key, page_size=2)
+            pages.append(rows)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        # page rows also hold the key columns
+        self.assertEqual([dict(row) for page in pages for row in page], [dict(row) for row in test_outcome])
+
+        # the chat_log view has no rowid, it is paged on its own columns
+        self.db_handler.insert_multiple_values('chat_log', [[50, 51, 'hi', 'a', '', offset] for offset in range(3)])
+        stream_conditions = ['stream_id eq 51']
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.db_handler.select_page('chat_log', ['offset'], stream_conditions, page_size=2)
+        rows, next_key = self.db_handler.select_page('chat_log', ['user'], stream_conditions, key_columns=['offset'], page_size=2)
+        self.assertEqual(next_key, (1,))
+        rows += self.db_handler.select_page('chat_log', ['user'], stream_conditions, key_columns=['offset'], after_key=next_key, \
+            page_size=2)[0]
+        self.assertEqual([(row['user'], row['offset']) for row in rows], [('a', 0), ('a', 1), ('a', 2)])
+        self.db_handler.delete_from_database('chat_rows', conditions=stream_conditions)
+
+        # columns are loaded a page at a time
+        pages = self.db_handler.iter_select_columns('channels', ['channel_id', 'channel_name'], conditions, \
+            order_by='channel_id', page_size=3)
+        self.assertEqual(list(pages), [((40, 41, 42), ('test',) * 3), ((43, 44), ('test',) * 2)])
+        with self.assertRaises(sqlite3.DatabaseError):
+            list(self.db_handler.iter_select_columns('channels', ['*']))
+
+        self.db_handler.delete_from_database('channels', conditions=conditions)
+
+    def test_insert_from_select(self):
+
+        self.db_handler.insert_multiple_values('chat_log', [[80, 81, 'hi', 'a', '', 1], [80, 81, 'hi', 'b', '', 2], \
+            [80, 81, 'bye', 'a', '', 3]])
+        self.assertEqual(self.db_handler.insert_from_select('chat_texts', 'chat_rows', ['channel_id', 'stream_id', 'text_id', \
+            'COUNT(*)'], ['channel_id eq 80', 'stream_id eq 81'], 'AND', 'text_id'), 2)
+
+        test_outcome = [{'text': 'bye', 'messages': 1}, {'text': 'hi', 'messages': 2}]
+        self.assertEqual(self.db_handler.select_from_database('chat_texts JOIN messages USING (text_id)', ['text', \
+            'chat_texts.messages AS messages'], ['channel_id eq 80'], order_by='text'), test_outcome)
+
+        for table_name in ['chat_log', 'chat_texts']:
+            self.db_handler.delete_from_database(table_name, ['channel_id eq 80'])
+
+    def test_select_by_values(self):
+
+        # rows come with the value they were found by, "123" is stored as 123 by the numeric affinity of spam_text
+        self.db_handler.insert_multiple_values('spam_counts', [[80, 81, 'hi', 1], [80, 81, '123', 2], [80, 82, 'hi', 3]])
+        rows = self.db_handler.select_by_values('spam_counts', 'spam_text', ['hi', '123', 'missing'], \
+            ['spam_text', 'spam_occurrences'], ['channel_id eq 80', 'stream_id eq 81'])
+        self.assertEqual(sorted([tuple(row) for row in rows]), [('123', 123, 2), ('hi', 'hi', 1)])
+        self.assertEqual(self.db_handler.select_by_values('spam_counts', 'spam_text', [], ['spam_text']), [])
+
+        self.db_handler.delete_from_database('spam_counts', ['channel_id eq 80'])
+
+    def test_upsert(self):
+
+        # rows with an existing key add to the existing values, new keys are inserted
+        self.db_handler.insert_values('spam_counts', [60, 61, 'spam', 2])
+        self.db_handler.upsert_multiple_values('spam_counts', [[60, 61, 'spam', 3], [60, 61, "it's spam", 1]], \
+            ['channel_id', 'stream_id', 'spam_text'], ['spam_occurrences'])
+        # without columns to add existing rows are left unchanged
+        self.db_handler.upsert_multiple_values('spam_counts', [[60, 61, 'spam', 10]], ['channel_id', 'stream_id', 'spam_text'])
+
+        test_outcome = [{'spam_text': "it's spam", 'spam_occurrences': 1}, {'spam_text': 'spam', 'spam_occurrences': 5}]
+        self.assertEqual(self.db_handler.select_from_database('spam_counts', ['spam_text', 'spam_occurrences'], \
+            ['channel_id eq 60'], order_by='spam_text'), test_outcome)
+
+        # quoted conditions are read back as is
+        condition = QueryBuilder.condition('spam_text', 'eq', "it's spam")
+        self.assertEqual(QueryBuilder.parse_condition(condition), ('spam_text', '=', "it's spam"))
+        self.assertEqual(len(self.db_handler.select_from_database('spam_counts', ['*'], [condition])), 1)
+
+        self.db_handler.delete_from_database('spam_counts', conditions=['channel_id eq 60'])
+
+    def test_row(self):
+
+        self.db_handler.insert_values("channels", [50, 'test'])
+        [row] = self.db_handler.select_from_database('channels', ['channel_id AS id', 'channel_name'], ['channel_id eq 50'])
+
+        # rows are read by name or index, compare equal to dicts and are converted to json as objects
+        self.assertEqual((row['id'], row[1]), (50, 'test'))
+        self.assertEqual(row, {'id': 50, 'channel_name': 'test'})
+        self.assertNotEqual(row, {'id': 50})
+        self.assertEqual(json.dumps(row, default=dict), '{"id": 50, "channel_name": "test"}')
+
+        self.db_handler.delete_from_database('channels', conditions=['channel_id eq 50'])
+
     def select_from_databse(self):
 
         # inserts the values into the database succesfully
@@ -93,6 +289,50 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(self.db_handler.select_from_database('channels', ['*'], ['channel_id eq 6']) \
                          , test_outcome)
 
+    def test_transaction(self):
+
+        # writes in a transaction are committed together
+        with self.db_handler.transaction():
+            self.db_handler.insert_values("channels", [7, 'test'])
+            self.db_handler.insert_values("channels", [8, 'test'])
+
+        test_outcome = [{'channel_id': 7, "channel_name": 'test'}, {'channel_id': 8, "channel_name": 'test'}]
+        self.assertEqual(self.db_handler.select_from_database('channels', ['*'], \
+            ['channel_id gteq 7', 'channel_id lteq 8']), test_outcome)
+
+        # writes in a failed transaction are all rolled back
+        with self.assertRaises(sqlite3.DatabaseError):
+            with self.db_handler.transaction():
+                self.db_handler.insert_values("channels", [9, 'test'])
+                self.db_handler.insert_values("channels", [7, 'test'])
+
+        self.assertEqual(self.db_handler.select_from_database('channels', ['*'], ['channel_id eq 9']), [])
+
+        self.db_handler.delete_from_database('channels', conditions=['channel_id gteq 7', 'channel_id lteq 8'])
+
+    def test_dictionary_values(self):
+
+        # values are given an id once, whichever call adds them
+        ids = self.db_handler.insert_dictionary_values('users', 'user_id', 'user', ['dictionary_a', "dictionary_'b"])
+        self.assertEqual(sorted(ids), ["dictionary_'b", 'dictionary_a'])
+        self.assertEqual(self.db_handler.insert_dictionary_values('users', 'user_id', 'user', \
+            ['dictionary_a', 'dictionary_c']), {'dictionary_a': ids['dictionary_a'], 'dictionary_c': ids['dictionary_a'] + 2})
+        self.assertEqual(self.db_handler.insert_dictionary_values('users', 'user_id', 'user', []), {})
+        self.db_handler.delete_from_database('users', ['user like dictionary_%'])
+
+        # callbacks run once the transaction commits, and are dropped if it rolls back
+        calls = []
+        with self.db_handler.transaction():
+            self.db_handler.after_commit(lambda: calls.append('committed'))
+            self.assertEqual(calls, [])
+        with self.assertRaises(sqlite3.DatabaseError):
+            with self.db_handler.transaction():
+                self.db_handler.after_commit(lambda: calls.append('rolled back'), lambda: calls.append('rollback'))
+                self.db_handler.insert_values("channels", [9, 'test'])
+                self.db_handler.insert_values("channels", [9, 'test'])
+        self.db_handler.after_commit(lambda: calls.append('outside'), lambda: calls.append('never'))
+        self.assertEqual(calls, ['committed', 'rollback', 'outside'])
+
 
 if __name__ == '__main__':
     unittest.main()
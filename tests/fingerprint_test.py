@@ -0,0 +1,39 @@
+import unittest
+from models.fingerprint import normalize, signature, similarity, SpamFingerprinter
+
+class TestFingerprint(unittest.TestCase):
+
+
+    def test_normalize(self):
+
+        self.assertEqual(normalize('KEKW KEKW'), 'kekw')
+        self.assertEqual(normalize(' kekw  KEKW\t'), 'kekw')
+        self.assertEqual(normalize('LOOOOOL'), 'lool')
+        self.assertEqual(normalize('Pog LUL Pog LUL Pog'), 'pog lul')
+        self.assertEqual(normalize('PogChamp PogChamp wow'), 'pogchamp wow')
+        self.assertEqual(normalize('gg wp'), 'gg wp')
+        self.assertEqual(normalize(''), '')
+
+    def test_similarity(self):
+
+        text = 'PLEASE BE A FAIR MATCH, to get more hours of tokens'
+        self.assertEqual(similarity(signature(text), signature(text)), 1.0)
+        self.assertGreater(similarity(signature(text), signature(text + '!')), 0.7)
+        self.assertLess(similarity(signature(text), signature('what a play by the support')), 0.3)
+
+    def test_cluster(self):
+
+        fingerprinter = SpamFingerprinter()
+        clusters = [fingerprinter.cluster(body) for body in ['KEKW KEKW', 'kekw  KEKW', \
+            'PLEASE BE A FAIR MATCH, to get more hours of tokens', 'please be a fair match, to get more hours of tokens!!', \
+            'what a play by the support', 'KEKW KEKW']]
+
+        self.assertEqual(clusters, [0, 0, 1, 1, 2, 0])
+        self.assertEqual(len(fingerprinter), 3)
+
+        with self.assertRaises(ValueError):
+            SpamFingerprinter(bins=16, band_rows=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import sqlite3
+from models.hyperloglog import HyperLogLog, ApproxCountDistinct
+
+class TestHyperLogLog(unittest.TestCase):
+
+
+    def test_instanciation(self):
+
+        with self.assertRaises(ValueError):
+            HyperLogLog(3)
+        with self.assertRaises(ValueError):
+            HyperLogLog(19)
+
+        self.assertEqual(len(HyperLogLog()), 0)
+
+    def test_count(self):
+
+        # small cardinalities are counted exactly
+        sketch = HyperLogLog(14)
+        for user in ['user1', 'user2', 'user2', 'user3']:
+            sketch.add(user)
+        self.assertEqual(len(sketch), 3)
+
+        # large ones within a few standard errors (1.04 / sqrt(2 ** 12) = 1.6%)
+        sketch = HyperLogLog(12)
+        for index in range(20000):
+            sketch.add('viewer{}'.format(index))
+            sketch.add('viewer{}'.format(index))
+        self.assertAlmostEqual(sketch.count() / 20000, 1, delta=0.05)
+
+    def test_merge_and_bytes(self):
+
+        first = HyperLogLog(10)
+        second = HyperLogLog(10)
+        union = HyperLogLog(10)
+        for index in range(3000):
+            (first if index % 2 else second).add(index)
+            union.add(index)
+
+        # sparse and dense sketches are read back as they were written
+        for sketch in [HyperLogLog(10), first]:
+            self.assertEqual(HyperLogLog.from_bytes(sketch.to_bytes()).count(), sketch.count())
+
+        # merging gives the sketch of the union
+        self.assertEqual(first.merge(second).count(), union.count())
+
+        with self.assertRaises(ValueError):
+            first.merge(HyperLogLog(11))
+
+    def test_aggregate(self):
+
+        connection = sqlite3.connect(':memory:')
+        connection.create_aggregate('approx_count_distinct', 1, ApproxCountDistinct)
+        connection.execute('CREATE TABLE chat_log (text string, user string)')
+        connection.executemany('INSERT INTO chat_log VALUES(?,?)', [('a', 'user1'), ('a', 'user2'), ('a', 'user1'), \
+            ('b', 'user1'), ('b', None)])
+
+        self.assertEqual(connection.execute('SELECT text, approx_count_distinct(user) FROM chat_log GROUP BY text').fetchall(), \
+            [('a', 2), ('b', 1)])
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import os
+import tempfile
+from models.result_cache import ResultCache
+
+class TestResultCache(unittest.TestCase):
+
+
+    def test_get(self):
+
+        cache = ResultCache(filename=None)
+        self.assertIsNone(cache.get('key', 1))
+        cache.put('key', 1, '[1]')
+        self.assertEqual(cache.get('key', 1), '[1]')
+
+        # results are only returned for the generation they were read in
+        self.assertIsNone(cache.get('key', 2))
+        cache.put('key', 2, '[2]')
+        self.assertEqual(cache.get('key', 2), '[2]')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        cache.clear()
+        self.assertIsNone(cache.get('key', 2))
+
+    def test_eviction(self):
+
+        # results larger than an entry are not kept
+        cache = ResultCache(max_bytes=10, max_entry_bytes=4, filename=None)
+        cache.put('large', 1, '[1, 2]')
+        self.assertIsNone(cache.get('large', 1))
+
+        # the least recently used results are evicted first
+        for key in ['a', 'b', 'c']:
+            cache.put(key, 1, '[{}]'.format(len(key)))
+        cache.get('a', 1)
+        cache.put('d', 1, '[4]')
+        self.assertEqual([key for key in ['a', 'b', 'c', 'd'] if cache.get(key, 1)], ['a', 'c', 'd'])
+
+    def test_file(self):
+
+        filename = os.path.join(tempfile.mkdtemp(), 'results.db')
+        cache = ResultCache(filename=filename)
+        cache.put('key', 1, '[1]')
+
+        # results are read from the file by the next runs
+        cache = ResultCache(filename=filename)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('key', 1), '[1]')
+        self.assertIsNone(cache.get('key', 2))
+
+        # the oldest half is evicted once the file holds too much
+        cache = ResultCache(filename=filename, max_file_bytes=10)
+        for key in ['a', 'b', 'c', 'd']:
+            cache.put(key, 1, '[{}]'.format(len(key)))
+        cache = ResultCache(filename=filename)
+        self.assertEqual([key for key in ['key', 'a', 'b', 'c', 'd'] if cache.get(key, 1)], ['c', 'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
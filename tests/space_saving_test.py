@@ -0,0 +1,62 @@
+import unittest
+from collections import Counter
+from models.space_saving import SpaceSaving
+
+class TestSpaceSaving(unittest.TestCase):
+
+
+    def test_instanciation(self):
+
+        with self.assertRaises(ValueError):
+            SpaceSaving(0)
+
+        self.assertEqual(len(SpaceSaving(3)), 0)
+        self.assertEqual(SpaceSaving(3).min_count(), 0)
+
+    def test_exact_below_capacity(self):
+
+        top_items = SpaceSaving(3)
+        for item in ['a', 'b', 'a', 'c', 'a', 'b']:
+            top_items.add(item)
+
+        self.assertEqual(top_items.items(), [('a', 3, 0, None), ('b', 2, 0, None), ('c', 1, 0, None)])
+
+    def test_error_bounds(self):
+
+        # a few heavy hitters among many items seen once
+        stream = []
+        for index in range(2000):
+            stream.append('unique {}'.format(index))
+            if index % 4 == 0:
+                stream.append('spam')
+            if index % 10 == 0:
+                stream.append('other spam')
+        counts = Counter(stream)
+
+        top_items = SpaceSaving(20)
+        for item in stream:
+            top_items.add(item)
+
+        self.assertEqual(len(top_items), 20)
+        for item, count, error, payload in top_items.items():
+            self.assertTrue(count - error <= counts[item] <= count)
+
+        # items above n / capacity are kept, the others occur at most min_count times
+        self.assertEqual([item for item, count, error, payload in top_items.items()[:2]], ['spam', 'other spam'])
+        self.assertTrue(max([count for item, count in counts.items() if item not in top_items.entries]) <= \
+            top_items.min_count() <= len(stream) / 20)
+
+    def test_payload(self):
+
+        # the payload of an item is kept until the item is replaced
+        top_items = SpaceSaving(1, set)
+        top_items.add('a').add('user1')
+        top_items.add('a').add('user2')
+        self.assertEqual(top_items.items(), [('a', 2, 0, {'user1', 'user2'})])
+
+        top_items.add('b').add('user3')
+        self.assertEqual(top_items.items(), [('b', 3, 2, {'user3'})])
+
+
+if __name__ == '__main__':
+    unittest.main()
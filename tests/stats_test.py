@@ -0,0 +1,81 @@
+import unittest
+import os
+import threading
+from models.chatlog import ChatLog
+from models.stats import Stats
+from models.twitch_model import Twitch
+
+class TestStats(unittest.TestCase):
+
+
+    def test_collect(self):
+
+        # nothing is recorded outside of collect
+        Stats.count('rows')
+        Stats.add_time('stage', 1.0)
+        self.assertEqual(Stats.current(), None)
+
+        with Stats.collect() as stats:
+            self.assertIs(Stats.current(), stats)
+            Stats.count('rows')
+            Stats.count('rows', 2)
+            Stats.add_time('stage', 0.5)
+            Stats.add_time('stage', 0.25)
+
+            # nested collects record apart
+            with Stats.collect() as inner_stats:
+                Stats.count('rows')
+            self.assertIs(Stats.current(), stats)
+        self.assertEqual(Stats.current(), None)
+
+        summary = stats.summary()
+        self.assertEqual(summary['counters'], {'rows': 3})
+        self.assertEqual(summary['timers'], {'stage': {'calls': 2, 'seconds': 0.75}})
+        self.assertGreaterEqual(summary['seconds'], 0)
+        self.assertEqual(inner_stats.summary()['counters'], {'rows': 1})
+
+    def test_threads(self):
+
+        # other threads do not record into the stats of this one
+        with Stats.collect() as stats:
+            thread = threading.Thread(target=Stats.count, args=('rows',))
+            thread.start()
+            thread.join()
+        self.assertEqual(stats.summary()['counters'], {})
+
+    def test_timed(self):
+
+        @Stats.timed('add')
+        def add(a, b):
+            if a is None:
+                raise ValueError('a')
+            return a + b
+
+        self.assertEqual(add(1, 2), 3)
+        with Stats.collect() as stats:
+            self.assertEqual(add(1, 2), 3)
+            with self.assertRaises(ValueError):
+                add(None, 2)
+        self.assertEqual(stats.summary()['timers']['add']['calls'], 2)
+
+    def test_instrumentation(self):
+
+        db_handler = Twitch().db_handler
+        with Stats.collect() as stats:
+            comments = list(ChatLog('tests/test_files/test_comment.json', stream=True).comments())
+            db_handler.insert_multiple_values('chat_log', comments)
+            rows = list(db_handler.iter_select_from_database('chat_log', ['*'], ['stream_id eq 451603129']))
+            db_handler.delete_from_database('chat_rows', ['stream_id eq 451603129'])
+
+        summary = stats.summary()
+        self.assertEqual(summary['counters']['comments_parsed'], 1)
+        self.assertEqual(summary['counters']['bytes_read'], os.path.getsize('tests/test_files/test_comment.json'))
+        self.assertEqual(summary['counters']['rows_inserted'], 1)
+        self.assertEqual(summary['counters']['rows_selected'], len(rows))
+        self.assertEqual(summary['counters']['rows_deleted'], len(rows))
+        for timer in ['sql.insert', 'sql.select', 'sql.delete', 'sql.commit']:
+            self.assertGreaterEqual(summary['timers'][timer]['calls'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 import unittest
 import sqlite3
 import json
+import os
+import tempfile
+import time
 from models.twitch_model import Twitch
 from models.chatlog import ChatLog
+from models.stats import Stats
 
 class TestTwitch(unittest.TestCase):
 
@@ -88,6 +92,13 @@ class TestTwitch(unittest.TestCase):
         comments = self.twitch.process_comments(filename)
         self.assertEqual(self.twitch.insert_top_spam(comments, 0), 1)
 
+        # top k comments are only inserted when their count minus its error is above the threshold
+        comments = self.twitch.process_comments(filename, True, top_k=5)
+        self.assertEqual(comments[0][1][4], 0)
+        self.assertEqual(self.twitch.insert_top_spam(comments, 0), 1)
+        comments = [('uncertain spam', (5, {'user'}, '137512364', '451603129', 3))]
+        self.assertEqual(self.twitch.insert_top_spam(comments, 2), 0)
+        self.twitch.delete_top_spam('137512364', '451603129')
 
 
     def test_get_top_spam(self):
@@ -121,6 +132,378 @@ class TestTwitch(unittest.TestCase):
 
         self.assertEqual(self.twitch.insert_chatlog(filename), [23894, 0, '451603129', '137512364'])
 
+    def test_ingest_chatlog(self):
+        filename = 'tests/test_files/test_comment.json'
+
+        with self.assertRaises(KeyError):
+            self.twitch.ingest_chatlog('fakename')
+
+        # stores the chatlog and its top spam in a single pass
+        self.twitch.parse_chatlog(filename, stream=True)
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.twitch.delete_top_spam('137512364', '451603129')
+        self.assertEqual(self.twitch.ingest_chatlog(filename, 0), [1, 0, '451603129', '137512364', 1])
+
+        test_outcome = [{'spam_text': 'PLEASE BE A FAIR MATCH, to get more hours of tokens', 'occurrences': 1, 'user_count': 1}]
+        self.assertEqual(self.twitch.get_top_spam('137512364', '451603129'), test_outcome)
+
+        # filters may contain spaces
+        result = self.twitch.query_chatlog(['stream_id eq 451603129', \
+            'text eq PLEASE BE A FAIR MATCH, to get more hours of tokens'])
+        self.assertEqual([row['user'] for row in result], ['seaskythe'])
+
+        # the rollups are kept up to date as the comments are stored
+        self.assertEqual(self.twitch.get_top_spam2('137512364', '451603129', 0), test_outcome)
+        self.assertEqual(self.twitch.get_viewer_metrics('137512364', '451603129')[0]['per_minute'][-1]['viewers'], 1)
+        self.twitch.parse_chatlog(filename, stream=True)
+        self.twitch.insert_chatlog(filename)
+        test_outcome = [{'spam_text': 'PLEASE BE A FAIR MATCH, to get more hours of tokens', 'occurrences': 2, 'user_count': 1}]
+        self.assertEqual(self.twitch.get_top_spam2('137512364', '451603129', 0), test_outcome)
+        self.assertEqual(self.twitch.get_top_spam2('137512364', '451603129', 1), test_outcome)
+        self.assertEqual(self.twitch.get_top_spam2('137512364', '451603129', 2), [])
+        self.assertEqual(self.twitch.get_viewer_metrics('137512364', '451603129', window='1m')[0]['per_minute'][-1], \
+            {'offset': 1, 'viewers': 1, 'messages': 2})
+        self.assertEqual(self.twitch.get_viewer_metrics('137512364', '451603129', window='5m')[0]['per_window'][-1], \
+            {'offset': 0, 'viewers': 1, 'messages': 2})
+
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.assertEqual(self.twitch.get_top_spam2('137512364', '451603129', 0), [])
+
+    def test_iter_ingest_chatlogs(self):
+        filenames = ['tests/test_files/test_comment.json', 'tests/test_files/not_valid_json.json', \
+            'tests/test_files/test_corrupt_comment.json', 'tests/test_files/missing.json', 'tests/test_files/test_comment.json']
+
+        # files are stored in order, the ones that can not be read are reported
+        ingest_stats = list(self.twitch.iter_ingest_chatlogs(filenames, 2, 0))
+        self.assertEqual([ingest_stat[0] for ingest_stat in ingest_stats], filenames)
+        self.assertEqual(ingest_stats[0][1:6], [1, 0, '451603129', '137512364', 1])
+        self.assertEqual(ingest_stats[4][1:6], [1, 0, '451603129', '137512364', 1])
+        for ingest_stat in ingest_stats[1:4]:
+            self.assertEqual(ingest_stat[1:6], [0, 0, None, None, 0])
+        self.assertEqual([ingest_stat[8] and ingest_stat[8].split(':')[0] for ingest_stat in ingest_stats], \
+            [None, 'JSONDecodeError', 'KeyError', 'FileNotFoundError', None])
+
+        # the second file replaced the rows of the first one
+        test_outcome = [{'spam_text': 'PLEASE BE A FAIR MATCH, to get more hours of tokens', 'occurrences': 1, 'user_count': 1}]
+        self.assertEqual(self.twitch.get_top_spam2('137512364', '451603129', 0), test_outcome)
+        self.assertEqual(len(self.twitch.get_top_spam('137512364', '451603129')), 1)
+
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.twitch.delete_top_spam('137512364', '451603129')
+
+    def test_update_top_spam(self):
+        with open('tests/test_files/test_comment.json') as file:
+            comment = json.load(file)['comments'][0]
+        other_user = json.loads(json.dumps(comment))
+        other_user['commenter']['display_name'] = 'other_user'
+
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'live.json')
+
+        with self.assertRaises(KeyError):
+            self.twitch.update_top_spam('fakename')
+
+        self.twitch.delete_top_spam('137512364', '451603129')
+        with open(filename, 'w') as file:
+            json.dump({'comments': [comment]}, file)
+        self.twitch.parse_chatlog(filename, stream=True)
+        self.assertEqual(self.twitch.update_top_spam(filename, 1), [1, 0, '451603129', '137512364'])
+        self.assertEqual(self.twitch.get_top_spam('137512364', '451603129'), [])
+
+        # only the appended comments are counted
+        with open(filename, 'w') as file:
+            json.dump({'comments': [comment, comment, other_user]}, file)
+        self.assertEqual(self.twitch.update_top_spam(filename, 1), [2, 1, '451603129', '137512364'])
+        test_outcome = [{'spam_text': 'PLEASE BE A FAIR MATCH, to get more hours of tokens', 'occurrences': 3, 'user_count': 2}]
+        self.assertEqual(self.twitch.get_top_spam('137512364', '451603129'), test_outcome)
+        self.assertEqual(self.twitch.update_top_spam(filename, 1), [0, 0, '451603129', '137512364'])
+
+        # a shorter export is counted from the start
+        with open(filename, 'w') as file:
+            json.dump({'comments': [comment, other_user]}, file)
+        self.assertEqual(self.twitch.update_top_spam(filename, 1), [2, 1, '451603129', '137512364'])
+        test_outcome = [{'spam_text': 'PLEASE BE A FAIR MATCH, to get more hours of tokens', 'occurrences': 2, 'user_count': 2}]
+        self.assertEqual(self.twitch.get_top_spam('137512364', '451603129'), test_outcome)
+
+        # with sketches the stream is counted again, then the stored sketches are merged with the new users
+        self.assertEqual(self.twitch.update_top_spam(filename, 1, exact=False), [2, 1, '451603129', '137512364'])
+        with open(filename, 'w') as file:
+            json.dump({'comments': [comment, other_user, comment]}, file)
+        self.assertEqual(self.twitch.update_top_spam(filename, 1, exact=False), [1, 1, '451603129', '137512364'])
+        test_outcome = [{'spam_text': 'PLEASE BE A FAIR MATCH, to get more hours of tokens', 'occurrences': 3, 'user_count': 2}]
+        self.assertEqual(self.twitch.get_top_spam('137512364', '451603129'), test_outcome)
+
+        self.twitch.delete_top_spam('137512364', '451603129')
+
+
+    def test_get_viewer_metrics(self):
+
+        with self.assertRaises(ValueError):
+            self.twitch.get_viewer_metrics('70', '71', window='2m')
+        self.assertEqual(self.twitch.get_viewer_metrics('70', '71'), [])
+
+        # messages are counted by content offset, windows without messages are kept
+        rows = [[70, 71, 'hi', 'a', '2019-07-12T04:00:05.000Z', 5.5], [70, 71, 'hi', 'b', '2019-07-12T04:00:00.000Z', 0.25], \
+            [70, 71, 'hi', 'a', '2019-07-12T04:00:59.000Z', 59.9], [70, 71, 'hi', 'c', '2019-07-12T04:02:10.000Z', 130]]
+        self.twitch.db_handler.insert_multiple_values('chat_log', rows)
+        # rows inserted without the rollups are only counted once they are rebuilt
+        self.assertEqual(self.twitch.get_viewer_metrics('70', '71'), [])
+        self.assertEqual(self.twitch.rebuild_rollups('70', '71'), 1)
+
+        # 1m windows are numbered minutes, as viewership printed them before it had other windows
+        test_outcome = [{'channel_id': '70', 'stream_id': '71', 'starttime': '2019-07-12T04:00:00.000Z', \
+            'per_minute': [{'offset': 1, 'viewers': 2, 'messages': 3}, {'offset': 2, 'viewers': 0, 'messages': 0}, \
+            {'offset': 3, 'viewers': 1, 'messages': 1}]}]
+        self.assertEqual(self.twitch.get_viewer_metrics('70', '71'), test_outcome)
+        self.assertEqual(self.twitch.get_viewer_metrics('70', '71', exact=False), test_outcome)
+
+        metrics = self.twitch.get_viewer_metrics('70', '71', window='10s')[0]
+        self.assertEqual(metrics['window'], '10s')
+        per_window = metrics['per_window']
+        self.assertEqual(len(per_window), 14)
+        self.assertEqual(per_window[0], {'offset': 0, 'viewers': 2, 'messages': 2})
+        self.assertEqual(per_window[5], {'offset': 50, 'viewers': 1, 'messages': 1})
+
+        per_window = self.twitch.get_viewer_metrics('70', '71', window='5m')[0]['per_window']
+        self.assertEqual(per_window, [{'offset': 0, 'viewers': 3, 'messages': 4}])
+
+        self.twitch.delete_chatlog('70', '71')
+        self.assertEqual(self.twitch.get_viewer_metrics('70', '71'), [])
+
+    def test_result_cache(self):
+        filename = 'tests/test_files/test_comment.json'
+        filters = ['stream_id eq 451603129']
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.twitch.delete_top_spam('137512364', '451603129')
+        cache = self.twitch.result_cache
+        cache.clear()
+
+        # results are cached once Twitch wrote the stream
+        self.assertEqual(self.twitch.query_chatlog(filters), [])
+        hits = cache.hits
+        self.assertEqual(self.twitch.query_chatlog(filters), [])
+        self.assertEqual(list(self.twitch.iter_query_chatlog(filters)), [])
+        self.assertEqual(cache.hits, hits + 2)
+
+        # and read again once it writes the stream again
+        self.twitch.parse_chatlog(filename)
+        self.twitch.insert_chatlog(filename)
+        rows = self.twitch.query_chatlog(filters)
+        self.assertEqual([row['user'] for row in rows], ['seaskythe'])
+        self.assertEqual(list(self.twitch.iter_query_chatlog(filters)), rows)
+        self.assertEqual(list(self.twitch.iter_query_chatlog(filters)), rows)
+
+        # so are results of filters on other columns, which may read any stream
+        self.assertEqual(len(self.twitch.query_chatlog(['user eq seaskythe'])), 1)
+        self.assertEqual(self.twitch.get_top_spam('137512364', '451603129'), [])
+        self.twitch.insert_top_spam(self.twitch.process_comments(filename), 0)
+        self.assertEqual(len(self.twitch.get_top_spam('137512364', '451603129')), 1)
+
+        # results larger than a cache entry are read every time
+        max_entry_bytes = cache.max_entry_bytes
+        cache.max_entry_bytes = len(json.dumps(rows)) - 1
+        try:
+            cache.clear()
+            hits = cache.hits
+            for query in range(2):
+                self.assertEqual(self.twitch.query_chatlog(filters), rows)
+                self.assertEqual([dict(row) for row in self.twitch.iter_query_chatlog(filters)], rows)
+            self.assertEqual((len(cache), cache.hits), (0, hits))
+        finally:
+            cache.max_entry_bytes = max_entry_bytes
+
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.assertEqual(self.twitch.query_chatlog(['user eq seaskythe']), [])
+        self.assertEqual(list(self.twitch.iter_query_chatlog(filters)), [])
+        self.twitch.delete_top_spam('137512364', '451603129')
+        self.assertEqual(self.twitch.get_top_spam('137512364', '451603129'), [])
+
+    def test_upgrade_database(self):
+
+        # a database of the first schema, its chat_log columns being "string"
+        rows = []
+        for row in range(20000):
+            text = 'spam {}'.format(row % 20) if row % 2 else 'unique message {}'.format(row)
+            user = '42' if row % 100 == 0 else 'viewer{}'.format(row % 500)
+            rows.append((1, 2, '123' if user == '42' else text, user, '2019-07-12T04:00:00.000Z', row // 10))
+        database_name = os.path.join(tempfile.mkdtemp(), 'old.db')
+        connection = sqlite3.connect(database_name)
+        connection.execute("CREATE TABLE chat_log (channel_id integer NOT NULL, stream_id integer NOT NULL, \
+            text string, user string, chat_time datetime, offset int)")
+        connection.executemany("INSERT INTO chat_log VALUES (?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+        connection.close()
+
+        db_handler = self.twitch.db_handler
+        previous_database_name = db_handler.database_name
+        db_handler.database_name = database_name
+        try:
+            # its texts and users are looked up by index, scanning them for every row took minutes
+            start = time.perf_counter()
+            db_handler.set_up_twitch_db()
+            self.assertLess(time.perf_counter() - start, 10)
+
+            self.assertEqual(db_handler.select_from_database('chat_rows', ['COUNT(*) AS count', \
+                'COUNT(text_id) AS texts', 'COUNT(user_id) AS users']), [{'count': 20000, 'texts': 20000, 'users': 20000}])
+            self.assertEqual(db_handler.select_from_database('messages', ['COUNT(*) AS count']), \
+                [{'count': len(set([row[2] for row in rows]))}])
+            self.assertEqual(db_handler.select_from_database('users', ['COUNT(*) AS count']), \
+                [{'count': len(set([row[3] for row in rows]))}])
+
+            occurrences, users = {}, {}
+            for row in rows:
+                occurrences[row[2]] = occurrences.get(row[2], 0) + 1
+                users.setdefault(row[2], set()).add(row[3])
+            spam = [(text, occurrences[text], len(users[text])) for text in occurrences]
+            spam = sorted([item for item in spam if item[1] > 1], key=lambda item: (-item[1], -item[2], item[0]))
+            self.assertEqual([(row['spam_text'], row['occurrences'], row['user_count']) for row in \
+                self.twitch.get_top_spam2('1', '2', 1)], spam)
+            self.assertEqual(self.twitch.query_chatlog(['stream_id eq 2', 'user eq 42'])[:2], [{'channel_id': 1, \
+                'stream_id': 2, 'text': '123', 'user': '42', 'chat_time': '2019-07-12T04:00:00.000Z', 'offset': 0}, \
+                {'channel_id': 1, 'stream_id': 2, 'text': '123', 'user': '42', 'chat_time': '2019-07-12T04:00:00.000Z', \
+                'offset': 10}])
+        finally:
+            db_handler.database_name = previous_database_name
+
+    def test_query_chatlog_page(self):
+
+        with self.assertRaises(TypeError):
+            self.twitch.query_chatlog_page(['not a filter'])
+
+        # rows of the same chat time are told apart by their rowid
+        rows = [[90, 91, 'message {}'.format(offset), 'user {}'.format(offset % 2), '2019-07-12T04:00:0{}.000Z'\
+            .format(offset // 2), offset] for offset in range(5)]
+        self.twitch.db_handler.insert_multiple_values('chat_log', rows)
+        filters = ['channel_id eq 90', 'stream_id eq 91']
+
+        pages = []
+        page, after = self.twitch.query_chatlog_page(filters, limit=2)
+        pages.append(page)
+        while after is not None:
+            page, after = self.twitch.query_chatlog_page(filters, after, 2)
+            pages.append(page)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        # pages hold the columns of chat_log
+        self.assertEqual([page_row for page in pages for page_row in page], self.twitch.query_chatlog(filters))
+        self.assertEqual([list(row.values()) for page in pages for row in page], rows)
+
+        # the key of a page is kept by the next pages of the same filters
+        page, after = self.twitch.query_chatlog_page(filters + ['user eq user 1'], limit=1)
+        self.assertEqual([row['offset'] for row in page], [1])
+        self.assertEqual([row['offset'] for row in self.twitch.query_chatlog_page(filters + ['user eq user 1'], after)[0]], [3])
+        self.twitch.delete_chatlog('90', '91')
+
+    def test_search_chatlog(self):
+
+        with self.assertRaises(ValueError):
+            self.twitch.search_chatlog('good) OR (game')
+        with self.assertRaises(ValueError):
+            self.twitch.search_chatlog('unknown_column : game')
+
+        rows = [[80, 81, 'good game well played', 'a', '2019-07-12T04:00:00.000Z', 1], \
+            [80, 81, 'what a game', 'b', '2019-07-12T04:00:01.000Z', 2], \
+            [80, 81, 'Good luck (gl)', 'c', '2019-07-12T04:00:02.000Z', 3], \
+            [80, 82, 'good game', 'd', '2019-07-12T04:00:03.000Z', 4]]
+        # rows inserted through the chat_log view are indexed with their text, and found once their rollups are rebuilt
+        self.twitch.db_handler.insert_multiple_values('chat_log', rows)
+        self.assertEqual(self.twitch.search_chatlog('game'), [])
+        self.assertEqual(self.twitch.rebuild_rollups('80', '81') + self.twitch.rebuild_rollups('80', '82'), 2)
+
+        # ranked best first, limited to a stream
+        found = self.twitch.search_chatlog('game', '80', '81')
+        self.assertEqual([row['user'] for row in found], ['b', 'a'])
+        self.assertLess(found[0]['rank'], found[1]['rank'])
+        self.assertEqual(found[1]['text'], 'good game well played')
+        self.assertEqual(len(self.twitch.search_chatlog('game')), 3)
+        self.assertEqual(len(self.twitch.search_chatlog('game', limit=1)), 1)
+
+        # phrases, prefixes and boolean queries
+        self.assertEqual([row['user'] for row in self.twitch.search_chatlog('"good game"', stream_id='81')], ['a'])
+        self.assertEqual([row['user'] for row in self.twitch.search_chatlog('goo* NOT game', '80')], ['c'])
+        self.assertEqual([row['user'] for row in self.twitch.search_chatlog('(gl OR played) AND good', '80', '81')], \
+            ['c', 'a'])
+        self.assertEqual([row['user'] for row in self.twitch.search_chatlog('"(gl"', '80', '81')], ['c'])
+
+        # a stream alone reads the rows of the matching texts by their stream and text, not every row of the stream
+        connection = sqlite3.connect(self.twitch.db_handler.database_name)
+        plan = connection.execute('EXPLAIN QUERY PLAN SELECT * FROM ' + Twitch.SEARCH_JOIN + \
+            ' WHERE chat_search MATCH ? AND chat_texts.stream_id = ?', ['game', 81]).fetchall()
+        connection.close()
+        details = ' '.join([row[3] for row in plan])
+        self.assertIn('chat_rows_stream_text', details)
+        self.assertNotIn('chat_rows_stream_user', details)
+
+        # deleted rows are not found any more
+        self.twitch.delete_chatlog('80', '81')
+        self.assertEqual([row['user'] for row in self.twitch.search_chatlog('game')], ['d'])
+        self.twitch.delete_chatlog('80', '82')
+        self.assertEqual(self.twitch.search_chatlog('game'), [])
+
+        # stored chatlogs are indexed as they are stored
+        filename = 'tests/test_files/test_comment.json'
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.twitch.parse_chatlog(filename, stream=True)
+        self.twitch.insert_chatlog(filename)
+        self.assertEqual([row['user'] for row in self.twitch.search_chatlog('fair match', '137512364')], ['seaskythe'])
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.assertEqual(self.twitch.search_chatlog('fair match', '137512364'), [])
+
+    # Writes a chatlog of the test comment with every body of bodies, by user or by users[body], returns its filename
+    def write_chatlog(self, bodies, user='seaskythe', users={}):
+        with open('tests/test_files/test_comment.json') as file:
+            chatlog = json.load(file)
+        comment = chatlog['comments'][0]
+        chatlog['comments'] = [dict(comment, content_offset_seconds=offset, message={'body': body}, \
+            commenter=dict(comment['commenter'], display_name=users.get(body, user))) for offset, body in enumerate(bodies)]
+        filename = os.path.join(tempfile.mkdtemp(), 'chatlog.json')
+        with open(filename, 'w') as file:
+            json.dump(chatlog, file)
+        self.twitch.parse_chatlog(filename, stream=True)
+        return filename
+
+    def test_numeric_texts(self):
+
+        # messages and users that look like numbers are stored and read back as they were written
+        filename = self.write_chatlog(['1', '2', '1', '123', '1.00'], users={'123': '42'})
+        self.twitch.delete_chatlog('137512364', '451603129')
+        self.twitch.insert_chatlog(filename)
+        rows = self.twitch.query_chatlog(['stream_id eq 451603129'])
+        self.assertEqual([(row['text'], row['user']) for row in sorted(rows, key=lambda row: row['offset'])], \
+            [('1', 'seaskythe'), ('2', 'seaskythe'), ('1', 'seaskythe'), ('123', '42'), ('1.00', 'seaskythe')])
+        self.assertEqual([row['offset'] for row in self.twitch.query_chatlog(['stream_id eq 451603129', 'user eq 42'])], [3])
+        self.assertEqual([(row['text'], row['user']) for row in self.twitch.search_chatlog('123', '137512364')], \
+            [('123', '42')])
+        self.assertEqual(sorted([row['offset'] for row in self.twitch.search_chatlog('1', '137512364')]), [0, 2, 4])
+        self.twitch.delete_chatlog('137512364', '451603129')
+
+    def test_dictionary_ids(self):
+        filename = self.write_chatlog(['dictionary message', 'dictionary message'], user='dictionary user')
+        self.twitch.delete_chatlog('137512364', '451603129')
+
+        # ids read by a transaction are reused before it commits, and kept once it does
+        with self.twitch.db_handler.transaction():
+            self.twitch.insert_chatlog(filename)
+            with Stats.collect() as stats:
+                self.twitch.insert_chatlog(filename)
+        self.assertEqual(stats.summary()['counters']['dictionary_ids.hits'], 2)
+        self.assertEqual(stats.summary()['counters']['dictionary_ids.misses'], 0)
+        with Stats.collect() as stats:
+            self.twitch.insert_chatlog(filename)
+        self.assertEqual(stats.summary()['counters']['dictionary_ids.misses'], 0)
+        self.twitch.delete_chatlog('137512364', '451603129')
+
+        # ids read by a transaction that rolls back are dropped, the next new message may be given the same id
+        rolled_back = self.write_chatlog(['rolled back message'])
+        with self.assertRaises(ZeroDivisionError):
+            with self.twitch.db_handler.transaction():
+                self.twitch.insert_chatlog(rolled_back)
+                1 / 0
+        self.twitch.insert_chatlog(self.write_chatlog(['stored message']))
+        self.twitch.insert_chatlog(rolled_back)
+        self.assertEqual(sorted([row['text'] for row in self.twitch.query_chatlog(['stream_id eq 451603129'])]), \
+            ['rolled back message', 'stored message'])
+        self.twitch.delete_chatlog('137512364', '451603129')
+
 
 if __name__ == '__main__':
     unittest.main()
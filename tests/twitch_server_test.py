@@ -0,0 +1,152 @@
+import unittest
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import settings
+from models.twitch_model import Twitch
+from twitch import run_command
+from twitch_helper import create_argument_parser, forward
+from twitch_server import TwitchServer
+
+class TestTwitchServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.twitch = Twitch()
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'twitch.sock')
+        self.server = TwitchServer(lambda command, out: run_command(self.twitch, command, out), \
+            create_argument_parser(), self.socket_path, 2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.server.ready.wait(10)
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.stop()
+        self.thread.join(10)
+
+    # returns (exit code, output, errors) of a command run by the server
+    def forward(self, argv):
+        out = io.StringIO()
+        err = io.StringIO()
+        exit_code = forward(argv, self.socket_path, out, err)
+        return exit_code, out.getvalue(), err.getvalue()
+
+    # returns the output of a command run in this process
+    def run_locally(self, argv):
+        out = io.StringIO()
+        run_command(self.twitch, create_argument_parser().parse_args(argv), out)
+        return out.getvalue()
+
+    def test_commands(self):
+        self.assertEqual(self.forward(['createchannel', 'server_channel', '4321']), (0, "(4321, 'server_channel')\n", ''))
+        self.assertEqual(self.forward(['gettopspam', '4321', '8765']), (0, '[]\n', ''))
+
+        # files are found relative to the directory of the client
+        self.assertEqual(self.forward(['storechatlog', 'tests/test_files/test_comment.json']), \
+            (0, 'inserted 1 records to chat log for stream 451603129 on channel 137512364\n', ''))
+
+        argv = ['querychatlog', 'stream_id eq 451603129', '--jsonl']
+        self.assertEqual(self.forward(argv), (0, self.run_locally(argv), ''))
+
+        # so are the files of a directory, every file is reported as it is stored
+        exit_code, output, errors = self.forward(['ingestbatch', 'tests/test_files', '--workers', '1'])
+        lines = output.splitlines()
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(len(lines), 4)
+        self.assertIn('not_valid_json.json: failed, JSONDecodeError', lines[0])
+        self.assertIn('test_comment.json: inserted 1 records to chat log and 0 top spam records', lines[1])
+        self.assertIn('test_corrupt_comment.json: failed, KeyError', lines[2])
+        self.assertTrue(lines[3].startswith('ingested 1 files, 2 failed, 1 records'))
+        self.twitch.delete_chatlog('137512364', '451603129')
+
+    def test_streamed_output(self):
+        rows = [[60, 61, 'message {}'.format(index), 'user', '2019-07-12T04:00:00.000Z', index] for index in range(500)]
+        self.twitch.db_handler.insert_multiple_values('chat_log', rows)
+
+        # the output is sent in several pieces
+        buffer_size = settings.SERVER_OUTPUT_BUFFER_SIZE
+        settings.SERVER_OUTPUT_BUFFER_SIZE = 1000
+        try:
+            argv = ['querychatlog', 'stream_id eq 61']
+            exit_code, output, errors = self.forward(argv)
+        finally:
+            settings.SERVER_OUTPUT_BUFFER_SIZE = buffer_size
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(output, self.run_locally(argv))
+        self.assertGreater(len(output), 10000)
+        self.twitch.delete_chatlog('60', '61')
+
+    def test_querychatlog_pages(self):
+        rows = [[62, 63, 'message {}'.format(index), 'user', '2019-07-12T04:00:00.000Z', index] for index in range(50)]
+        self.twitch.db_handler.insert_multiple_values('chat_log', rows)
+        argv = ['querychatlog', 'channel_id eq 62', 'stream_id eq 63']
+
+        # pages are printed with the key of the next one, until it is null
+        page_rows = []
+        page = json.loads(self.run_locally(argv + ['--limit', '20']))
+        page_rows += page['rows']
+        while page['after'] is not None:
+            page = json.loads(self.forward(argv + ['--limit', '20', '--after', json.dumps(page['after'])])[1])
+            page_rows += page['rows']
+        self.assertEqual(page_rows, json.loads(self.run_locally(argv)))
+        self.assertEqual(self.forward(argv + ['--after', '["2019-07-12T04:00:00.000Z", 1]'])[0], 1)
+        self.twitch.delete_chatlog('62', '63')
+
+    def test_stats(self):
+        exit_code, output, errors = self.forward(['--stats', 'storechatlog', 'tests/test_files/test_comment.json'])
+        self.assertEqual(exit_code, 0)
+        stats = json.loads(errors)
+        self.assertEqual(stats['counters']['comments_parsed'], 1)
+        # the chat_rows row, and its user and text unless they were stored before
+        self.assertIn(stats['counters']['rows_inserted'], [1, 2, 3])
+        self.assertEqual(stats['timers']['store_comments']['calls'], 1)
+
+        # commands are not profiled by the server
+        self.assertEqual(self.forward(['--profile', 'twitch.prof', 'gettopspam', '4321', '8765'])[0], 2)
+        self.twitch.delete_chatlog('137512364', '451603129')
+
+    def test_errors(self):
+        exit_code, output, errors = self.forward(['querychatlog', 'not a filter'])
+        self.assertEqual((exit_code, output), (1, ''))
+        self.assertIn('TypeError', errors)
+
+        self.assertEqual(self.forward(['gettopspam', '1'])[0], 2)
+        self.assertEqual(self.forward(['serve'])[0], 2)
+        self.assertEqual(self.forward([])[0], 2)
+        self.assertEqual(self.forward(['--sqlite-profile', 'durable', 'gettopspam', '1', '2'])[0], 2)
+
+        # the server still answers
+        self.assertEqual(self.forward(['gettopspam', '4321', '8765']), (0, '[]\n', ''))
+
+    def test_socket(self):
+        # a socket still accepting clients is not replaced
+        server = TwitchServer(None, None, self.socket_path)
+        with self.assertRaises(OSError):
+            server.serve_forever()
+
+        # a socket left by a stopped server is
+        socket_path = os.path.join(tempfile.mkdtemp(), 'stale.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(socket_path)
+        server = TwitchServer(lambda command, out: run_command(self.twitch, command, out), create_argument_parser(), \
+            socket_path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.assertTrue(server.ready.wait(10))
+        self.assertEqual(forward(['gettopspam', '4321', '8765'], socket_path, io.StringIO(), io.StringIO()), 0)
+        server.stop()
+        thread.join(10)
+        self.assertFalse(os.path.exists(socket_path))
+
+        err = io.StringIO()
+        self.assertEqual(forward(['gettopspam', '4321', '8765'], socket_path, io.StringIO(), err), 1)
+        self.assertIn('No server is listening', err.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import random
+from models import viewer_metrics
+from models.viewer_metrics import ViewerMetrics
+
+class TestViewerMetrics(unittest.TestCase):
+
+
+    def test_instanciation(self):
+
+        with self.assertRaises(ValueError):
+            ViewerMetrics(0)
+
+        metrics = ViewerMetrics(60)
+        self.assertEqual(len(metrics), 0)
+        self.assertEqual(metrics.metrics(), [])
+
+    def test_windows(self):
+
+        for use_numpy in [True, False]:
+            metrics = ViewerMetrics(10, use_numpy=use_numpy)
+            metrics.add((0, 9.99, 10, 35.5), ('a', 'b', 'a', 'a'))
+            metrics.add((), ())
+            metrics.add((3, 12), ('a', 'c'))
+
+            self.assertEqual(len(metrics), 6)
+            self.assertEqual(metrics.metrics(), [(0, 3, 2), (10, 2, 2), (20, 0, 0), (30, 1, 1)])
+
+    @unittest.skipIf(viewer_metrics.numpy is None, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+
+        generator = random.Random(0)
+        offsets = [round(generator.uniform(0, 3600), 3) for index in range(20000)]
+        users = ['viewer{}'.format(generator.randrange(3000)) for index in range(20000)]
+
+        results = []
+        for use_numpy in [True, False]:
+            metrics = ViewerMetrics(60, use_numpy=use_numpy)
+            # pages are merged past MERGED_PAGES pages
+            for start in range(0, len(offsets), 1000):
+                metrics.add(offsets[start:start + 1000], users[start:start + 1000])
+            results.append(metrics.metrics())
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(sum([messages for offset, messages, viewers in results[0]]), 20000)
+
+    def test_sketches(self):
+
+        offsets = [index % 120 for index in range(10000)]
+        users = ['viewer{}'.format(index) for index in range(10000)]
+
+        exact = ViewerMetrics(60)
+        exact.add(offsets, users)
+        sketches = ViewerMetrics(60, exact=False)
+        sketches.add(offsets, users)
+
+        for (offset, messages, viewers), (sketch_offset, sketch_messages, sketch_viewers) \
+            in zip(exact.metrics(), sketches.metrics()):
+            self.assertEqual((offset, messages), (sketch_offset, sketch_messages))
+            self.assertAlmostEqual(sketch_viewers / viewers, 1, delta=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
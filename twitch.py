@@ -1,8 +1,9 @@
 import json
 import sys
 import sqlite3
-from twitch_helper import create_argument_parser
-from models.twitch_model import Twitch
+import time
+import settings
+from twitch_helper import create_argument_parser, expand_chatlog_paths, forward
 
 
 def main():
@@ -11,50 +12,198 @@ def main():
     argument_parser = create_argument_parser()
     parser = argument_parser.parse_args()
 
+    # the command is run by the server, this process does not load the models or open the database
+    if parser.server:
+        sys.exit(forward(sys.argv[1:], parser.socket))
+
+    from models.twitch_model import Twitch
     try:
         twitch = Twitch()
     except TypeError as e:
         # Already instantiated
         twitch = Twitch.getInstance()
 
+    if parser.sqlite_profile:
+        twitch.db_handler.set_sqlite_profile(parser.sqlite_profile)
+
+    if parser.sub == 'serve':
+        from twitch_server import TwitchServer
+        TwitchServer(lambda command, out: run_command(twitch, command, out), argument_parser, parser.socket, \
+            parser.workers).serve_forever()
+    elif parser.profile:
+        run_profiled(twitch, parser)
+    elif parser.stats:
+        from models.stats import Stats
+        with Stats.collect() as stats:
+            try:
+                run_command(twitch, parser, sys.stdout)
+            finally:
+                print(json.dumps(stats.summary()), file=sys.stderr)
+    else:
+        run_command(twitch, parser, sys.stdout)
+
+
+# Runs the command of parsed arguments under --profiler, writing the profile to --profile. cProfile writes
+# pstats data (python -m pstats FILE), pyinstrument an html report. Stats are still printed with --stats
+def run_profiled(twitch, parser):
+    from models.stats import Stats
+    if parser.profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            sys.exit('pyinstrument is not installed, use --profiler cprofile or pip install pyinstrument')
+        profiler = Profiler()
+        profiler.start()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    with Stats.collect() as stats:
+        try:
+            run_command(twitch, parser, sys.stdout)
+        finally:
+            if parser.profiler == 'pyinstrument':
+                profiler.stop()
+                with open(parser.profile, 'w') as file:
+                    file.write(profiler.output_html())
+            else:
+                profiler.disable()
+                profiler.dump_stats(parser.profile)
+            if parser.stats:
+                print(json.dumps(stats.summary()), file=sys.stderr)
+
+
+# Runs the command of parsed arguments, printing its output to out
+def run_command(twitch, parser, out):
+
+    # distinct users are estimated with HyperLogLog sketches with --approx, or by default if exact counts are turned off
+    exact = (settings.EXACT_USER_COUNTS or getattr(parser, 'exact', False)) and not getattr(parser, 'approx', False)
+
     if parser.sub == "createchannel":
         channel = twitch.create_channel(parser.channel_id, parser.channel_name)
-        print(channel)
+        print(channel, file=out)
+    elif parser.sub == "parsetopspam" and parser.incremental:
+
+        twitch.parse_chatlog(parser.file, stream=True)
+        update_stat = twitch.update_top_spam(parser.file, exact=exact)
+
+        print("updated {} top spam records from {} new comments for stream {} on channel {}"\
+        .format(update_stat[1], update_stat[0], update_stat[2], update_stat[3]), file=out)
+
     elif parser.sub == "parsetopspam":
 
-        twitch.parse_chatlog(parser.file)
-        comments = twitch.process_comments(parser.file, True)
+        twitch.parse_chatlog(parser.file, stream=True)
+        comments = twitch.process_comments(parser.file, True, exact, parser.top_k, parser.fingerprint)
         stream_id = comments[0][1][3]
         channel_id = comments[0][1][2]
         twitch.delete_top_spam(channel_id, stream_id)
         spam_count = twitch.insert_top_spam(comments)
 
-        print("inserted {} top spam records for stream {} on channel {}".format(spam_count, stream_id, channel_id))
+        print("inserted {} top spam records for stream {} on channel {}".format(spam_count, stream_id, channel_id), file=out)
+
+        if parser.top_k:
+            # error bounds of the Space-Saving counts
+            uncertain_count = len([comment for comment, comment_data in comments \
+                if comment_data[0] > settings.TOP_SPAM_THRESHOLD >= comment_data[0] - comment_data[4]])
+            print("top {} counts overestimate occurrences by at most {}, {} comments may be above the threshold and were not inserted"\
+                .format(parser.top_k, max([comment_data[4] for comment, comment_data in comments]), uncertain_count), file=out)
 
     elif parser.sub == "gettopspam":
-        print(json.dumps(twitch.get_top_spam(parser.channel_id, parser.stream_id)))
+        print(json.dumps(twitch.get_top_spam(parser.channel_id, parser.stream_id), default=dict), file=out)
 
     elif parser.sub == "gettopspam2":
-        print(json.dumps(twitch.get_top_spam2(parser.channel_id, parser.stream_id)))
+        print(json.dumps(twitch.get_top_spam2(parser.channel_id, parser.stream_id, exact=not parser.approx), default=dict), file=out)
 
     elif parser.sub == "storechatlog":
 
-        chatlog = twitch.parse_chatlog(parser.file)
-        channel_id = chatlog['comments'][0]['channel_id']
-        stream_id = chatlog['comments'][0]['content_id']
+        twitch.parse_chatlog(parser.file, stream=True)
+        channel_id, stream_id = twitch.get_stream_ids(parser.file)
         twitch.delete_chatlog(channel_id, stream_id)
         inserted_chatlog_stat = twitch.insert_chatlog(parser.file)
 
         print("inserted {} records to chat log for stream {} on channel {}"\
-        .format(inserted_chatlog_stat[0]-inserted_chatlog_stat[1], inserted_chatlog_stat[2], inserted_chatlog_stat[3]))
+        .format(inserted_chatlog_stat[0]-inserted_chatlog_stat[1], inserted_chatlog_stat[2], inserted_chatlog_stat[3]), file=out)
+
+    elif parser.sub == "ingest":
+
+        twitch.parse_chatlog(parser.file, stream=True)
+        channel_id, stream_id = twitch.get_stream_ids(parser.file)
+        twitch.delete_chatlog(channel_id, stream_id)
+        twitch.delete_top_spam(channel_id, stream_id)
+        ingest_stat = twitch.ingest_chatlog(parser.file, exact=exact)
+
+        print("inserted {} records to chat log for stream {} on channel {}"\
+        .format(ingest_stat[0]-ingest_stat[1], ingest_stat[2], ingest_stat[3]), file=out)
+        print("inserted {} top spam records for stream {} on channel {}".format(ingest_stat[4], stream_id, channel_id), file=out)
+
+    elif parser.sub == "ingestbatch":
+
+        filenames = expand_chatlog_paths(parser.paths)
+        start = time.perf_counter()
+        failure_count = 0
+        record_count = 0
+        for index, ingest_stat in enumerate(twitch.iter_ingest_chatlogs(filenames, parser.workers, exact=exact)):
+            filename, comment_count, insert_failure_count, stream_id, channel_id, spam_count, read_seconds, \
+                store_seconds, error = ingest_stat
+            if error:
+                failure_count += 1
+                print("[{}/{}] {}: failed, {}".format(index + 1, len(filenames), filename, error), file=out, flush=True)
+                continue
+
+            record_count += comment_count - insert_failure_count
+            print("[{}/{}] {}: inserted {} records to chat log and {} top spam records for stream {} on channel {} "\
+                "(read in {:.2f}s, stored in {:.2f}s)".format(index + 1, len(filenames), filename, comment_count - \
+                insert_failure_count, spam_count, stream_id, channel_id, read_seconds, store_seconds), file=out, flush=True)
+
+        print("ingested {} files, {} failed, {} records in {:.2f}s".format(len(filenames) - failure_count, failure_count, \
+            record_count, time.perf_counter() - start), file=out)
+
+    elif parser.sub == 'querychatlog' and (parser.limit is not None or parser.after is not None):
+        if parser.limit is None:
+            raise ValueError("--after needs the --limit of the pages")
+        rows, after = twitch.query_chatlog_page(parser.filters, parser.after, parser.limit)
+        print(json.dumps({'rows': rows, 'after': after}), file=out)
 
     elif parser.sub == 'querychatlog':
-        result = twitch.query_chatlog(parser.filters)
-        print(json.dumps(result))
+        rows = twitch.iter_query_chatlog(parser.filters, parser.page_size)
+        if parser.jsonl:
+            print_json_lines(rows, out)
+        else:
+            print_json_array(rows, out)
+
+    elif parser.sub == 'searchchatlog':
+        rows = twitch.search_chatlog(parser.query, parser.channel_id, parser.stream_id, parser.limit)
+        if parser.jsonl:
+            print_json_lines(rows, out)
+        else:
+            print_json_array(rows, out)
 
     elif parser.sub == 'viewership':
-        print(json.dumps(twitch.get_viewer_metrics(parser.channel_id, parser.stream_id)))
+        print(json.dumps(twitch.get_viewer_metrics(parser.channel_id, parser.stream_id, not parser.approx, \
+            parser.window), default=dict), file=out)
+
+    elif parser.sub == 'rebuildrollups':
+        stream_count = twitch.rebuild_rollups(parser.channel_id, parser.stream_id)
+        print("rebuilt the rollups of {} streams".format(stream_count), file=out)
+
+
+
+# prints rows as a json array while they are produced, the output is the same as json.dumps(list(rows))
+# Rows are converted to dicts only here, when they are serialized
+def print_json_array(rows, out):
+    out.write('[')
+    for index, row in enumerate(rows):
+        if index:
+            out.write(', ')
+        out.write(json.dumps(row, default=dict))
+    print(']', file=out)
+
 
+# prints every row as a json object on its own line as soon as it is produced
+def print_json_lines(rows, out):
+    for row in rows:
+        print(json.dumps(row, default=dict), file=out, flush=True)
 
 
 if __name__== "__main__":
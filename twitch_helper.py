@@ -1,9 +1,28 @@
 import argparse
+import glob
+import json
+import os
+import socket
+import sys
+import settings
 
 def create_argument_parser():
     # creating parsing  functionality for the application
     argument_parser = argparse.ArgumentParser(description='Parsing the command line arguments for twitch application')
 
+    # SQLite performance profile used for this invocation
+    argument_parser.add_argument('--sqlite-profile', choices=sorted(settings.SQLITE_PROFILES.keys()))
+
+    # commands are run by the `serve` process listening on --socket with --server
+    argument_parser.add_argument('--server', action='store_true', help="forward the command to a running twitch.py serve")
+    argument_parser.add_argument('--socket', default=settings.SERVER_SOCKET, help="unix socket of the server")
+
+    # timers and counters of the command, printed to stderr as json, and profiling of the command to a file
+    argument_parser.add_argument('--stats', action='store_true', help="print the timers and counters of the command to stderr")
+    argument_parser.add_argument('--profile', metavar='FILE', help="profile the command and write the profile to FILE")
+    argument_parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile', \
+        help="cprofile writes pstats data, pyinstrument (if installed) an html report")
+
     # sub-commands functionality
     sub_parser = argument_parser.add_subparsers(dest='sub')
 
@@ -15,6 +34,13 @@ def create_argument_parser():
     # look for parst top spam functionality and add arguments to parser
     parser_pars_topspam = sub_parser.add_parser('parsetopspam')
     parser_pars_topspam.add_argument('file')
+    parser_pars_topspam.add_argument("--incremental", action="store_true", \
+        help="only count the comments added since the last run on this stream")
+    add_exact_argument(parser_pars_topspam)
+    count_mode = parser_pars_topspam.add_mutually_exclusive_group()
+    count_mode.add_argument("--top-k", type=int, metavar='K', \
+        help="only count the K most repeated comments, in bounded memory (e.g. {})".format(settings.TOP_K_CAPACITY))
+    count_mode.add_argument("--fingerprint", action="store_true", help="count near duplicate comments together")
 
     # look for get top spam command and add arguments to parser
     parser_get_topspam = sub_parser.add_parser('gettopspam')
@@ -25,18 +51,120 @@ def create_argument_parser():
     parser_get_topspam = sub_parser.add_parser('gettopspam2')
     parser_get_topspam.add_argument("channel_id")
     parser_get_topspam.add_argument("stream_id")
+    add_approx_argument(parser_get_topspam)
 
     # look for storing chat log functionality and add file name argument to parser
     parser_store_chatlog = sub_parser.add_parser("storechatlog")
     parser_store_chatlog.add_argument('file')
 
+    # look for ingesting a chat log into both the chat log and top spam in a single pass
+    parser_ingest = sub_parser.add_parser("ingest")
+    parser_ingest.add_argument('file')
+    add_exact_argument(parser_ingest)
+
+    # look for ingesting many chat logs with a pool of processes
+    parser_ingest_batch = sub_parser.add_parser("ingestbatch")
+    parser_ingest_batch.add_argument('paths', nargs='+', help="chatlog files, directories of .json files or glob patterns")
+    parser_ingest_batch.add_argument("--workers", type=int, default=settings.INGEST_WORKERS, \
+        help="number of processes reading the files")
+    add_exact_argument(parser_ingest_batch)
+
     # look for querying the chat log with filers
     parser_query_chatlog = sub_parser.add_parser("querychatlog")
     parser_query_chatlog.add_argument("filters",nargs="+")
+    query_chatlog_output = parser_query_chatlog.add_mutually_exclusive_group()
+    query_chatlog_output.add_argument("--jsonl", action="store_true", help="print one json object per line")
+    query_chatlog_output.add_argument("--limit", type=int, \
+        help='print a page of at most LIMIT rows as {"rows": [...], "after": key of the next page or null}')
+    parser_query_chatlog.add_argument("--after", type=json.loads, help='"after" key printed with the previous page')
+    parser_query_chatlog.add_argument("--page-size", type=int, default=settings.SELECT_PAGE_SIZE)
+
+    # look for full text search of the chat log messages
+    parser_search_chatlog = sub_parser.add_parser("searchchatlog")
+    parser_search_chatlog.add_argument("query", help='words, "phrases", prefixes*, AND, OR, NOT, NEAR and ( )')
+    parser_search_chatlog.add_argument("--channel-id")
+    parser_search_chatlog.add_argument("--stream-id")
+    parser_search_chatlog.add_argument("--limit", type=int, default=settings.SEARCH_LIMIT, \
+        help="number of best ranked messages printed")
+    parser_search_chatlog.add_argument("--jsonl", action="store_true", help="print one json object per line")
 
     # look for get viewership metrics command and add arguments to parser
     parser_get_topspam = sub_parser.add_parser('viewership')
     parser_get_topspam.add_argument("channel_id")
     parser_get_topspam.add_argument("stream_id")
+    parser_get_topspam.add_argument("--window", choices=list(settings.VIEWERSHIP_WINDOWS), default=settings.VIEWERSHIP_WINDOW, \
+        help="count messages and viewers per window of stream time")
+    add_approx_argument(parser_get_topspam)
+
+    # look for rebuilding the rollups of a stream, or of every stream without arguments
+    parser_rebuild_rollups = sub_parser.add_parser('rebuildrollups')
+    parser_rebuild_rollups.add_argument("channel_id", nargs='?')
+    parser_rebuild_rollups.add_argument("stream_id", nargs='?')
+
+    # look for running the commands sent by clients in a long running process
+    parser_serve = sub_parser.add_parser('serve')
+    parser_serve.add_argument("--workers", type=int, default=settings.SERVER_WORKERS, \
+        help="number of commands run at the same time")
 
     return argument_parser
+
+
+# Returns the chatlog files of paths given to ingestbatch, each path being a file, a directory whose .json
+# files are taken or a glob pattern. Files of a directory or pattern are sorted
+def expand_chatlog_paths(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += sorted(glob.glob(os.path.join(path, '*.json')))
+        elif os.path.exists(path) or not glob.has_magic(path):
+            filenames.append(path)
+        else:
+            filenames += sorted(glob.glob(path))
+    return filenames
+
+
+# commands counting distinct users count them exactly or with HyperLogLog sketches, settings.EXACT_USER_COUNTS
+# is used if neither is given
+def add_exact_argument(parser):
+    user_counts = parser.add_mutually_exclusive_group()
+    user_counts.add_argument("--exact", action="store_true", help="count distinct users exactly")
+    user_counts.add_argument("--approx", action="store_true", help="estimate distinct users with HyperLogLog sketches")
+
+
+# queries counting distinct users with COUNT(DISTINCT user) can estimate them with approx_count_distinct,
+# which uses a fixed amount of memory per group but is slower as every row is hashed in python
+def add_approx_argument(parser):
+    parser.add_argument("--approx", action="store_true", help="estimate distinct users with a HyperLogLog sketch")
+
+
+# Sends the arguments of a twitch.py command to the server listening on socket_path (see twitch_server)
+# and writes its output to out as it arrives. Errors are written to err. Returns the exit code of the command
+def forward(argv, socket_path=settings.SERVER_SOCKET, out=None, err=None):
+    out = out or sys.stdout
+    err = err or sys.stderr
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print('No server is listening on {}, start one with twitch.py --socket {} serve'.format(socket_path, \
+                socket_path), file=err)
+            return 1
+        client.sendall((json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n').encode('utf-8'))
+
+        with client.makefile('r', encoding='utf-8') as responses:
+            for line in responses:
+                response = json.loads(line)
+                if 'stdout' in response:
+                    out.write(response['stdout'])
+                    out.flush()
+                    continue
+
+                if response.get('stats'):
+                    print(json.dumps(response['stats']), file=err)
+                if response['error']:
+                    print(response['error'], file=err)
+                return response['exit']
+
+    print('The server closed the connection', file=err)
+    return 1
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from models.stats import Stats
+import settings
+
+# Commands are sent to the server over a Unix socket as a line of JSON, {"argv": [...], "cwd": "..."},
+# argv being the arguments of twitch.py (see twitch_helper.forward). The server answers with lines of
+# JSON: {"stdout": "..."} as the command prints, then {"exit": 0, "error": null} once it is done, or a
+# non zero exit and an error message. With --stats the last line also has the "stats" of the command
+
+# commands writing to the database, run one at a time so they do not wait on each other's locks
+WRITE_COMMANDS = ['createchannel', 'parsetopspam', 'storechatlog', 'ingest', 'ingestbatch', 'rebuildrollups']
+
+
+# Output of a command run by the server, sent to the client every settings.SERVER_OUTPUT_BUFFER_SIZE
+# characters or when the command flushes it. send blocks the command until the client received the
+# output, so a slow client slows the command down instead of growing the buffer
+class ClientOutput():
+
+    def __init__(self, send):
+        self.send = send
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= settings.SERVER_OUTPUT_BUFFER_SIZE:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            text = ''.join(self.buffer)
+            self.buffer = []
+            self.size = 0
+            self.send({'stdout': text})
+
+
+# Runs the commands of twitch.py sent by clients in a single long running process, so the database is
+# set up once and the connections of the worker threads and their prepared statements are kept between
+# commands. run_command(parser, out) runs the command of parsed arguments, printing to out
+class TwitchServer():
+
+    def __init__(self, run_command, argument_parser, socket_path=settings.SERVER_SOCKET, workers=settings.SERVER_WORKERS):
+        self.run_command = run_command
+        self.argument_parser = argument_parser
+        self.socket_path = socket_path
+        self.logger = settings.server_logger
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers)
+        self.write_lock = threading.Lock()
+        # set once the server accepts clients
+        self.ready = threading.Event()
+        self.__loop = None
+        self.__stopped = None
+
+    # Serves clients until stop is called or the process is interrupted or terminated
+    def serve_forever(self):
+        asyncio.run(self.__serve())
+
+    # Stops the server once the commands being run are done, can be called from any thread
+    def stop(self):
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__set_stopped)
+
+    async def __serve(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__stopped = self.__loop.create_future()
+        if threading.current_thread() is threading.main_thread():
+            for signal_number in [signal.SIGINT, signal.SIGTERM]:
+                self.__loop.add_signal_handler(signal_number, self.__set_stopped)
+
+        self.__remove_stale_socket()
+        server = await asyncio.start_unix_server(self.__handle_client, self.socket_path)
+        self.logger.info('Server listening on (%s) with %s workers', self.socket_path, self.workers)
+        self.ready.set()
+        try:
+            async with server:
+                await self.__stopped
+        finally:
+            os.unlink(self.socket_path)
+            self.executor.shutdown()
+            self.logger.info('Server on (%s) stopped', self.socket_path)
+
+    def __set_stopped(self):
+        if not self.__stopped.done():
+            self.__stopped.set_result(None)
+
+    # A socket file left by a server that was killed is removed, one still accepting clients is not
+    def __remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            try:
+                client.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.unlink(self.socket_path)
+                return
+        raise OSError("A server is already listening on {}".format(self.socket_path))
+
+    async def __handle_client(self, reader, writer):
+        # called by the command thread for every piece of output
+        def send(message):
+            asyncio.run_coroutine_threadsafe(self.__send(writer, message), self.__loop).result()
+
+        try:
+            request = json.loads(await reader.readline())
+            exit_code, error, stats = await self.__loop.run_in_executor(self.executor, self.__run_request, request, send)
+            message = {'exit': exit_code, 'error': error}
+            if stats is not None:
+                message['stats'] = stats
+            await self.__send(writer, message)
+        except (ConnectionError, ValueError, KeyError) as e:
+            self.logger.error('Server could not answer a client.\n\tError: %s', e)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def __send(writer, message):
+        writer.write((json.dumps(message) + '\n').encode('utf-8'))
+        await writer.drain()
+
+    # Runs the command of a request on a worker thread, returns (exit code, error message, stats summary or None)
+    def __run_request(self, request, send):
+        try:
+            parser = self.argument_parser.parse_args(request['argv'])
+        except SystemExit:
+            return 2, 'Invalid arguments {}'.format(request['argv']), None
+
+        if parser.sub is None or parser.sub == 'serve':
+            return 2, 'The server can not run {}'.format(parser.sub or 'without a command'), None
+        if parser.sqlite_profile:
+            return 2, 'The SQLite profile of the server is set by the serve command', None
+        if parser.profile:
+            return 2, 'The server does not profile commands, run them without --server', None
+
+        # files are opened relative to the directory of the client
+        if getattr(parser, 'file', None):
+            parser.file = os.path.join(request['cwd'], parser.file)
+        if getattr(parser, 'paths', None):
+            parser.paths = [os.path.join(request['cwd'], path) for path in parser.paths]
+
+        # the stats of the command are collected by this worker thread only
+        output = ClientOutput(send)
+        with Stats.collect() as stats:
+            try:
+                if parser.sub in WRITE_COMMANDS:
+                    with self.write_lock:
+                        self.run_command(parser, output)
+                else:
+                    self.run_command(parser, output)
+                output.flush()
+            except Exception as e:
+                self.logger.error('Server command %s failed.\n\tError: %s', request['argv'], e)
+                return 1, '{}: {}'.format(type(e).__name__, e), stats.summary() if parser.stats else None
+
+        self.logger.info('Server command %s complete', request['argv'])
+        return 0, None, stats.summary() if parser.stats else None